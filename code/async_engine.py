@@ -0,0 +1,223 @@
+"""
+    An asyncio engine for StrategyThree, selected with `--engine async`.
+
+    The Sleekflow contacts are retrieved while the Breeze contacts are retrieved and processed, the Breeze
+    people are retrieved while the tags and the people per tag are and every batch of Sleekflow changes is
+    uploaded as soon as the comparison fills it, as a single stream of creates, updates and deletes. The
+    processing and the comparison are CPU bound, so they run in a thread of their own, which hands the
+    requests to the event loop.
+
+    At most ASYNC_ENGINE_CONCURRENCY requests are in flight at the same time, which is the budget shared by all of
+    it (next to the rate limits in RATE_LIMITS). The Breeze tags and the Sleekflow pages are retrieved like the
+    synchronous StrategyThree does, within BREEZE_TAG_FETCH_CONCURRENCY and SLEEKFLOW_PAGE_FETCH_CONCURRENCY, and at
+    most SLEEKFLOW_UPLOAD_CONCURRENCY batches are uploaded at the same time.
+    The results are the same as those of the synchronous StrategyThree.
+"""
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from configs import (
+    ASYNC_ENGINE_CONCURRENCY,
+    FILTERED_EXPORT_ENABLED,
+    SLEEKFLOW_UPLOAD_CONCURRENCY,
+)
+from breeze import Breeze
+from sleekflow import Sleekflow, SleekflowBatcher
+from strategies import StrategyThree
+from instrumentation import span
+from logger import log
+from transport import shared_request_budget
+
+
+class DryRunFinished(Exception):
+    """
+        Stops the processing after the output of a dry run, where the synchronous StrategyThree exits
+    """
+
+
+class AsyncStrategyThree(StrategyThree):
+    loop = None
+    executor = None
+    upload_slots = None
+
+    # The retrieval of the Sleekflow contacts, started when the run starts
+    sleekflow_contacts = None
+
+    @classmethod
+    def execute(cls, samplefile, datafile, *args, **kwargs):
+        if asyncio.run(cls.execute_async(samplefile, datafile, *args, **kwargs)) and Sleekflow.dry_run:
+            # Exiting is left until the event loop is done
+            exit(0)
+
+    @classmethod
+    async def execute_async(cls, samplefile, datafile, *args, **kwargs):
+        """
+            Returns whether the contacts were synced
+        """
+        log('Executing Strategy 3 (async engine)')
+        cls.loop = asyncio.get_running_loop()
+        cls.executor = ThreadPoolExecutor(max_workers=ASYNC_ENGINE_CONCURRENCY)
+        cls.upload_slots = asyncio.Semaphore(SLEEKFLOW_UPLOAD_CONCURRENCY)
+
+        # Every request of the run, however deeply nested its pool, takes one of the slots
+        with shared_request_budget(ASYNC_ENGINE_CONCURRENCY):
+            try:
+                Sleekflow.set_full_sync(kwargs.get('full_sync', False))
+                # An incremental sync compares the contacts to the snapshot of the last sync instead
+                cls.sleekflow_contacts = None
+                if Sleekflow.full_sync_due():
+                    cls.sleekflow_contacts = cls.submit_request(Sleekflow.get_all_contacts)
+                with span('breeze.get_contacts'):
+                    success, contacts, tags = await cls.run_request(Breeze.get_contacts, prefetch_people=True)
+
+                if not success:
+                    if cls.sleekflow_contacts is not None:
+                        cls.sleekflow_contacts.cancel()
+                    cls.notify_failed_retrieval()
+                    return False
+
+                # The processing is CPU bound, so it runs in its own thread; so does the comparison (see sync_contacts)
+                try:
+                    await cls.loop.run_in_executor(
+                        None, partial(cls.process_contacts, contacts, tags, samplefile, datafile, *args, **kwargs)
+                    )
+                except DryRunFinished:
+                    pass
+                return True
+            finally:
+                cls.executor.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    def submit_request(cls, function, *args, **kwargs):
+        """
+            Starts the request right away, even while the event loop is busy, and returns an awaitable of its result
+        """
+        return cls.loop.run_in_executor(cls.executor, partial(function, *args, **kwargs))
+
+    @classmethod
+    async def run_request(cls, function, *args, **kwargs):
+        return await cls.submit_request(function, *args, **kwargs)
+
+    @classmethod
+    def sync_contacts(cls, contacts):
+        """
+            The same as Sleekflow.sync, with every batch of changes uploaded as soon as it is full, while the rest
+            of the contacts are compared. Called from the processing thread, where the comparison runs too; the
+            event loop only sends the requests.
+        """
+        contacts, ignored_contacts = Sleekflow.parse_contacts(contacts)
+        owned_labels = Sleekflow.owned_labels(contacts, cls.owned_labels())
+        protected_labels = cls.protected_labels()
+        snapshot = Sleekflow.open_snapshot()
+        try:
+            result = cls.sync_to_sleekflow(
+                contacts, ignored_contacts, cls.sync_journal(), snapshot, owned_labels, protected_labels
+            )
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+        if Sleekflow.dry_run:
+            raise DryRunFinished()
+        return result
+
+    @classmethod
+    def wait_for(cls, awaitable):
+        """
+            Waits for an awaitable of the event loop from another thread and returns its result
+        """
+        async def _wait():
+            return await awaitable
+        return asyncio.run_coroutine_threadsafe(_wait(), cls.loop).result()
+
+    @classmethod
+    async def upload_change_batch(cls, endpoint, change, batch):
+        async with cls.upload_slots:
+            return await cls.run_request(Sleekflow.upload_change_batch, endpoint, change, batch)
+
+    @classmethod
+    def sync_to_sleekflow(cls, contacts, ignored_contacts, journal, snapshot, owned_labels, protected_labels):
+        full_sync = cls.sleekflow_contacts is not None
+        # Only the time spent waiting for the contacts that were retrieved in the meantime
+        with span('sleekflow.get_contacts'):
+            if full_sync:
+                contacts_to_compare, sleekflow_contacts = contacts, cls.wait_for(cls.sleekflow_contacts)
+            else:
+                contacts_to_compare, sleekflow_contacts = Sleekflow.contacts_to_compare(contacts, snapshot, full_sync)
+
+        changes = Sleekflow.iter_changes(contacts_to_compare, sleekflow_contacts, owned_labels, protected_labels)
+
+        if Sleekflow.dry_run:
+            log(f'{Sleekflow.LOGGER_ID} sync: comparing contacts')
+            planned = {'creates': [], 'updates': [], 'deletes': []}
+            with span('sleekflow.compare'):
+                for change, record in changes:
+                    planned[change].append(record)
+
+            Sleekflow.print_dry_run(planned['creates'], planned['updates'], planned['deletes'])
+            return Sleekflow.sync_result(
+                planned['creates'], planned['updates'], planned['deletes'], ignored_contacts, [], [], []
+            )
+
+        log(f'{Sleekflow.LOGGER_ID} sync: comparing contacts and uploading the changes')
+        endpoint = Sleekflow.add_api_key(Sleekflow.ADD_OR_UPDATE_RESOURCE)
+        planned = {'creates': [], 'updates': [], 'deletes': []}
+        # Only when a sync whose plan was cut off is resumed (see SyncJournal)
+        _changes, _ignored_contacts, uploaded_phone_numbers, previous_failures = (
+            journal.read() if journal is not None else ({}, [], {}, {})
+        )
+        batchers = {change: SleekflowBatcher() for change in planned}
+        uploads = []
+
+        def _upload(change, batches):
+            for batch in batches:
+                # A batch is recorded in the plan before it's uploaded, so that the uploaded batch can be found in it
+                if journal is not None:
+                    journal.record_planned_changes(change, batch)
+                if change == 'deletes' and FILTERED_EXPORT_ENABLED:
+                    # See Sleekflow.upload_changes
+                    continue
+                upload = asyncio.run_coroutine_threadsafe(cls.upload_change_batch(endpoint, change, batch), cls.loop)
+                uploads.append((change, upload))
+
+        Sleekflow.journal = journal
+        try:
+            # The uploads start while the contacts are compared, so the compare span is part of the write span
+            with span('sleekflow.write'):
+                with span('sleekflow.compare'):
+                    for change, record in changes:
+                        planned[change].append(record)
+                        if record[1]['phoneNumber'] in uploaded_phone_numbers.get(change, ()):
+                            journal.record_planned_changes(change, [record])
+                            continue
+                        _upload(change, batchers[change].add(record))
+                    for change, batcher in batchers.items():
+                        _upload(change, batcher.flush())
+
+                if journal is not None:
+                    journal.record_plan_complete(ignored_contacts)
+
+                log(f'{Sleekflow.LOGGER_ID} sync: waiting for {len(uploads)} batches of {len(planned["creates"])} '
+                    f'creates, {len(planned["updates"])} updates and {len(planned["deletes"])} deletes')
+                results = [upload.result() for _change, upload in uploads]
+        finally:
+            Sleekflow.journal = None
+
+        if journal is not None:
+            journal.record_finished()
+
+        failures = {change: list(previous_failures.get(change, [])) for change in planned}
+        for (change, _upload_future), batch_failures in zip(uploads, results):
+            failures[change].extend(batch_failures)
+
+        if snapshot is not None:
+            Sleekflow.update_snapshot(
+                snapshot, full_sync, contacts_to_compare, sleekflow_contacts,
+                failures['creates'] + failures['updates'] + failures['deletes'], owned_labels, protected_labels,
+            )
+
+        return Sleekflow.sync_result(
+            planned['creates'], planned['updates'], planned['deletes'], ignored_contacts,
+            failures['creates'], failures['updates'], failures['deletes'],
+        )
@@ -0,0 +1,223 @@
+"""
+    Synthetic benchmarks for the hot paths of the sync.
+
+    Usage (from the directory in which the sync.sh file lives):
+
+        python ./code/benchmarks.py <benchmark> [--sizes 1000 10000 ...]
+
+    No remote API is called; every benchmark generates its own data.
+"""
+import argparse
+import random
+import time
+import pandas as pd
+
+from breeze import Breeze
+from strategies import CSVStrategy, StrategyThree
+from utils import compare_contacts, determine_updates, map_to_respondio_api_fields
+
+DEFAULT_SIZES = {
+    'compare_contacts': [1000, 10000, 50000, 200000],
+    'determine_updates': [10000, 50000, 200000],
+    'breeze_tags': [5000, 20000, 50000],
+    'parse_to_new_dataframe': [5000, 20000, 50000],
+    'parse_to_dataframe': [5000, 20000, 50000],
+}
+BREEZE_TAGS_COUNT = 300
+SAMPLE_FILE_HEADERS = [
+    'First Name', 'Last Name', 'Phone Number', 'Email', 'Tags', 'Assignee',
+    'custom_field.breeze_id', 'custom_field.active', 'Age',
+]
+
+
+def _timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _print_row(size, seconds, details=''):
+    per_item = (seconds / size) * 1e6 if size else 0
+    print(f'{size:>10} | {seconds:>10.3f}s | {per_item:>8.2f}us/item | {details}')
+
+
+def _synthetic_breeze_contacts(size):
+    return [
+        {
+            'custom_field.breeze_id': str(1000000 + i),
+            'Phone Number': f'2782{i:07d}',
+            'First Name': f'First{i}',
+            'Last Name': f'Last{i}',
+            'custom_field.active': 'true',
+            'Tags': ', '.join(f'Tag {t}' for t in range(i % 5)),
+        }
+        for i in range(size)
+    ]
+
+
+def _synthetic_respondio_contacts(size, rng):
+    """
+        Roughly 80% of the Breeze contacts exist remotely (some of them with stale fields or tags),
+        10% of the remote contacts no longer exist in Breeze and a handful are duplicates.
+    """
+    contacts = []
+    for i in range(size):
+        if rng.random() < 0.2:
+            continue
+        contacts.append({
+            'id': 5000000 + i,
+            'custom_fields': {
+                'breeze_id': str(1000000 + i),
+                'phone': f'2782{i:07d}',
+                'firstName': f'First{i}' if rng.random() < 0.9 else f'Stale{i}',
+                'lastName': f'Last{i}',
+                'active': 'true',
+            },
+            'tags': [f'Tag {t}' for t in range(i % 4)],
+        })
+
+    for i in range(size // 10):
+        contacts.append({
+            'id': 9000000 + i,
+            'custom_fields': {'breeze_id': str(8000000 + i), 'active': 'true'},
+            'tags': [],
+        })
+
+    for i in range(0, size, 1000):
+        contacts.append({
+            'id': 9900000 + i,
+            'custom_fields': {'breeze_id': str(1000000 + i), 'active': 'true'},
+            'tags': [],
+        })
+
+    rng.shuffle(contacts)
+    return contacts
+
+
+def benchmark_compare_contacts(sizes):
+    print('compare_contacts: <breeze contacts> | <time> | <time per contact> | creates/updates/deletes')
+    rng = random.Random(0)
+
+    for size in sizes:
+        breeze_contacts = _synthetic_breeze_contacts(size)
+        respondio_contacts = _synthetic_respondio_contacts(size, rng)
+
+        seconds, (creates, updates, deletes) = _timed(
+            compare_contacts,
+            breeze_contacts=breeze_contacts,
+            respondio_contacts=respondio_contacts,
+        )
+        _print_row(size, seconds, f'{len(creates)}/{len(updates)}/{len(deletes)}')
+
+
+def benchmark_determine_updates(sizes):
+    print('determine_updates (5% changed): <matched contacts> | <time> | <time per contact> | updates')
+
+    for size in sizes:
+        mapped_contacts = map_to_respondio_api_fields(_synthetic_breeze_contacts(size))
+        matched_contacts = []
+        for i, contact in enumerate(mapped_contacts):
+            custom_fields = {key: value for key, value in contact.items() if key != 'tags'}
+            if i % 20 == 0:
+                custom_fields['firstName'] = f'Stale{i}'
+            matched_contacts.append({
+                'breeze': contact,
+                'respondio': {'id': i, 'custom_fields': custom_fields, 'tags': list(reversed(contact['tags']))},
+            })
+
+        seconds, updates = _timed(determine_updates, matched_contacts)
+        _print_row(size, seconds, str(len(updates)))
+
+
+def benchmark_breeze_tags(sizes):
+    print(f'Breeze tag join ({BREEZE_TAGS_COUNT} tags): <people> | <time> | <time per person> | memberships')
+    rng = random.Random(0)
+
+    for size in sizes:
+        people = [{'id': str(i), 'tags': []} for i in range(size)]
+        tag_memberships = [
+            (f'Tag {t}', [{'id': str(i)} for i in rng.sample(range(size), rng.randint(0, size // 50))])
+            for t in range(BREEZE_TAGS_COUNT)
+        ]
+        memberships_count = sum(len(tag_people) for _tag_name, tag_people in tag_memberships)
+
+        seconds, _people = _timed(Breeze._apply_tag_memberships, people, tag_memberships)
+        _print_row(size, seconds, str(memberships_count))
+
+
+def _synthetic_breeze_export(size, rng):
+    """
+        A dataframe shaped like a Breeze export, with BREEZE_TAGS_COUNT sparse '(Tag)' columns
+    """
+    data = {
+        'Breeze ID': [1000000 + i for i in range(size)],
+        'First Name': [f'First{i}' for i in range(size)],
+        'Last Name': [f'Last{i}' for i in range(size)],
+        'Gender': [rng.choice(['Male', 'Female', None]) for _i in range(size)],
+        'Age': [rng.choice([float('nan'), 12.0, 40.0, 65.0, 80.0]) for _i in range(size)],
+        'Campus': [rng.choice(['Durbanville Campus', 'Bellville Campus', None]) for _i in range(size)],
+        'Mobile': [f'082 {i:07d}' for i in range(size)],
+        'Email': [f'person{i}@example.com' for i in range(size)],
+    }
+    for t in range(BREEZE_TAGS_COUNT):
+        data[f'Tag {t} (Tag)'] = [('x' if rng.random() < 0.02 else None) for _i in range(size)]
+    return pd.DataFrame(data=data)
+
+
+def benchmark_parse_to_new_dataframe(sizes):
+    print(f'parse_to_new_dataframe ({BREEZE_TAGS_COUNT} tag columns): <rows> | <time> | <time per row> |')
+    rng = random.Random(0)
+
+    for size in sizes:
+        dataframe = _synthetic_breeze_export(size, rng)
+        seconds, _dataframe = _timed(CSVStrategy.parse_to_new_dataframe, SAMPLE_FILE_HEADERS, dataframe)
+        _print_row(size, seconds)
+
+
+def benchmark_parse_to_dataframe(sizes):
+    print(f'parse_to_dataframe ({BREEZE_TAGS_COUNT} tags): <people> | <time> | <time per person> | dataframe size')
+    rng = random.Random(0)
+    tags = [f'Tag {t}' for t in range(BREEZE_TAGS_COUNT)]
+
+    for size in sizes:
+        people = [
+            {
+                'id': str(1000000 + i), 'first_name': f'First{i}', 'last_name': f'Last{i}', 'gender': 'Female',
+                'age': '40', 'campus': '', 'mobile': f'082 {i:07d}', 'email': '',
+                'tags': rng.sample(tags, rng.randint(0, 10)),
+            }
+            for i in range(size)
+        ]
+
+        seconds, dataframe = _timed(StrategyThree.parse_to_dataframe, people, tags)
+        _print_row(size, seconds, f'{dataframe.memory_usage(deep=True).sum() / 2 ** 20:.1f}MB')
+
+
+BENCHMARKS = {
+    'compare_contacts': benchmark_compare_contacts,
+    'determine_updates': benchmark_determine_updates,
+    'breeze_tags': benchmark_breeze_tags,
+    'parse_to_new_dataframe': benchmark_parse_to_new_dataframe,
+    'parse_to_dataframe': benchmark_parse_to_dataframe,
+}
+
+
+def handle_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'benchmark',
+        choices=BENCHMARKS.keys(),
+        help='The benchmark to run',
+    )
+    parser.add_argument(
+        '--sizes',
+        nargs='+',
+        type=int,
+        help='Overrides the default input sizes of the benchmark',
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = handle_arguments()
+    BENCHMARKS[args.benchmark](args.sizes or DEFAULT_SIZES[args.benchmark])
@@ -1,16 +1,20 @@
-import requests
 import json
 
 from datetime import datetime
 from configs import (
     BREEZE_API_URL,
     BREEZE_API_KEY,
+    BREEZE_TAG_FETCH_CONCURRENCY,
 )
+from concurrency import map_concurrently, start_in_background
+from transport import get_client
 from logger import log
 
 
 class BreezeRequests:
 
+    client = get_client('breeze')
+
     @classmethod
     def headers(cls):
         return {
@@ -24,15 +28,23 @@ class BreezeRequests:
             base_url=BREEZE_API_URL,
             resource_endpoint=resource
         )
-        return requests.get(url, headers=cls.headers())
+        return cls.client.get(url, headers=cls.headers())
 
 
 class Breeze(BreezeRequests):
 
     LOGGER_ID = 'Breeze'
 
+    # The tags whose people could not be retrieved during the last get_contacts call
+    failed_tags = []
+
     @classmethod
-    def get_contacts(cls):
+    def get_contacts(cls, prefetch_people=False):
+        """
+            With 'prefetch_people', the people are retrieved while the tags and the people per tag are
+        """
+        people = start_in_background(cls._get_people, detail=True) if prefetch_people else None
+
         try:
             log(f'{cls.LOGGER_ID} get_contacts: retrieving tags')
             tags = cls._get_tags()
@@ -40,36 +52,84 @@ class Breeze(BreezeRequests):
             log(f'{cls.LOGGER_ID} get_contacts: something went wrong retrieving tags: {e}')
             return False, None, None
 
-        try:
+        if people is None:
             log(f'{cls.LOGGER_ID} get_contacts: retrieving people')
-            people_list = cls._get_people(detail=True)
+            people_list = cls._people_result(lambda: cls._get_people(detail=True))
+            if people_list is None:
+                return False, None, None
+
+        log(f'{cls.LOGGER_ID} get_contacts: retrieving people per tag')
+        tags_people = map_concurrently(
+            lambda tag: cls._get_users_by_tag_id(tag['id']),
+            tags,
+            max_workers=BREEZE_TAG_FETCH_CONCURRENCY,
+        )
+
+        if people is not None:
+            log(f'{cls.LOGGER_ID} get_contacts: waiting for the people')
+            people_list = cls._people_result(people.result)
+            if people_list is None:
+                return False, None, None
+
+        return cls.build_contacts(people_list, tags, tags_people)
+
+    @classmethod
+    def _people_result(cls, get_people):
+        # Returns None if the people could not be retrieved
+        try:
+            return get_people()
         except Exception as e:
             log(f'{cls.LOGGER_ID} get_contacts: something went wrong retrieving people: {e}')
-            return False, None, None
+            return None
 
+    @classmethod
+    def build_contacts(cls, people_list, tags, tags_people):
+        """
+            Parses the people and adds their tags. 'tags_people' has a (<people>, <error>) tuple for every
+            tag, as returned by map_concurrently. Returns the same as get_contacts.
+        """
         people_list_with_tags = []
         for person in people_list:
             p = cls._parse_person_fields(person)
             people_list_with_tags.append(p)
 
         tags_names = []
-        log(f'{cls.LOGGER_ID} get_contacts: updating people tags')
+        tag_memberships = []
+        cls.failed_tags = []
 
-        for tag in tags:
-            people = cls._get_users_by_tag_id(tag['id'])
-            people_list_with_tags = cls._update_people_in_list_with_tag(people, people_list_with_tags, tag['name'])
+        for tag, (people, error) in zip(tags, tags_people):
+            if error is not None:
+                log(f'{cls.LOGGER_ID} get_contacts: something went wrong retrieving people for tag {tag["name"]}: {error}')
+                cls.failed_tags.append({'tag': tag, 'error': error})
+                continue
+
+            tag_memberships.append((tag['name'], people))
             tags_names.append(tag['name'])
 
+        log(f'{cls.LOGGER_ID} get_contacts: updating people tags')
+        people_list_with_tags = cls._apply_tag_memberships(people_list_with_tags, tag_memberships)
+
         return True, people_list_with_tags, tags_names
 
     @classmethod
-    def _update_people_in_list_with_tag(cls, tags_people, people_list, tag_name):
-        for tag_person in tags_people:
-            for index, p in enumerate(people_list):
-                if p.get('id', '') == tag_person['id']:
-                    current_tags = p.get('tags') or []
-                    p['tags'] = current_tags + [tag_name]
-                    people_list[index] = p
+    def _apply_tag_memberships(cls, people_list, tag_memberships):
+        """
+            'tag_memberships' format:
+            [(<tag_name>, [<tag_person>, <tag_person>, ...]), ...]
+
+            The people are indexed by id once, after which every tag membership is a dict lookup.
+            Tags are appended to each person in the order of 'tag_memberships'.
+        """
+        people_by_id = {}
+        for person in people_list:
+            people_by_id.setdefault(person.get('id', ''), []).append(person)
+
+        for tag_name, tag_people in tag_memberships:
+            for tag_person in tag_people:
+                for person in people_by_id.get(tag_person['id'], []):
+                    current_tags = person.get('tags') or []
+                    current_tags.append(tag_name)
+                    person['tags'] = current_tags
 
         return people_list
 
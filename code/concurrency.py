@@ -0,0 +1,62 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+
+def map_concurrently(function, items, max_workers=1):
+    """
+        Calls 'function' on every item using at most 'max_workers' threads.
+
+        Returns a list of (result, error) tuples in the same order as 'items'. An exception
+        raised for one item is captured as its error and does not affect the other items.
+    """
+    def _call(item):
+        try:
+            return function(item), None
+        except Exception as e:
+            return None, e
+
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [_call(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(_call, items))
+
+
+def imap_prefetched(function, items, max_workers=1):
+    """
+        Lazily calls 'function' on every item of the (possibly endless) iterator 'items', yielding the
+        results in order. Up to 'max_workers' calls run ahead of the consumer. When the consumer stops
+        early (or closes the generator), calls that have not started yet are cancelled.
+
+        Unlike map_concurrently, an exception raised by a call is raised to the consumer.
+    """
+    items = iter(items)
+    if max_workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(function, item) for item in islice(items, max_workers))
+        try:
+            while pending:
+                result = pending.popleft().result()
+                pending.extend(executor.submit(function, item) for item in islice(items, 1))
+                yield result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def start_in_background(function, *args, **kwargs):
+    """
+        Calls 'function' on a separate thread and returns a Future right away. The Future's result()
+        waits for the call to finish and returns its result, or raises its exception.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(function, *args, **kwargs)
+    # The thread is not stopped; it exits once the call is done
+    executor.shutdown(wait=False)
+    return future
@@ -11,9 +11,24 @@ DEFAULT_SAMPLE_INPUT_FILE_PATH = 'data_files/input/sample.csv'
 # Output paths
 DATA_OUTPUT_FILE_NAME = 'contacts_to_sync.csv'
 FAILED_SYNC_DATAFRAME_OUTPUT_FILE_NAME = 'failed_syncs.csv'
+# The journal of the remote sync, in the same output directory, from which an interrupted sync can be resumed (--resume)
+SYNC_JOURNAL_ENABLED = True
+SYNC_JOURNAL_FILE_NAME = 'sync_journal.jsonl'
+# The timings, counters and HTTP metrics of the run (and profile, with --profile), in the same output directory
+RUN_SUMMARY_FILE_NAME = 'run_summary.json'
+# The summary of a resumed sync (--resume), next to the run summary of the interrupted run that it completes
+RESUME_SUMMARY_FILE_NAME = 'run_summary.resume.json'
 
 LOG_FILE = 'logs'
 
+# Strategy 3 only: whether the contacts retrieved from Breeze should also be written to the data input file.
+# The file is written in the background and is not read back by the script.
+PERSIST_GENERATED_INPUT_FILE = True
+
+# Strategies 1 and 2: the data input file is read and processed in chunks of this many rows, so that memory use does
+# not grow with the size of the Breeze export. Set to None to read the whole file at once.
+CSV_CHUNK_SIZE = 5000
+
 """ 
     This config governs the header mappings between the sample file (respond.io) and the data file (breeze),
     e.g. "the column with header X of the sample file is made up of columns Y and Z of the data file". 
@@ -23,7 +38,9 @@ LOG_FILE = 'logs'
     
     Configuration:
         'breeze_headers' => the Breeze headers/columns from which to consolidate the respond.io column value
-        'lambda' => the function to call to add dynamically determined values in addition to 'breeze_headers'
+        'lambda' => the function to call to add dynamically determined values in addition to 'breeze_headers'.
+                    It is called once with the whole dataframe and must return a boolean dataframe with a column
+                    per value, flagging the rows to which each value applies (see BaseStrategy.dynamic_tags).
         'default' => the default value when no other value is found
         
         Example:
@@ -82,6 +99,9 @@ MALE = 'Male'
 
 # The values of this config MUST be formatted as follows
 # <Tag name>: '`<column-name>` <operator> `<value>`'
+# Supported operators: =, ==, !=, <, <=, >, >= and %. Criteria can be combined with AND/OR and grouped with
+# parentheses, e.g. "(`Age` >= `65` OR `Age` < `18`) AND `Gender` = `Female`". Empty cells never match.
+# The criteria are checked when the script starts.
 DYNAMIC_TAGS_CRITERIA = {
     LEGENDES: "`Age` >= `65`",
     MALE: "`Gender` = `Male`",
@@ -111,6 +131,42 @@ if FILTERED_EXPORT_ENABLED:
 GET_BY_REMOTE_FIELD_NAME = 'active'
 GET_BY_REMOTE_FIELD_VALUE = 'true'
 
+# When enabled, the contacts synced to Sleekflow (and respond.io) are recorded in a local snapshot, by breeze_id
+# (SLEEKFLOW_SYNC_SNAPSHOT_PATH, and SYNC_SNAPSHOT_PATH for respond.io). Later syncs then only compare and push the
+# contacts that changed since the snapshot, without retrieving the remote contacts. A full sync (retrieving and
+# comparing everything) is done when the snapshot is empty, when the last full sync is more than
+# FULL_SYNC_INTERVAL_DAYS days ago or when requested with --full.
+INCREMENTAL_SYNC_ENABLED = True
+SLEEKFLOW_SYNC_SNAPSHOT_PATH = 'data_files/sleekflow_sync_snapshot.sqlite3'
+SYNC_SNAPSHOT_PATH = 'data_files/sync_snapshot.sqlite3'
+FULL_SYNC_INTERVAL_DAYS = 7
+
+# The maximum number of respond.io contact pages that are retrieved at the same time
+RESPONDIO_PAGE_FETCH_CONCURRENCY = 5
+
+# The maximum number of respond.io contacts that are created/updated/deleted at the same time. The requests
+# of a single contact are always sent in order. All of them share the respond.io limit in RATE_LIMITS.
+RESPONDIO_WRITE_CONCURRENCY = 5
+
+# When enabled, a new respond.io contact's tags (up to MAX_UPDATEABLE_TAGS of them) are sent with the request that
+# creates it, instead of with a separate tags request afterwards. Disable it if the API stops accepting them there.
+RESPONDIO_CREATE_WITH_TAGS = True
+
+# Contacts are sent to Sleekflow in batches of at most SLEEKFLOW_BATCH_SIZE contacts and SLEEKFLOW_BATCH_MAX_BYTES
+# bytes (of JSON), of which at most SLEEKFLOW_UPLOAD_CONCURRENCY are sent at the same time. A batch that is rejected
+# because of its content is split in halves and retried, until the contacts that are at fault are found.
+SLEEKFLOW_BATCH_SIZE = 50
+SLEEKFLOW_BATCH_MAX_BYTES = 256 * 1024
+SLEEKFLOW_UPLOAD_CONCURRENCY = 4
+
+# The maximum number of Sleekflow contact pages that are requested ahead while the contacts are retrieved
+SLEEKFLOW_PAGE_FETCH_CONCURRENCY = 4
+
+# The maximum number of requests that the async engine (--engine async) has in flight at the same time, shared by the
+# Breeze and Sleekflow retrievals (within their own fetch concurrency) and the Sleekflow uploads (at most
+# SLEEKFLOW_UPLOAD_CONCURRENCY of them). The requests still obey RATE_LIMITS.
+ASYNC_ENGINE_CONCURRENCY = 16
+
 # 'field_id' => the respond.io field id of the column. This will be used when the data is
 #               mapped to the API structure.
 API_FIELD_MAPPINGS = {
@@ -138,6 +194,45 @@ API_FIELD_MAPPINGS = {
 }
 
 
+# The maximum number of Breeze tags whose people are retrieved at the same time.
+# Set to 1 to retrieve the tags one after another.
+BREEZE_TAG_FETCH_CONCURRENCY = 8
+
+# ----- HTTP CONFIGS -----
+
+# Every remote service gets its own pool of keep-alive connections.
+# 'timeout' => (<connect timeout>, <read timeout>) in seconds
+# 'pool_size' => the maximum number of connections kept alive to the service; room for every request to it that can be in
+#                flight at the same time, otherwise the connections of the extra requests are thrown away after every request
+HTTP_CLIENT_SETTINGS = {
+    # The people are retrieved while the tags are
+    'breeze': {'timeout': (5, 120), 'pool_size': BREEZE_TAG_FETCH_CONCURRENCY + 1},
+    'respondio': {'timeout': (5, 30), 'pool_size': RESPONDIO_PAGE_FETCH_CONCURRENCY + RESPONDIO_WRITE_CONCURRENCY},
+    'sleekflow': {'timeout': (5, 300), 'pool_size': SLEEKFLOW_PAGE_FETCH_CONCURRENCY + SLEEKFLOW_UPLOAD_CONCURRENCY},
+    'mailgun': {'timeout': (5, 60), 'pool_size': 1},
+}
+
+# Failed requests (connection errors, 429 and 5xx responses) are retried up to HTTP_MAX_RETRIES times,
+# waiting a random time of up to HTTP_BACKOFF_SECONDS * 2^<retry> seconds in between (capped at
+# HTTP_MAX_BACKOFF_SECONDS). A Retry-After header sent by the server takes precedence, however long it asks to wait.
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_SECONDS = 0.5
+HTTP_MAX_BACKOFF_SECONDS = 30
+# Rate limited (429) requests are retried up to this many times instead
+HTTP_MAX_RATE_LIMITED_RETRIES = 8
+
+# The client-side rate limit of every remote service, shared by all requests to that service.
+# 'requests_per_second' => the sustained request rate (None for no limit)
+# 'burst' => the number of requests that may be sent at once after an idle period
+# When a service responds with 429 the rate is halved (after waiting for its Retry-After time),
+# after which it gradually recovers to 'requests_per_second'.
+RATE_LIMITS = {
+    'breeze': {'requests_per_second': 20, 'burst': 10},
+    'respondio': {'requests_per_second': 25, 'burst': 5},
+    'sleekflow': {'requests_per_second': 10, 'burst': 5},
+}
+
+
 BREEZE_TO_CSV_HEADER_CONVERTERS = {
     'id': 'Breeze ID',
     'first_name': 'First Name',
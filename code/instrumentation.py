@@ -0,0 +1,181 @@
+"""
+    Lightweight instrumentation of a run: timed spans, counters and HTTP request metrics, which are kept in
+    memory (thread safe) and written as a JSON summary at the end of the run. Optionally, the run is
+    profiled with cProfile or tracemalloc as well.
+"""
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+# The upper bounds (in milliseconds) of the HTTP latency histogram buckets; slower requests go in a last bucket
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2500, 5000, 10000]
+PROFILE_TOP_ENTRIES = 25
+
+_DONE = object()
+
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_http = {}
+
+
+@contextmanager
+def span(name):
+    """
+        Times the code in a 'with span(<name>):' block. Every span name keeps its count and total and maximum duration.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            stats = _spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+
+def timed_iter(name, iterable):
+    """
+        Yields the items of 'iterable', timing every step of the iteration as a span; for lazy
+        iterables (e.g. a chunked file reader) that is where the work happens
+    """
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            item = next(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def record_http(service, method, status, seconds, bytes_sent, bytes_received):
+    """
+        Records a single HTTP request. 'status' is the status code, or the name of the error when no
+        response was received.
+    """
+    milliseconds = seconds * 1000
+    bucket = next((f'<={bound}ms' for bound in LATENCY_BUCKETS_MS if milliseconds <= bound),
+                  f'>{LATENCY_BUCKETS_MS[-1]}ms')
+
+    with _lock:
+        stats = _http.setdefault(service, {
+            'requests': 0,
+            'methods': {},
+            'status_codes': {},
+            'seconds': 0.0,
+            'max_seconds': 0.0,
+            'latency_histogram': {},
+            'bytes_sent': 0,
+            'bytes_received': 0,
+        })
+        stats['requests'] += 1
+        stats['methods'][method] = stats['methods'].get(method, 0) + 1
+        stats['status_codes'][str(status)] = stats['status_codes'].get(str(status), 0) + 1
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['latency_histogram'][bucket] = stats['latency_histogram'].get(bucket, 0) + 1
+        stats['bytes_sent'] += bytes_sent
+        stats['bytes_received'] += bytes_received
+
+
+def summary():
+    with _lock:
+        return {
+            'spans': {
+                name: {**stats, 'seconds': round(stats['seconds'], 3), 'max_seconds': round(stats['max_seconds'], 3)}
+                for name, stats in _spans.items()
+            },
+            'counters': dict(_counters),
+            'http': {
+                service: {
+                    **stats,
+                    'methods': dict(stats['methods']),
+                    'status_codes': dict(stats['status_codes']),
+                    'latency_histogram': dict(stats['latency_histogram']),
+                    'seconds': round(stats['seconds'], 3),
+                    'max_seconds': round(stats['max_seconds'], 3),
+                }
+                for service, stats in _http.items()
+            },
+        }
+
+
+def write_summary(path, details=None):
+    """
+        Writes the summary, together with 'details' (a dict), to 'path' as JSON
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(path, 'w') as summary_file:
+        json.dump({**(details or {}), **summary()}, summary_file, indent=4, default=str)
+    return path
+
+
+class Profiler:
+    """
+        Profiles the run with 'cprofile' (the time spent per function, in the main thread only) or 'tracemalloc'
+        (the memory allocated per line, in all threads). stop() writes the full profile to a directory (with the
+        suffix in its file name, if any) and returns the top entries.
+    """
+
+    MODES = ['none', 'cprofile', 'tracemalloc']
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.profile = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.mode == 'tracemalloc':
+            tracemalloc.start()
+
+    def stop(self, directory, suffix=''):
+        if self.mode == 'cprofile':
+            self.profile.disable()
+            path = os.path.join(directory, f'profile{suffix}.pstats')
+            self.profile.dump_stats(path)
+
+            stats = pstats.Stats(self.profile).sort_stats('cumulative')
+            top = []
+            for function in stats.fcn_list[:PROFILE_TOP_ENTRIES]:
+                _calls, calls, _total_time, cumulative_time, _callers = stats.stats[function]
+                top.append({'function': pstats.func_std_string(function), 'calls': calls,
+                            'cumulative_seconds': round(cumulative_time, 3)})
+            return {'mode': self.mode, 'path': path, 'top': top}
+
+        if self.mode == 'tracemalloc':
+            snapshot = tracemalloc.take_snapshot()
+            current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            statistics = snapshot.statistics('lineno')
+            path = os.path.join(directory, f'tracemalloc{suffix}.txt')
+            with open(path, 'w') as profile_file:
+                profile_file.writelines(f'{statistic}\n' for statistic in statistics)
+
+            return {
+                'mode': self.mode,
+                'path': path,
+                'current_bytes': current_bytes,
+                'peak_bytes': peak_bytes,
+                'top': [str(statistic) for statistic in statistics[:PROFILE_TOP_ENTRIES]],
+            }
+
+        return None
@@ -0,0 +1,135 @@
+import glob
+import json
+import os
+import threading
+
+
+class SyncJournal:
+    """
+        An append-only JSONL log of a sync run: the planned changes, a line for every batch of changes
+        that was uploaded and a last line once the sync finished. A sync that was interrupted can be
+        resumed from its journal without retrieving or comparing anything again. When it was interrupted
+        before its plan was complete (the async engine uploads while it compares), the contacts are compared
+        again instead, but the changes that were uploaded are not sent again.
+
+        Every line is a JSON object with an 'event':
+            {'event': 'plan', 'change': <change>, 'record': [<contact>, <payload>]}    --- a planned change
+            {'event': 'ignored', 'failure': <failed record>}                            --- a contact that was not synced
+            {'event': 'planned'}                                                        --- the plan is complete
+            {'event': 'resumed'}                                                        --- the plan was cut off and starts over
+            {'event': 'uploaded', 'change': <change>, 'keys': [<key>, ...], 'failures': [<failed record>, ...]}
+            {'event': 'finished'}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def find_interrupted(cls, output_dir, file_name):
+        """
+            Returns the journal of the last sync if it was interrupted after (part of) its plan was recorded,
+            otherwise None
+        """
+        paths = glob.glob(os.path.join(output_dir, 'sync_*', file_name))
+        if not paths:
+            return None
+
+        journal = cls(max(paths, key=os.path.getmtime))
+        events = {entry['event'] for entry in journal._entries()}
+        if events and 'finished' not in events:
+            return journal
+        return None
+
+    def is_plan_complete(self):
+        complete = False
+        for entry in self._entries():
+            if entry['event'] in ('planned', 'resumed'):
+                complete = entry['event'] == 'planned'
+        return complete
+
+    def record_plan(self, changes, ignored_failures):
+        """
+            'changes' format: {<change>: [(<contact>, <payload>), ...], ...}
+        """
+        for change, records in changes.items():
+            self.record_planned_changes(change, records)
+        self.record_plan_complete(ignored_failures)
+
+    def record_planned_changes(self, change, records):
+        """
+            Records part of the plan; the plan is only complete after record_plan_complete
+        """
+        self._write([{'event': 'plan', 'change': change, 'record': list(record)} for record in records])
+
+    def record_plan_complete(self, ignored_failures):
+        entries = [{'event': 'ignored', 'failure': failure} for failure in ignored_failures]
+        entries.append({'event': 'planned'})
+        self._write(entries)
+
+    def record_resumed(self):
+        """
+            Discards the plan that was cut off; the changes that were uploaded stay uploaded
+        """
+        self._write([{'event': 'resumed'}])
+
+    def record_uploaded(self, change, keys, failures):
+        self._write([{'event': 'uploaded', 'change': change, 'keys': list(keys), 'failures': failures}])
+
+    def record_finished(self):
+        self._write([{'event': 'finished'}])
+        self.close()
+
+    def read(self):
+        """
+            Returns the planned changes ({<change>: [(<contact>, <payload>), ...]}), the ignored failures,
+            the keys of the uploaded changes ({<change>: {<key>, ...}}) and the failures of the uploaded
+            changes ({<change>: [<failed record>, ...]}). They're all empty when the journal wasn't written yet.
+        """
+        changes = {}
+        ignored_failures = []
+        uploaded_keys = {}
+        failures = {}
+
+        for entry in self._entries():
+            if entry['event'] == 'plan':
+                changes.setdefault(entry['change'], []).append(tuple(entry['record']))
+            elif entry['event'] == 'resumed':
+                changes = {}
+            elif entry['event'] == 'ignored':
+                ignored_failures.append(entry['failure'])
+            elif entry['event'] == 'uploaded':
+                uploaded_keys.setdefault(entry['change'], set()).update(entry['keys'])
+                failures.setdefault(entry['change'], []).extend(entry['failures'])
+
+        return changes, ignored_failures, uploaded_keys, failures
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _write(self, entries):
+        lines = ''.join(json.dumps(entry, default=str) + '\n' for entry in entries)
+        with self.lock:
+            if self.file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.file = open(self.path, 'a')
+            self.file.write(lines)
+            # Flushed right away, so that the lines survive the process being killed
+            self.file.flush()
+
+    def _entries(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # The last line is cut off when the process died while writing it
+                    break
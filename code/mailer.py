@@ -1,5 +1,5 @@
-import requests
 from configs import MAILGUN_API_KEY, MAILGUN_URL
+from transport import get_client
 from logger import log
 
 
@@ -15,7 +15,7 @@ def mail(from_address, recipients=[], subject=None, body=None, attachment_info=N
     if attachment_info:
         files = [("attachment", (attachment_info['name'], open(attachment_info['path'], 'rb').read(), 'text/csv'))]
 
-    res = requests.post(
+    res = get_client('mailgun').post(
         f'{MAILGUN_URL}messages',
         data=data,
         files=files,
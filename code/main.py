@@ -1,12 +1,19 @@
 import argparse
+import time
+
+from datetime import datetime
 from configs import (
     DEFAULT_STRATEGY,
     DEFAULT_DATA_INPUT_FILE_PATH,
     DEFAULT_SAMPLE_INPUT_FILE_PATH,
     DEFAULT_EXPORT_CSV,
     DRY_RUN,
+    RESUME_SUMMARY_FILE_NAME,
+    RUN_SUMMARY_FILE_NAME,
 )
+from instrumentation import Profiler, write_summary
 from logger import log
+from ratelimit import log_metrics, metrics
 
 # Maps the specified strategy number to file
 STRATEGIES = {
@@ -15,6 +22,11 @@ STRATEGIES = {
     '3': 'StrategyThree',
 }
 
+# The strategies that can run with the async engine, by strategy number
+ASYNC_STRATEGIES = {
+    '3': 'AsyncStrategyThree',
+}
+
 log('EXECUTING SCRIPT...')
 
 
@@ -50,8 +62,43 @@ def handle_arguments():
         choices=['yes', 'no'],
         help='Specifies whether this attempt is a dry run',
     )
+    parser.add_argument(
+        '--full',
+        default='no',
+        choices=['yes', 'no'],
+        help='Specifies whether all remote contacts should be compared, instead of only the ones '
+             'that changed since the last sync',
+    )
+    parser.add_argument(
+        '--engine',
+        default='sync',
+        choices=['sync', 'async'],
+        help='Specifies whether the strategy runs synchronously or with the asyncio engine, which sends requests '
+             'concurrently (only strategy 3)',
+    )
 
-    return parser.parse_args()
+    parser.add_argument(
+        '--resume',
+        default='no',
+        choices=['yes', 'no'],
+        help='Specifies whether the last sync, if it was interrupted, should be finished from its journal '
+             'instead of running a new sync (only strategies 2 and 3)',
+    )
+
+    parser.add_argument(
+        '--profile',
+        default='none',
+        choices=Profiler.MODES,
+        help='Specifies whether the run is profiled with cProfile (time per function) or tracemalloc (memory per line). '
+             'The profile is written to the output directory, next to the run summary',
+    )
+
+    arguments = parser.parse_args()
+    if arguments.engine == 'async' and arguments.strategy not in ASYNC_STRATEGIES:
+        parser.error(f'strategy {arguments.strategy} cannot run with the async engine')
+    if arguments.resume == 'yes' and (arguments.strategy == '1' or arguments.dry == 'yes'):
+        parser.error('only a (non dry run) sync of strategy 2 or 3 can be resumed')
+    return arguments
 
 
 args = handle_arguments()
@@ -72,12 +119,54 @@ if args.export == 'yes':
 else:
     should_export = False
 
+# Not applicable to Strategy 1
+full_sync = args.full == 'yes'
+
 # Import appropriate strategy class
-exec(f'from strategies import {strategy_class}')
+if args.engine == 'async':
+    strategy_class = ASYNC_STRATEGIES[args.strategy]
+    exec(f'from async_engine import {strategy_class}')
+else:
+    exec(f'from strategies import {strategy_class}')
+
+started_at = datetime.now()
+start = time.perf_counter()
+profiler = Profiler(args.profile)
+profiler.start()
 
-print(f'Executing {strategy_class}')
-# Execute strategy
-errors = eval(f'{strategy_class}.execute(sample_file, datafile=data_file, export=should_export, dry_run=dry_run)')
+try:
+    if args.resume == 'yes':
+        print(f'Resuming {strategy_class}')
+        if eval(f'{strategy_class}.resume(sample_file, datafile=data_file, export=should_export)'):
+            exec(f'{strategy_class}.notify_results(None)')
+        else:
+            print('There is no interrupted sync to resume')
+    else:
+        print(f'Executing {strategy_class}')
+        # Execute strategy
+        errors = eval(f'{strategy_class}.execute(sample_file, datafile=data_file, export=should_export, dry_run=dry_run, full_sync=full_sync)')
 
-# Notify results
-exec(f'{strategy_class}.notify_results(errors)')
+        # Notify results
+        exec(f'{strategy_class}.notify_results(errors)')
+finally:
+    if args.resume == 'yes' and not eval(f'{strategy_class}.export_dir'):
+        # Nothing was resumed, so there is nothing to summarize (and no output directory to summarize it in)
+        log('There was no sync to resume, no run summary written')
+    else:
+        # Also written when the run fails (or exits after a dry run), since that is when it's needed most.
+        # A resumed sync is summarized next to the summary of the run it completes, instead of replacing it.
+        if args.resume == 'yes':
+            summary_file_name, profile_suffix = RESUME_SUMMARY_FILE_NAME, '.resume'
+        else:
+            summary_file_name, profile_suffix = RUN_SUMMARY_FILE_NAME, ''
+        output_dir = f"data_files/output/{eval(f'{strategy_class}.get_export_dir()')}"
+        summary_path = write_summary(f'{output_dir}/{summary_file_name}', {
+            'strategy': strategy_class,
+            'arguments': vars(args),
+            'started_at': started_at.isoformat(),
+            'seconds': round(time.perf_counter() - start, 3),
+            'profile': profiler.stop(output_dir, profile_suffix),
+            'rate_limiters': metrics(),
+        })
+        log(f'Run summary written to {summary_path}')
+    log_metrics()
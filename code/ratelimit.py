@@ -0,0 +1,114 @@
+import threading
+import time
+
+from configs import RATE_LIMITS
+from logger import log
+
+
+class TokenBucket:
+    """
+        A thread-safe token bucket: on average at most 'requests_per_second' calls to acquire() return
+        per second, with bursts of up to 'burst' calls. A 429 response should be reported with throttle(),
+        which pauses every caller (for the Retry-After time when known) and halves the rate. The rate then
+        recovers gradually with every successful request. A bucket without a rate never waits.
+    """
+
+    RECOVERY_STEP = 0.02  # Fraction of the configured rate regained per successful request
+    MIN_RATE_FRACTION = 0.1  # The rate never drops below this fraction of the configured rate
+
+    def __init__(self, name, requests_per_second=None, burst=1):
+        self.name = name
+        self.max_rate = requests_per_second
+        self.rate = requests_per_second
+        self.burst = max(burst, 1)
+
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.throttle_events = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        """
+            Blocks until the caller may send a request and returns the number of seconds waited
+        """
+        with self.lock:
+            self.requests += 1
+            if not self.rate:
+                return 0
+
+            now = time.monotonic()
+            self._refill(now)
+            # Tokens may go negative: every caller reserves the next free slot and sleeps until then
+            self.tokens -= 1
+            wait = max(self.updated_at - now, 0) + (-self.tokens / self.rate if self.tokens < 0 else 0)
+            self.throttled_seconds += wait
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def throttle(self, retry_after=None):
+        with self.lock:
+            self.throttle_events += 1
+            if not self.rate:
+                return
+
+            now = time.monotonic()
+            self._refill(now)
+            if now >= self.updated_at:
+                # Requests that were already in flight when the pause started don't slow it down further
+                self.rate = max(self.rate / 2, self.max_rate * self.MIN_RATE_FRACTION)
+
+            pause = retry_after if retry_after is not None else 1 / self.rate
+            # No tokens are earned while paused, so requests resume at the reduced rate
+            self.tokens = min(self.tokens, 0)
+            self.updated_at = max(self.updated_at, now + pause)
+
+        log(f'{self.name} rate limited: pausing {pause:.2f}s, continuing at {self.rate:.2f} requests per second')
+
+    def succeed(self):
+        with self.lock:
+            if self.rate and self.rate < self.max_rate:
+                self.rate = min(self.rate + self.max_rate * self.RECOVERY_STEP, self.max_rate)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttle_events': self.throttle_events,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+                'current_requests_per_second': self.rate,
+            }
+
+    def _refill(self, now):
+        if now > self.updated_at:
+            self.tokens = min(self.tokens + (now - self.updated_at) * self.rate, self.burst)
+            self.updated_at = now
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(service):
+    """
+        Returns the shared TokenBucket of a service configured in RATE_LIMITS
+    """
+    with _limiters_lock:
+        if service not in _limiters:
+            _limiters[service] = TokenBucket(service, **RATE_LIMITS.get(service, {}))
+        return _limiters[service]
+
+
+def metrics():
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {service: limiter.metrics() for service, limiter in limiters.items()}
+
+
+def log_metrics():
+    for service, service_metrics in metrics().items():
+        log(f'{service} rate limiter: {service_metrics}')
@@ -1,13 +1,33 @@
-import requests
 import json
+import math
+import threading
+
+from datetime import datetime, timedelta
 from configs import (
     RESPONDIO_API_URL,
     RESPONDIO_API_TOKEN,
     FILTERED_EXPORT_ENABLED,
     GET_BY_REMOTE_FIELD_NAME,
     GET_BY_REMOTE_FIELD_VALUE,
+    RESPONDIO_PAGE_FETCH_CONCURRENCY,
+    RESPONDIO_WRITE_CONCURRENCY,
+    RESPONDIO_CREATE_WITH_TAGS,
+    INCREMENTAL_SYNC_ENABLED,
+    SYNC_SNAPSHOT_PATH,
+    FULL_SYNC_INTERVAL_DAYS,
+    API_FIELD_MAPPINGS,
+)
+from concurrency import map_concurrently
+from snapshot import SyncSnapshot
+from utils import (
+    compare_mapped_contacts,
+    contact_fingerprint,
+    index_contacts_by_breeze_id,
+    map_to_respondio_api_fields,
+    output_dry_run_results,
 )
-from utils import compare_contacts, output_dry_run_results
+from transport import get_client
+from instrumentation import increment, span
 from logger import log
 
 
@@ -15,8 +35,32 @@ def _get_stat(planned, failed):
     return f'{len(failed)}/{len(planned)}'
 
 
+def _partition(tags, size):
+    return [tags[i:i + size] for i in range(0, len(tags), size)]
+
+
+def _requests_count(tags, size):
+    return math.ceil(len(tags) / size)
+
+
+def plan_tag_operations(tag_changes, max_tags):
+    """
+        Merges the 'tags' entries of an update, e.g. [{'add': [...], 'remove': [...]}, ...], into the fewest
+        (<method>, <tags partition>) requests, with at most 'max_tags' tags each. Duplicate tags are sent once.
+    """
+    tags_to_add = list(dict.fromkeys(tag for tag_change in tag_changes for tag in tag_change.get('add', [])))
+    tags_to_remove = list(dict.fromkeys(tag for tag_change in tag_changes for tag in tag_change.get('remove', [])))
+
+    return (
+        [('add', partition) for partition in _partition(tags_to_add, max_tags)] +
+        [('remove', partition) for partition in _partition(tags_to_remove, max_tags)]
+    )
+
+
 class RespondIORequests:
 
+    client = get_client('respondio')
+
     @classmethod
     def headers(cls):
         return {
@@ -30,7 +74,7 @@ class RespondIORequests:
             base_url=RESPONDIO_API_URL,
             resource_endpoint=resource
         )
-        return requests.get(url, headers=cls.headers())
+        return cls.client.get(url, headers=cls.headers())
 
     @classmethod
     def put(cls, resource, data):
@@ -38,7 +82,7 @@ class RespondIORequests:
             base_url=RESPONDIO_API_URL,
             resource_endpoint=resource
         )
-        return requests.put(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.put(url, data=json.dumps(data), headers=cls.headers())
 
     @classmethod
     def post(cls, resource, data):
@@ -46,7 +90,7 @@ class RespondIORequests:
             base_url=RESPONDIO_API_URL,
             resource_endpoint=resource
         )
-        return requests.post(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.post(url, data=json.dumps(data), headers=cls.headers())
 
     @classmethod
     def delete(cls, resource, data):
@@ -54,11 +98,20 @@ class RespondIORequests:
             base_url=RESPONDIO_API_URL,
             resource_endpoint=resource
         )
-        return requests.delete(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.delete(url, data=json.dumps(data), headers=cls.headers())
 
 
 class RespondIO(RespondIORequests):
     dry_run = False
+    full_sync = False
+
+    # The remote ids of the contacts created during the last sync, by breeze_id
+    created_contact_ids = {}
+
+    # The number of tag requests that the tag planning saved during the last sync, counting only the requests
+    # that were sent successfully
+    tag_requests_saved = 0
+    tag_requests_saved_lock = threading.Lock()
 
     FAILED = 'failed'
     SUCCESS = 'success'
@@ -70,48 +123,82 @@ class RespondIO(RespondIORequests):
     def set_dry_run(cls, dry_run):
         cls.dry_run = dry_run
 
+    @classmethod
+    def set_full_sync(cls, full_sync):
+        cls.full_sync = full_sync
+
     @classmethod
     def sync_to_respondio(cls, breeze_contacts: []):
+        """
+            'breeze_contacts' can be any iterable of contacts (e.g. a generator); it is only iterated once
+        """
         print('sync_to_respondio...')
+        snapshot = SyncSnapshot(SYNC_SNAPSHOT_PATH) if INCREMENTAL_SYNC_ENABLED else None
         try:
-            current_query_page = 1
-            respondio_contacts_data = []
-
-            log(f'{cls.LOGGER_ID} sync_to_respondio: retrieving contacts')
-
-            while True:
-                log(f'{cls.LOGGER_ID} sync_to_respondio: retrieving page data: {current_query_page}')
-                contacts_data, _metadata = cls.get_contacts(current_query_page)
-                if not any(contacts_data):
-                    break
-                respondio_contacts_data.extend(contacts_data)
-                current_query_page += 1
+            mapped_contacts = map_to_respondio_api_fields(breeze_contacts)
+
+            full_sync = snapshot is None or cls._is_full_sync_due(snapshot)
+            if full_sync:
+                log(f'{cls.LOGGER_ID} sync_to_respondio: retrieving contacts')
+                contacts_to_compare = mapped_contacts
+                with span('respondio.get_contacts'):
+                    respondio_contacts_data = cls.get_all_contacts()
+            else:
+                log(f'{cls.LOGGER_ID} sync_to_respondio: determining changes since the last sync')
+                with span('respondio.get_contacts'):
+                    contacts_to_compare, respondio_contacts_data = cls._changes_since_snapshot(
+                        mapped_contacts, snapshot.records()
+                    )
+                log(f'{cls.LOGGER_ID} sync_to_respondio: {len(contacts_to_compare)}/{len(mapped_contacts)} '
+                    f'contacts changed since the last sync')
+
+            # Recorded before comparing and writing, since both modify the contacts
+            planned_records = {contact['breeze_id']: cls._snapshot_record(contact) for contact in contacts_to_compare}
+            remote_records = {
+                breeze_id: cls._snapshot_record(cls._content_from_remote_contact(remote_contact), remote_contact['id'])
+                for breeze_id, remote_contact in index_contacts_by_breeze_id(respondio_contacts_data)[0].items()
+            }
 
             log(f'{cls.LOGGER_ID} sync_to_respondio: comparing contacts')
-            creates, updates, deletes = compare_contacts(
-                breeze_contacts=breeze_contacts,
-                respondio_contacts=respondio_contacts_data
-            )
+            with span('respondio.compare'):
+                creates, updates, deletes = compare_mapped_contacts(
+                    mapped_contacts=contacts_to_compare,
+                    respondio_contacts=respondio_contacts_data
+                )
+            increment('respondio.creates', len(creates))
+            increment('respondio.updates', len(updates))
+            increment('respondio.deletes', len(deletes))
 
             if cls.dry_run:
                 output_dry_run_results(creates=creates, updates=updates, deletes=deletes)
 
-            # Handle remote creates
-            log(f'{cls.LOGGER_ID} sync_to_respondio: handling "create" contacts')
-            failed_creates = cls.create_remote_contacts(creates)
-
-            # Handle remote updates
-            log(f'{cls.LOGGER_ID} sync_to_respondio: handling "update" contacts')
-            failed_updates = cls.update_remote_contacts(updates)
-
-            # Handle remote deletes
-            failed_deletes = []
-            if not FILTERED_EXPORT_ENABLED:
-                # A remote delete is not permitted if a filtered export is being done,
-                # because there's no way of knowing who should not exist on repond.io
-                # with an incomplete list
-                log(f'{cls.LOGGER_ID} sync_to_respondio: handling "delete" contacts')
-                failed_deletes = cls.delete_remote_contacts(deletes)
+            cls.tag_requests_saved = 0
+            with span('respondio.write'):
+                # Handle remote creates
+                log(f'{cls.LOGGER_ID} sync_to_respondio: handling "create" contacts')
+                failed_creates = cls.create_remote_contacts(creates)
+
+                # Handle remote updates
+                log(f'{cls.LOGGER_ID} sync_to_respondio: handling "update" contacts')
+                failed_updates = cls.update_remote_contacts(updates)
+
+                # Handle remote deletes
+                failed_deletes = []
+                if not FILTERED_EXPORT_ENABLED:
+                    # A remote delete is not permitted if a filtered export is being done,
+                    # because there's no way of knowing who should not exist on repond.io
+                    # with an incomplete list
+                    log(f'{cls.LOGGER_ID} sync_to_respondio: handling "delete" contacts')
+                    failed_deletes = cls.delete_remote_contacts(deletes)
+            log(f'{cls.LOGGER_ID} sync_to_respondio: {cls.tag_requests_saved} tag requests saved')
+
+            if snapshot is not None:
+                deletes_done = not FILTERED_EXPORT_ENABLED
+                cls._update_snapshot(
+                    snapshot, full_sync, planned_records, remote_records, deletes if deletes_done else [],
+                    failed_creates['contact_creates'] + failed_creates['contacts_ignored'] +
+                    failed_creates['tags_updates'] + failed_updates + failed_deletes,
+                )
 
             return {
                 'status': cls.FAILED if any(failed_creates) or any(failed_updates) or any(
@@ -131,11 +218,164 @@ class RespondIO(RespondIORequests):
                         failed_updates + failed_creates['tags_updates'],
                     ),
                     'deletes': _get_stat(deletes, failed_deletes),
+                    'tag_requests_saved': cls.tag_requests_saved,
                 },
             }
         except Exception as e:
             print(f'sync_to_respondio failed')
             raise e
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    @classmethod
+    def _is_full_sync_due(cls, snapshot):
+        if cls.full_sync or snapshot.is_empty():
+            return True
+
+        last_full_sync = snapshot.last_full_sync()
+        return last_full_sync is None or datetime.now() - last_full_sync >= timedelta(days=FULL_SYNC_INTERVAL_DAYS)
+
+    @classmethod
+    def _snapshot_record(cls, content, remote_id=None):
+        content = {key: list(value) if key == 'tags' else value for key, value in content.items()}
+        return {'remote_id': remote_id, 'content': content, 'content_hash': contact_fingerprint(content)}
+
+    @classmethod
+    def _content_from_remote_contact(cls, remote_contact):
+        # The same format as the contacts returned by map_to_respondio_api_fields
+        custom_fields = remote_contact.get('custom_fields') or {}
+        content = {
+            api_field['field_id']: custom_fields.get(api_field['field_id'], '')
+            for api_field in API_FIELD_MAPPINGS.values()
+            if api_field['field_id'] != 'tags'
+        }
+        content['tags'] = list(remote_contact.get('tags') or [])
+        return content
+
+    @classmethod
+    def _remote_contact_from_record(cls, record):
+        # The same format as the contacts returned by get_contacts
+        content = record['content']
+        return {
+            'id': record['remote_id'],
+            'custom_fields': {key: value for key, value in content.items() if key != 'tags'},
+            'tags': list(content.get('tags', [])),
+        }
+
+    @classmethod
+    def _changes_since_snapshot(cls, mapped_contacts, records):
+        """
+            Returns the contacts that are new or changed since the snapshot, together with the snapshot's
+            version of the remote contacts they should be compared with. Contacts that are in the snapshot
+            but no longer in Breeze are included as remote contacts, so that they will be deleted.
+        """
+        changed_contacts = []
+        breeze_ids = set()
+
+        for contact in mapped_contacts:
+            breeze_ids.add(contact['breeze_id'])
+            record = records.get(contact['breeze_id'])
+            if record is None or record['content_hash'] != contact_fingerprint(contact):
+                changed_contacts.append(contact)
+
+        remote_contacts = [
+            cls._remote_contact_from_record(records[contact['breeze_id']])
+            for contact in changed_contacts
+            if contact['breeze_id'] in records
+        ]
+        remote_contacts.extend(
+            cls._remote_contact_from_record(record)
+            for breeze_id, record in records.items()
+            if breeze_id not in breeze_ids
+        )
+
+        return changed_contacts, remote_contacts
+
+    @classmethod
+    def _update_snapshot(cls, snapshot, full_sync, planned_records, remote_records, deletes, failures):
+        """
+            Records the remote state after the sync: the planned content for contacts that synced
+            successfully and the previous remote content for contacts that failed, so that they are
+            compared again next time.
+        """
+        failed_breeze_ids = {
+            str(failure['contact'].get('breeze_id'))
+            for failure in failures
+            if failure.get('contact')
+        }
+        deleted_breeze_ids = {
+            str(delete_contact['breeze_id'])
+            for delete_contact in deletes
+            if str(delete_contact['breeze_id']) not in failed_breeze_ids
+        }
+
+        records = {}
+        for breeze_id, planned_record in planned_records.items():
+            remote_record = remote_records.get(breeze_id)
+            created_id = cls.created_contact_ids.get(breeze_id)
+
+            if breeze_id in failed_breeze_ids:
+                if remote_record:
+                    records[breeze_id] = remote_record
+                elif created_id:
+                    # The contact was created, but its tags could not be added
+                    records[breeze_id] = cls._snapshot_record({**planned_record['content'], 'tags': []}, created_id)
+                continue
+
+            remote_id = remote_record['remote_id'] if remote_record else created_id
+            if remote_id is not None:
+                records[breeze_id] = {**planned_record, 'remote_id': remote_id}
+
+        # Remote contacts that should have been deleted, but weren't, are kept so that it is tried again
+        for breeze_id, remote_record in remote_records.items():
+            if breeze_id not in planned_records and breeze_id not in deleted_breeze_ids:
+                records[breeze_id] = remote_record
+
+        if full_sync:
+            snapshot.replace_all(records, datetime.now())
+        else:
+            snapshot.update(records, deleted_breeze_ids)
+        log(f'{cls.LOGGER_ID} sync_to_respondio: recorded {len(records)} contacts in the sync snapshot')
+
+    @classmethod
+    def get_all_contacts(cls):
+        """
+            The first page's 'meta' tells how many pages there are, after which the remaining pages are
+            retrieved concurrently and merged in page order. Pages are then requested one at a time until
+            an empty page is found, in case contacts were added while paging.
+        """
+        log(f'{cls.LOGGER_ID} get_all_contacts: retrieving page data: 1')
+        contacts_data, metadata = cls.get_contacts(1)
+        if not any(contacts_data or []):
+            return []
+
+        all_contacts = list(contacts_data)
+        last_page = (metadata or {}).get('last_page') or 1
+
+        if last_page > 1:
+            pages = list(range(2, last_page + 1))
+            log(f'{cls.LOGGER_ID} get_all_contacts: retrieving page data: 2-{last_page}')
+            pages_data = map_concurrently(cls.get_contacts, pages, max_workers=RESPONDIO_PAGE_FETCH_CONCURRENCY)
+
+            for page, (page_data, error) in zip(pages, pages_data):
+                if error is not None:
+                    log(f'{cls.LOGGER_ID} get_all_contacts: retrieving page {page} failed: {error}')
+                    raise error
+
+                contacts_data, _metadata = page_data
+                all_contacts.extend(contacts_data or [])
+
+        current_query_page = last_page + 1
+        while True:
+            log(f'{cls.LOGGER_ID} get_all_contacts: retrieving page data: {current_query_page}')
+            contacts_data, _metadata = cls.get_contacts(current_query_page)
+            if not any(contacts_data or []):
+                break
+            all_contacts.extend(contacts_data)
+            current_query_page += 1
+
+        return all_contacts
 
     @classmethod
     def get_contacts(cls, page):
@@ -148,50 +388,82 @@ class RespondIO(RespondIORequests):
         else:
             raise Exception("get_contacts failed - I'm quitting!")
 
+    @classmethod
+    def _record_tag_requests_saved(cls, saved):
+        # Called from the write threads
+        if saved:
+            with cls.tag_requests_saved_lock:
+                cls.tag_requests_saved += saved
+            increment('respondio.tag_requests_saved', saved)
+
     @classmethod
     def create_remote_contacts(cls, creates):
         failed_creates = []
         failed_tag_updates = []
         ignored_creates = []
 
+        failures = {
+            'contact_creates': failed_creates,
+            'tags_updates': failed_tag_updates,
+            'contacts_ignored': ignored_creates,
+        }
+
+        cls.created_contact_ids = {}
         print('Creating contacts...')
-        for contact_to_create in creates:
-            if not contact_to_create['phone']:
-                ignored_creates.append(
-                    cls._failed_response(
-                        contact_to_create, None, message='No phone number!')
-                )
+        results = map_concurrently(cls._create_remote_contact, creates, max_workers=RESPONDIO_WRITE_CONCURRENCY)
+        for contact_to_create, (result, error) in zip(creates, results):
+            if error is not None:
+                failed_creates.append(cls._failed_response(contact_to_create, None, message=str(error)))
                 continue
 
-            tags = None
-            if 'tags' in contact_to_create:
-                tags = contact_to_create.pop('tags')
+            failure_type, failure = result
+            if failure_type:
+                failures[failure_type].append(failure)
 
-            payload = cls.parse_to_respondio_payload(custom_fields_data=contact_to_create)
-            response = cls.post('contact/', payload)
+        return failures
 
-            if response.status_code != 200:
-                # Check is contact already exists
-                # If so, "delete" the contact on respondio so that the next sync will create him/her
+    @classmethod
+    def _create_remote_contact(cls, contact_to_create):
+        """
+            Creates a single contact, with as many of its tags as the create request allows, and then adds
+            the rest of its tags. Returns a (<failure type>, <failed response>)
+            tuple, where the failure type is one of the keys returned by create_remote_contacts.
+        """
+        if not contact_to_create['phone']:
+            return 'contacts_ignored', cls._failed_response(contact_to_create, None, message='No phone number!')
 
-                failed_creates.append(cls._failed_response(contact_to_create, response))
-                continue
+        tags = None
+        if 'tags' in contact_to_create:
+            tags = contact_to_create.pop('tags')
 
-            new_contact_data = json.loads(response.content).get('data', {})
-            new_contact_id = new_contact_data.get('id')
+        tags_to_create = []
+        if tags and RESPONDIO_CREATE_WITH_TAGS:
+            tags_to_create, tags = tags[:cls.MAX_UPDATEABLE_TAGS], tags[cls.MAX_UPDATEABLE_TAGS:]
 
-            if new_contact_id and tags:
-                success, response = cls._update_tags('add', new_contact_id, tags)
+        payload = cls.parse_to_respondio_payload(custom_fields_data=contact_to_create, tags=tags_to_create)
+        response = cls.post('contact/', payload)
 
-                if not success:
-                    failed_tag_updates.append(cls._failed_response(contact_to_create, response))
-                    continue
+        if response.status_code != 200:
+            # Check is contact already exists
+            # If so, "delete" the contact on respondio so that the next sync will create him/her
+            return 'contact_creates', cls._failed_response(contact_to_create, response)
 
-        return {
-            'contact_creates': failed_creates,
-            'tags_updates': failed_tag_updates,
-            'contacts_ignored': ignored_creates,
-        }
+        if tags_to_create:
+            # Without them in the create request, they would have taken a tags request of their own
+            cls._record_tag_requests_saved(1)
+
+        new_contact_data = json.loads(response.content).get('data', {})
+        new_contact_id = new_contact_data.get('id')
+        if new_contact_id:
+            cls.created_contact_ids[str(contact_to_create['breeze_id'])] = new_contact_id
+
+        if new_contact_id and tags:
+            success, response = cls._update_tags('add', new_contact_id, tags)
+
+            if not success:
+                return 'tags_updates', cls._failed_response(contact_to_create, response)
+
+        return None, None
 
     @classmethod
     def update_remote_contacts(cls, updates):
@@ -208,44 +480,60 @@ class RespondIO(RespondIORequests):
         """
         failed_updates = []
         print('Updating contacts...')
-        for contact_to_update in updates:
-            if 'phone' in contact_to_update.get('custom_fields', {}).keys() and not contact_to_update['custom_fields']['phone']:
-                failed_updates.append(
-                    cls._failed_response(
-                        contact_to_update, None, message='Invalid phone number!')
-                )
-                contact_to_update['custom_fields'].pop('phone')
+        results = map_concurrently(cls._update_remote_contact, updates, max_workers=RESPONDIO_WRITE_CONCURRENCY)
+        for contact_to_update, (contact_failures, error) in zip(updates, results):
+            if error is not None:
+                failed_updates.append(cls._failed_response(contact_to_update, None, message=str(error)))
+                continue
 
-            contact_id = contact_to_update['id']
+            failed_updates.extend(contact_failures)
 
-            if contact_to_update.get('custom_fields'):
-                parsed_custom_fields_data = cls.parse_to_respondio_payload(
-                    custom_fields_data=contact_to_update['custom_fields']
-                )
-                response = cls.put(f"contact/{contact_id}", parsed_custom_fields_data)
+        return failed_updates
 
-                if response.status_code != 200:
-                    failed_updates.append(cls._failed_response(contact_to_update, response))
-                    continue
+    @classmethod
+    def _update_remote_contact(cls, contact_to_update):
+        """
+            Updates the custom fields and then the tags of a single contact. Returns the list of
+            failed responses for the contact.
+        """
+        failed_updates = []
 
-            # Tags updates must be handled separately
-            if contact_to_update.get('tags'):
-                tags_to_add = []
-                tags_to_remove = []
+        if 'phone' in contact_to_update.get('custom_fields', {}).keys() and not contact_to_update['custom_fields']['phone']:
+            failed_updates.append(
+                cls._failed_response(
+                    contact_to_update, None, message='Invalid phone number!')
+            )
+            contact_to_update['custom_fields'].pop('phone')
 
-                for tag in contact_to_update['tags']:
-                    tags_to_add.extend(tag.get('add', []))
-                    tags_to_remove.extend(tag.get('remove', []))
+        contact_id = contact_to_update['id']
 
-                success, response = cls._update_tags('add', contact_id, tags_to_add)
-                if not success:
-                    failed_updates.append(cls._failed_response(contact_to_update, response))
-                    continue
+        if contact_to_update.get('custom_fields'):
+            parsed_custom_fields_data = cls.parse_to_respondio_payload(
+                custom_fields_data=contact_to_update['custom_fields']
+            )
+            response = cls.put(f"contact/{contact_id}", parsed_custom_fields_data)
 
-                success, response = cls._update_tags('remove', contact_id, tags_to_remove)
+            if response.status_code != 200:
+                failed_updates.append(cls._failed_response(contact_to_update, response))
+                return failed_updates
+
+        # Tags updates must be handled separately
+        if contact_to_update.get('tags'):
+            tag_operations = plan_tag_operations(contact_to_update['tags'], cls.MAX_UPDATEABLE_TAGS)
+
+            for method, tags_partition in tag_operations:
+                success, response = cls._update_tags(method, contact_id, tags_partition)
                 if not success:
                     failed_updates.append(cls._failed_response(contact_to_update, response))
-                    continue
+                    return failed_updates
+
+            # Compared to an add and a remove request per tags entry
+            unplanned_requests = sum(
+                _requests_count(tag_change.get(method, []), cls.MAX_UPDATEABLE_TAGS)
+                for tag_change in contact_to_update['tags']
+                for method in ('add', 'remove')
+            )
+            cls._record_tag_requests_saved(unplanned_requests - len(tag_operations))
 
         return failed_updates
 
@@ -324,16 +612,9 @@ class RespondIO(RespondIORequests):
             return True, None
 
         url = f"contact/{contact_id}/tags"
-        tags_to_update = [tags]
-
-        if len(tags) > cls.MAX_UPDATEABLE_TAGS:
-            # Divide list of tags into groups of size MAX_UPDATEABLE_TAGS
-            tags_to_update = [
-                tags[i:i + cls.MAX_UPDATEABLE_TAGS]
-                for i in range(0, len(tags), cls.MAX_UPDATEABLE_TAGS)
-            ]
 
-        for tags_partition in tags_to_update:
+        # Divide list of tags into groups of size MAX_UPDATEABLE_TAGS
+        for tags_partition in _partition(tags, cls.MAX_UPDATEABLE_TAGS):
             if method == 'add':
                 response = cls.post(url, {'tags': tags_partition})
             else:
@@ -0,0 +1,180 @@
+"""
+    Compiles DYNAMIC_TAGS_CRITERIA strings into predicates that are evaluated over whole dataframe columns.
+
+    Grammar:
+        criteria    => any_of
+        any_of      => all_of (OR all_of)*
+        all_of      => term (AND term)*
+        term        => comparison | '(' any_of ')'
+        comparison  => `<column-name>` <operator> `<value>`
+"""
+import re
+import pandas as pd
+
+NUMERIC_OPERATORS = ['<', '<=', '>', '>=', '%']
+EQUALITY_OPERATORS = ['=', '==', '!=']
+
+TOKEN_PATTERN = re.compile(r'\s*(?:`(?P<quoted>[^`]*)`|(?P<keyword>AND|OR)\b|(?P<symbol><=|>=|==|!=|[<>=%()]))', re.IGNORECASE)
+
+
+class Comparison:
+
+    def __init__(self, column, operator, value):
+        self.column = column
+        self.operator = '==' if operator == '=' else operator
+        self.value = value
+        self.number = _to_number(value)
+
+        if self.operator in NUMERIC_OPERATORS and self.number is None:
+            raise ValueError(f'`{value}` must be a number for the {operator} operator')
+        if self.operator == '%' and self.number == 0:
+            raise ValueError('`0` cannot be used with the % operator')
+
+    def mask(self, dataframe):
+        column = dataframe[self.column]
+        # Missing values never match, whatever the operator
+        present = column.notna()
+        numbers = pd.to_numeric(column, errors='coerce')
+
+        if self.operator in EQUALITY_OPERATORS:
+            equal = column.astype(str) == self.value
+            if self.number is not None:
+                equal |= numbers == self.number
+            matches = ~equal if self.operator == '!=' else equal
+        elif self.operator == '<':
+            matches = numbers < self.number
+        elif self.operator == '<=':
+            matches = numbers <= self.number
+        elif self.operator == '>':
+            matches = numbers > self.number
+        elif self.operator == '>=':
+            matches = numbers >= self.number
+        else:
+            # Like Python's %, the criteria holds when there is a remainder
+            matches = numbers.notna() & (numbers % self.number != 0)
+
+        return (present & matches).to_numpy(dtype=bool)
+
+    def __repr__(self):
+        return f'`{self.column}` {self.operator} `{self.value}`'
+
+
+class AllOf:
+
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    def mask(self, dataframe):
+        result = self.predicates[0].mask(dataframe)
+        for predicate in self.predicates[1:]:
+            result = result & predicate.mask(dataframe)
+        return result
+
+    def __repr__(self):
+        return '(' + ' AND '.join(repr(p) for p in self.predicates) + ')'
+
+
+class AnyOf(AllOf):
+
+    def mask(self, dataframe):
+        result = self.predicates[0].mask(dataframe)
+        for predicate in self.predicates[1:]:
+            result = result | predicate.mask(dataframe)
+        return result
+
+    def __repr__(self):
+        return '(' + ' OR '.join(repr(p) for p in self.predicates) + ')'
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _tokenize(criteria):
+    tokens = []
+    position = 0
+    criteria = criteria.rstrip()
+
+    while position < len(criteria):
+        match = TOKEN_PATTERN.match(criteria, position)
+        if not match:
+            raise ValueError(f'Unexpected text at position {position}: {criteria[position:]}')
+        if match.group('quoted') is not None:
+            tokens.append(('quoted', match.group('quoted')))
+        elif match.group('keyword'):
+            tokens.append(('keyword', match.group('keyword').upper()))
+        else:
+            tokens.append(('symbol', match.group('symbol')))
+        position = match.end()
+
+    return tokens
+
+
+def compile_criteria(criteria):
+    """
+        Parses a criteria string, e.g. "`Age` >= `65` AND `Gender` = `Female`", into a predicate
+        with a mask(dataframe) method. Raises a ValueError if the criteria is invalid.
+    """
+    tokens = _tokenize(criteria)
+    position = 0
+
+    def _peek():
+        return tokens[position] if position < len(tokens) else (None, None)
+
+    def _take(expected_kind):
+        nonlocal position
+        kind, value = _peek()
+        if kind != expected_kind:
+            raise ValueError(f'Expected {expected_kind} but found {value or "the end"} in: {criteria}')
+        position += 1
+        return value
+
+    def _any_of():
+        predicates = [_all_of()]
+        while _peek() == ('keyword', 'OR'):
+            _take('keyword')
+            predicates.append(_all_of())
+        return predicates[0] if len(predicates) == 1 else AnyOf(predicates)
+
+    def _all_of():
+        predicates = [_term()]
+        while _peek() == ('keyword', 'AND'):
+            _take('keyword')
+            predicates.append(_term())
+        return predicates[0] if len(predicates) == 1 else AllOf(predicates)
+
+    def _term():
+        nonlocal position
+        if _peek() == ('symbol', '('):
+            position += 1
+            predicate = _any_of()
+            if _take('symbol') != ')':
+                raise ValueError(f'Expected ) in: {criteria}')
+            return predicate
+
+        column = _take('quoted')
+        operator = _take('symbol')
+        if operator not in NUMERIC_OPERATORS + EQUALITY_OPERATORS:
+            raise ValueError(f'Unknown operator {operator} in: {criteria}')
+        return Comparison(column, operator, _take('quoted'))
+
+    predicate = _any_of()
+    if position != len(tokens):
+        raise ValueError(f'Unexpected {tokens[position][1]} in: {criteria}')
+    return predicate
+
+
+def compile_tag_rules(criteria_by_tag):
+    """
+        Compiles a {<tag name>: <criteria>} config into a list of (<tag name>, <predicate>) tuples
+    """
+    rules = []
+    for tag_name, criteria in criteria_by_tag.items():
+        try:
+            rules.append((tag_name, compile_criteria(criteria)))
+        except ValueError as e:
+            raise ValueError(f'Invalid criteria for dynamic tag {tag_name}: {e}')
+    return rules
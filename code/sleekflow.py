@@ -1,23 +1,117 @@
-import requests
 import json
+import math
+import re
+
+from datetime import datetime, timedelta
 from configs import (
     SLEEKFLOW_API_KEY,
     SLEEKFLOW_API_URL,
     FILTERED_EXPORT_ENABLED,
+    FULL_SYNC_INTERVAL_DAYS,
+    INCREMENTAL_SYNC_ENABLED,
+    SLEEKFLOW_SYNC_SNAPSHOT_PATH,
     GET_BY_REMOTE_FIELD_NAME,
     GET_BY_REMOTE_FIELD_VALUE,
+    SLEEKFLOW_BATCH_SIZE,
+    SLEEKFLOW_BATCH_MAX_BYTES,
+    SLEEKFLOW_UPLOAD_CONCURRENCY,
+    SLEEKFLOW_PAGE_FETCH_CONCURRENCY,
 )
-from utils import compare_contacts, output_dry_run_results
+from itertools import count
+from concurrency import imap_prefetched, map_concurrently, start_in_background
+from snapshot import SyncSnapshot
+from utils import contact_fingerprint, print_dry_run_results
+from transport import get_client
+from instrumentation import increment, span
 from logger import log
 
 
+# Statuses with which a whole batch is rejected for reasons other than its content
+BATCH_WIDE_ERROR_STATUS_CODES = {401, 403, 404, 429}
+
+
 def _get_stat(planned, failed):
     return f'{len(failed)}/{len(planned)}'
 
 
+def _text(value):
+    # Empty cells are None or NaN
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    return str(value)
+
+
+def _labels(tags_string):
+    return [label for label in _text(tags_string).split(', ') if label]
+
+
+def _phone_number_key(phone_number):
+    return re.sub(r'\D', '', phone_number)
+
+
+def _remote_contact(sleekflow_contact):
+    """
+        The phone number, names and labels (as a set) of a Sleekflow contact. Labels are accepted as a list
+        of names, a list of label objects or a comma separated string.
+    """
+    labels = sleekflow_contact.get('labels', sleekflow_contact.get('Labels')) or []
+    if isinstance(labels, str):
+        labels = labels.split(',')
+
+    label_names = set()
+    for label in labels:
+        if isinstance(label, dict):
+            label = label.get('hashtag') or label.get('LabelValue') or label.get('name')
+        if _text(label).strip():
+            label_names.add(_text(label).strip())
+
+    return {
+        'id': sleekflow_contact.get('id'),
+        'phoneNumber': _text(sleekflow_contact.get('phoneNumber', sleekflow_contact.get('PhoneNumber'))),
+        'firstName': _text(sleekflow_contact.get('firstName', sleekflow_contact.get('FirstName'))),
+        'lastName': _text(sleekflow_contact.get('lastName', sleekflow_contact.get('LastName'))),
+        'labels': label_names,
+    }
+
+
+class SleekflowBatcher:
+    """
+        Groups (<contact>, <payload>) records into batches of at most SLEEKFLOW_BATCH_SIZE records and
+        SLEEKFLOW_BATCH_MAX_BYTES bytes of JSON, as the records come in
+    """
+
+    def __init__(self):
+        self.batch = []
+        self.batch_bytes = 2  # The brackets of the JSON list
+
+    def add(self, record):
+        """
+            Returns the batches that are full after adding 'record'
+        """
+        full_batches = []
+        # The payload and the ', ' separating it from the previous one
+        record_bytes = len(json.dumps(record[1])) + 2
+        if self.batch and self.batch_bytes + record_bytes > SLEEKFLOW_BATCH_MAX_BYTES:
+            full_batches.extend(self.flush())
+
+        self.batch.append(record)
+        self.batch_bytes += record_bytes
+        if len(self.batch) >= SLEEKFLOW_BATCH_SIZE:
+            full_batches.extend(self.flush())
+        return full_batches
+
+    def flush(self):
+        """
+            Returns the last batch, if it has any records
+        """
+        batch, self.batch, self.batch_bytes = self.batch, [], 2
+        return [batch] if batch else []
+
+
 class SleekflowRequests:
 
     base_url = SLEEKFLOW_API_URL
+    client = get_client('sleekflow')
 
     @classmethod
     def headers(cls):
@@ -38,7 +132,7 @@ class SleekflowRequests:
             base_url=cls.base_url,
             resource_endpoint=cls.ensure_no_beginning_slash(resource)
         )
-        return requests.get(url, headers=cls.headers())
+        return cls.client.get(url, headers=cls.headers())
 
     @classmethod
     def put(cls, resource, data):
@@ -46,7 +140,7 @@ class SleekflowRequests:
             base_url=cls.base_url,
             resource_endpoint=cls.ensure_no_beginning_slash(resource)
         )
-        return requests.put(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.put(url, data=json.dumps(data), headers=cls.headers())
 
     @classmethod
     def post(cls, resource, data):
@@ -54,7 +148,7 @@ class SleekflowRequests:
             base_url=cls.base_url,
             resource_endpoint=cls.ensure_no_beginning_slash(resource)
         )
-        return requests.post(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.post(url, data=json.dumps(data), headers=cls.headers())
 
     @classmethod
     def delete(cls, resource, data):
@@ -62,7 +156,7 @@ class SleekflowRequests:
             base_url=cls.base_url,
             resource_endpoint=cls.ensure_no_beginning_slash(resource)
         )
-        return requests.delete(url, data=json.dumps(data), headers=cls.headers())
+        return cls.client.delete(url, data=json.dumps(data), headers=cls.headers())
 
     @classmethod
     def add_api_key(cls, resource):
@@ -76,66 +170,498 @@ class SleekflowRequests:
 
 class Sleekflow(SleekflowRequests):
     dry_run = False
+    full_sync = False
+
+    # The Future of the contacts being retrieved by prefetch_contacts, until sync takes them
+    prefetched_contacts = None
+
+    # The SyncJournal that the uploaded batches are recorded in, while changes are uploaded
+    journal = None
 
     FAILED = 'failed'
     SUCCESS = 'success'
 
     LOGGER_ID = 'Sleekflow'
     MAX_API_CONTACTS = 1000
+    ADD_OR_UPDATE_RESOURCE = 'Contact/AddOrUpdate'
 
     @classmethod
     def set_dry_run(cls, dry_run):
         cls.dry_run = dry_run
 
     @classmethod
-    def sync(cls, breeze_contacts: []):
+    def set_full_sync(cls, full_sync):
+        cls.full_sync = full_sync
+
+    @classmethod
+    def prefetch_contacts(cls):
+        """
+            Starts retrieving the Sleekflow contacts in the background, so that the next sync finds them
+            (or part of them) already retrieved. An incremental sync doesn't need them.
+        """
+        if not cls.full_sync_due():
+            log(f'{cls.LOGGER_ID} prefetch_contacts: the next sync is incremental, no contacts retrieved')
+            return
+        log(f'{cls.LOGGER_ID} prefetch_contacts: retrieving contacts in the background')
+        cls.prefetched_contacts = start_in_background(cls.get_all_contacts)
+
+    @classmethod
+    def sync(cls, breeze_contacts: [], journal=None, owned_labels=(), protected_labels=()):
+        """
+            'breeze_contacts' can be any iterable of contacts (e.g. a generator); it is only iterated once.
+            Contacts are matched to the Sleekflow contacts by phone number, and only what differs is sent.
+            With INCREMENTAL_SYNC_ENABLED, only the contacts that changed since the last sync are compared
+            (see changes_since_snapshot), unless a full sync is due.
+            The planned changes and their progress are recorded in 'journal' (a SyncJournal), if given.
+            See compare_to_remote_contacts for 'owned_labels' and 'protected_labels'.
+        """
         log(f'{cls.LOGGER_ID} Syncing...')
+        contacts, ignored_contacts = cls.parse_contacts(breeze_contacts)
+        owned_labels = cls.owned_labels(contacts, owned_labels)
+
+        snapshot = cls.open_snapshot()
+        try:
+            full_sync = cls.is_full_sync_due(snapshot)
+            # With a prefetch, this is only the time spent waiting for it
+            with span('sleekflow.get_contacts'):
+                contacts_to_compare, sleekflow_contacts = cls.contacts_to_compare(contacts, snapshot, full_sync)
+
+            log(f'{cls.LOGGER_ID} sync: comparing contacts')
+            with span('sleekflow.compare'):
+                creates, updates, deletes = cls.compare_to_remote_contacts(
+                    contacts_to_compare, sleekflow_contacts, owned_labels, protected_labels
+                )
+
+            if cls.dry_run:
+                cls.output_dry_run(creates, updates, deletes)
+
+            if journal is not None:
+                journal.record_plan({'creates': creates, 'updates': updates, 'deletes': deletes}, ignored_contacts)
+
+            failed_creates, failed_updates, failed_deletes = cls.upload_remaining_changes(
+                creates, updates, deletes, journal
+            )
+
+            if snapshot is not None:
+                cls.update_snapshot(
+                    snapshot, full_sync, contacts_to_compare, sleekflow_contacts,
+                    failed_creates + failed_updates + failed_deletes, owned_labels, protected_labels,
+                )
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+        return cls.sync_result(creates, updates, deletes, ignored_contacts, failed_creates, failed_updates, failed_deletes)
+
+    @classmethod
+    def owned_labels(cls, contacts, owned_labels=()):
+        """
+            'owned_labels' and the labels of all 'contacts', which an incremental sync doesn't all compare
+        """
+        return set(owned_labels).union(*(contact['labels'] for contact in contacts.values()))
+
+    @classmethod
+    def contacts_to_compare(cls, contacts, snapshot, full_sync):
+        """
+            Returns the contacts to compare and the Sleekflow contacts to compare them with: all of them for a
+            full sync, or those that changed since the snapshot of the last sync.
+        """
+        if full_sync:
+            return contacts, cls.wait_for_contacts()
+
+        if cls.prefetched_contacts is not None:
+            cls.prefetched_contacts.cancel()
+            cls.prefetched_contacts = None
+
+        log(f'{cls.LOGGER_ID} sync: determining the changes since the last sync')
+        contacts_to_compare, sleekflow_contacts = cls.changes_since_snapshot(contacts, snapshot.records())
+        log(f'{cls.LOGGER_ID} sync: {len(contacts_to_compare)}/{len(contacts)} contacts changed since the last sync')
+        return contacts_to_compare, sleekflow_contacts
 
-        # sleekflow_contacts = cls.get_all_contacts()
-        cls.create_contacts(breeze_contacts)
+    @classmethod
+    def wait_for_contacts(cls):
+        if cls.prefetched_contacts is not None:
+            log(f'{cls.LOGGER_ID} sync: waiting for the prefetched contacts')
+            prefetched_contacts, cls.prefetched_contacts = cls.prefetched_contacts, None
+            return prefetched_contacts.result()
+
+        log(f'{cls.LOGGER_ID} sync: retrieving contacts')
+        return cls.get_all_contacts()
 
-        # creates, updates, deletes = compare_contacts(
-        #     breeze_contacts=breeze_contacts,
-        #     sleekflow_contacts=sleekflow_contacts
-        # )
+    @classmethod
+    def open_snapshot(cls):
+        """
+            The SyncSnapshot of the last sync, or None if the syncs are not incremental
+        """
+        return SyncSnapshot(SLEEKFLOW_SYNC_SNAPSHOT_PATH) if INCREMENTAL_SYNC_ENABLED else None
+
+    @classmethod
+    def is_full_sync_due(cls, snapshot):
+        if snapshot is None or cls.full_sync or snapshot.is_empty():
+            return True
+
+        last_full_sync = snapshot.last_full_sync()
+        return last_full_sync is None or datetime.now() - last_full_sync >= timedelta(days=FULL_SYNC_INTERVAL_DAYS)
+
+    @classmethod
+    def full_sync_due(cls):
+        snapshot = cls.open_snapshot()
+        try:
+            return cls.is_full_sync_due(snapshot)
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    @classmethod
+    def _snapshot_record(cls, phone_number, contact, labels, remote_id=None):
+        # The phone number, names and labels of a contact, as it is in Sleekflow after it was synced
+        content = {
+            'phoneNumber': phone_number,
+            'firstName': contact['firstName'],
+            'lastName': contact['lastName'],
+            'labels': sorted(labels),
+        }
+        return {'remote_id': remote_id, 'content': content, 'content_hash': contact_fingerprint(content)}
+
+    @classmethod
+    def changes_since_snapshot(cls, contacts, records):
+        """
+            Returns the contacts that are new or changed since the snapshot's 'records', by phone number like
+            'contacts', together with the snapshot's version of the Sleekflow contacts they should be compared
+            with. The contacts in the snapshot that are no longer in Breeze are included as Sleekflow contacts,
+            so that their labels are removed.
+        """
+        records_by_phone_number = {
+            _phone_number_key(record['content']['phoneNumber']): (breeze_id, record)
+            for breeze_id, record in records.items()
+        }
+
+        changed_contacts = {}
+        phone_numbers = set()
+        for phone_number, contact in contacts.items():
+            phone_number_key = _phone_number_key(phone_number)
+            phone_numbers.add(phone_number_key)
+            _breeze_id, record = records_by_phone_number.get(phone_number_key, (None, None))
+            content_hash = cls._snapshot_record(phone_number, contact, contact['labels'])['content_hash']
+            if record is None or record['content_hash'] != content_hash:
+                changed_contacts[phone_number] = contact
+
+        changed_phone_numbers = {_phone_number_key(phone_number) for phone_number in changed_contacts}
+        sleekflow_contacts = [
+            # The breeze_id tells update_snapshot which record to remove once the labels are removed
+            {'id': record['remote_id'], 'breeze_id': breeze_id, **record['content']}
+            for phone_number_key, (breeze_id, record) in records_by_phone_number.items()
+            if phone_number_key in changed_phone_numbers or phone_number_key not in phone_numbers
+        ]
+        return changed_contacts, sleekflow_contacts
+
+    @classmethod
+    def update_snapshot(cls, snapshot, full_sync, contacts, sleekflow_contacts, failures, owned_labels=(),
+                        protected_labels=()):
+        """
+            Records the compared 'contacts' as they are in Sleekflow after the sync. A contact that synced is
+            recorded as it is in Breeze (with the 'protected_labels' it had, since they weren't removed). A
+            contact that failed keeps its record after an incremental sync, and is recorded as it was in
+            Sleekflow after a full one, so that it is compared again next time.
+        """
+        failed_phone_numbers = {_phone_number_key(failure['contact']['phoneNumber']) for failure in failures}
+
+        remote_contacts = {}
+        for sleekflow_contact in sleekflow_contacts:
+            remote_contact = _remote_contact(sleekflow_contact)
+            if remote_contact['phoneNumber']:
+                remote_contacts.setdefault(_phone_number_key(remote_contact['phoneNumber']), []).append(remote_contact)
+        tracked_labels = set(owned_labels).union(protected_labels)
+
+        records = {}
+        for phone_number, contact in contacts.items():
+            phone_number_key = _phone_number_key(phone_number)
+            remotes = remote_contacts.get(phone_number_key, [])
+            remote_id = remotes[0]['id'] if remotes else None
+            remote_labels = set().union(*(remote['labels'] for remote in remotes))
+
+            if phone_number_key in failed_phone_numbers:
+                if full_sync and remotes:
+                    records[str(contact['breeze_id'])] = cls._snapshot_record(
+                        phone_number, remotes[0], remote_labels.intersection(tracked_labels), remote_id
+                    )
+                continue
+
+            labels = set(contact['labels']).union(remote_labels.intersection(protected_labels))
+            records[str(contact['breeze_id'])] = cls._snapshot_record(phone_number, contact, labels, remote_id)
+
+        if full_sync:
+            snapshot.replace_all(records, datetime.now())
+        elif FILTERED_EXPORT_ENABLED:
+            # The deletes were not uploaded
+            snapshot.update(records, [])
+        else:
+            # The contacts that are no longer in Breeze, and whose labels were removed
+            compared_phone_numbers = {_phone_number_key(phone_number) for phone_number in contacts}
+            deleted_breeze_ids = [
+                sleekflow_contact['breeze_id']
+                for sleekflow_contact in sleekflow_contacts
+                if _phone_number_key(sleekflow_contact['phoneNumber']) not in compared_phone_numbers
+                and _phone_number_key(sleekflow_contact['phoneNumber']) not in failed_phone_numbers
+                and sleekflow_contact['breeze_id'] not in records
+            ]
+            snapshot.update(records, deleted_breeze_ids)
+        log(f'{cls.LOGGER_ID} sync: recorded {len(records)} contacts in the sync snapshot')
+
+    @classmethod
+    def resume(cls, journal):
+        """
+            Uploads the changes planned in the journal of an interrupted sync that were not uploaded yet.
+            Returns the same as sync, as if the sync had never been interrupted.
+        """
+        changes, ignored_contacts, _uploaded_phone_numbers, _failures = journal.read()
+        creates, updates, deletes = (changes.get(change, []) for change in ('creates', 'updates', 'deletes'))
+
+        failed_creates, failed_updates, failed_deletes = cls.upload_remaining_changes(creates, updates, deletes, journal)
+        return cls.sync_result(
+            creates, updates, deletes, ignored_contacts, failed_creates, failed_updates, failed_deletes
+        )
+
+    @classmethod
+    def upload_remaining_changes(cls, creates, updates, deletes, journal=None):
+        """
+            Like upload_changes, but skips the changes that the journal has as uploaded already, i.e. when the
+            sync is resumed. Their failures are returned with the failures of the other changes.
+        """
+        _changes, _ignored_contacts, uploaded_phone_numbers, previous_failures = (
+            journal.read() if journal is not None else ({}, [], {}, {})
+        )
 
-        # failed_creates = cls.create_contacts(creates)
-        # failed_updates = cls.update_contacts(updates)
-        #
-        # if not FILTERED_EXPORT_ENABLED:
-        #     # A remote delete is not permitted if a filtered export is being done,
-        #     # because there's no way of knowing who should not exist on repond.io
-        #     # with an incomplete list
-        #     log(f'{cls.LOGGER_ID} sync_to_respondio: handling "delete" contacts')
-        #     failed_deletes = cls.cls.delete_contacts(deletes)
+        def _remaining(change, records):
+            uploaded = uploaded_phone_numbers.get(change, set())
+            return [(contact, payload) for contact, payload in records if payload['phoneNumber'] not in uploaded]
 
+        remaining = [_remaining('creates', creates), _remaining('updates', updates), _remaining('deletes', deletes)]
+        if uploaded_phone_numbers:
+            log(f'{cls.LOGGER_ID} resume: {sum(len(records) for records in remaining)}/'
+                f'{len(creates) + len(updates) + len(deletes)} planned changes remain in {journal.path}')
+
+        failed_creates, failed_updates, failed_deletes = cls.upload_changes(*remaining, journal)
+        return (
+            previous_failures.get('creates', []) + failed_creates,
+            previous_failures.get('updates', []) + failed_updates,
+            previous_failures.get('deletes', []) + failed_deletes,
+        )
+
+    @classmethod
+    def upload_changes(cls, creates, updates, deletes, journal=None):
+        """
+            Returns the failed records of the creates, updates and deletes
+        """
+        cls.journal = journal
+        try:
+            with span('sleekflow.write'):
+                failed_creates = cls.create_contacts(creates)
+                failed_updates = cls.update_contacts(updates)
+
+                failed_deletes = []
+                if not FILTERED_EXPORT_ENABLED:
+                    # Removing labels is not permitted if a filtered export is being done,
+                    # because there's no way of knowing who should not have them with an incomplete list
+                    failed_deletes = cls.delete_contacts(deletes)
+        finally:
+            cls.journal = None
+
+        if journal is not None:
+            journal.record_finished()
+        return failed_creates, failed_updates, failed_deletes
+
+    @classmethod
+    def output_dry_run(cls, creates, updates, deletes):
+        cls.print_dry_run(creates, updates, deletes)
+        # Exit prematurely, since no additional work is needed
+        exit(0)
+
+    @classmethod
+    def print_dry_run(cls, creates, updates, deletes):
+        print_dry_run_results(
+            creates=[payload for _contact, payload in creates],
+            updates=[payload for _contact, payload in updates],
+            deletes=[payload['phoneNumber'] for _contact, payload in deletes],
+        )
+
+    @classmethod
+    def sync_result(cls, creates, updates, deletes, ignored_contacts, failed_contact_creates, failed_updates, failed_deletes):
+        """
+            The result of a sync, in the same format as RespondIO.sync_to_respondio's
+        """
+        failed_creates = {
+            'contact_creates': failed_contact_creates,
+            'contacts_ignored': ignored_contacts,
+            'tags_updates': [],
+        }
+        failed_contacts = failed_creates['contact_creates'] + failed_creates['contacts_ignored']
+
+        increment('sleekflow.creates', len(creates))
+        increment('sleekflow.updates', len(updates))
+        increment('sleekflow.deletes', len(deletes))
+        increment('sleekflow.ignored', len(ignored_contacts))
+        increment('sleekflow.failed', len(failed_contact_creates) + len(failed_updates) + len(failed_deletes))
         return {
-            'status': cls.SUCCESS,
-            'failed': {},
+            'status': cls.FAILED if failed_contacts or failed_updates or failed_deletes else cls.SUCCESS,
+            'failed': {
+                'creates': failed_creates,
+                'updates': failed_updates,
+                'deletes': failed_deletes,
+            },
             'stats': {
-                'creates': len(breeze_contacts),
-                'updates': 0,
-                'deletes': 0,
+                'creates': _get_stat(creates + ignored_contacts, failed_contacts),
+                'updates': _get_stat(updates, failed_updates),
+                'deletes': _get_stat(deletes, failed_deletes),
             },
         }
 
     @classmethod
-    def get_all_contacts(cls):
-        all_contacts_fetched = False
-        all_contacts = []
-        offset = 0
+    def parse_contacts(cls, breeze_contacts):
+        """
+            Returns the contacts by phone number ({<phone number>: <contact>}, with the fields and labels
+            that are synced) and a failed record for every contact without a phone number
+        """
+        contacts = {}
+        ignored_contacts = []
+        duplicate_phone_numbers = 0
+
+        for contact in breeze_contacts:
+            parsed_contact = {
+                'breeze_id': contact.get('custom_field.breeze_id'),
+                'firstName': _text(contact['First Name']),
+                'lastName': _text(contact['Last Name']),
+                'labels': _labels(contact['Tags']),
+            }
+            phone_number = _text(contact.get('Phone Number'))
+            if not phone_number:
+                ignored_contacts.append(cls._failed_record(parsed_contact, message='No phone number!'))
+                continue
+
+            if phone_number in contacts:
+                duplicate_phone_numbers += 1
+            # Like before, the last contact with a phone number wins
+            contacts[phone_number] = parsed_contact
+
+        if duplicate_phone_numbers:
+            log(f'{cls.LOGGER_ID} parse_contacts: {duplicate_phone_numbers} contacts share a phone number with another contact')
+        return contacts, ignored_contacts
 
-        while not all_contacts_fetched:
-            new_contacts = cls.get_contacts(offset=offset)
-            all_contacts = all_contacts + new_contacts
+    @classmethod
+    def compare_to_remote_contacts(cls, contacts, sleekflow_contacts, owned_labels=(), protected_labels=()):
+        """
+            Returns the creates, updates and deletes of iter_changes as lists
+        """
+        changes = {'creates': [], 'updates': [], 'deletes': []}
+        for change, record in cls.iter_changes(contacts, sleekflow_contacts, owned_labels, protected_labels):
+            changes[change].append(record)
+        return changes['creates'], changes['updates'], changes['deletes']
 
-            if len(new_contacts) < cls.MAX_API_CONTACTS:
-                all_contacts_fetched = True
-            else:
-                offset += cls.MAX_API_CONTACTS
+    @classmethod
+    def iter_changes(cls, contacts, sleekflow_contacts, owned_labels=(), protected_labels=()):
+        """
+            Yields the creates, updates and deletes as (<change>, (<contact>, <AddOrUpdate payload>)) tuples,
+            as soon as they are known: the creates and updates while the contacts are compared and the deletes
+            after that.
+            Updates only contain the fields and labels that changed. Sleekflow contacts are never deleted,
+            since not all of them come from Breeze; instead the "deletes" remove the labels of the contacts
+            that are no longer in Breeze.
+
+            Only the labels that Breeze owns are ever removed: 'owned_labels' and the labels of 'contacts'.
+            Labels that were added in Sleekflow itself are left alone, and so are 'protected_labels' (e.g.
+            the labels of tags whose people could not be retrieved).
+        """
+        owned_labels = set(owned_labels).union(*(contact['labels'] for contact in contacts.values()))
+        owned_labels.difference_update(protected_labels)
+
+        remote_contacts = {}
+        for sleekflow_contact in sleekflow_contacts:
+            remote_contact = _remote_contact(sleekflow_contact)
+            if remote_contact['phoneNumber']:
+                remote_contacts.setdefault(_phone_number_key(remote_contact['phoneNumber']), []).append(remote_contact)
+
+        duplicates = [remotes for remotes in remote_contacts.values() if len(remotes) > 1]
+        if duplicates:
+            # Updates are sent by phone number, so they can't be aimed at one of the duplicates. They are
+            # compared as a whole instead: whatever differs on any of them is sent.
+            descriptions = [
+                f'{remotes[0]["phoneNumber"]} ({", ".join(str(remote["id"]) for remote in remotes)})'
+                for remotes in duplicates
+            ]
+            log(f'{cls.LOGGER_ID} compare_to_remote_contacts: {len(duplicates)} phone numbers are shared by more '
+                f'than one Sleekflow contact: {", ".join(descriptions)}')
+
+        matched_phone_numbers = set()
+
+        for phone_number, contact in contacts.items():
+            remotes = remote_contacts.get(_phone_number_key(phone_number))
+            if not remotes:
+                yield 'creates', (cls._failure_contact(contact, phone_number), {
+                    'firstName': contact['firstName'],
+                    'lastName': contact['lastName'],
+                    'addLabels': contact['labels'],
+                    'labels': contact['labels'],
+                    # 'email': contact.get('Email'),
+                    'phoneNumber': phone_number,
+                })
+                continue
+
+            matched_phone_numbers.add(_phone_number_key(phone_number))
+            payload = {
+                field: contact[field]
+                for field in ('firstName', 'lastName')
+                if any(contact[field] != remote[field] for remote in remotes)
+            }
+
+            labels_to_add = [
+                label for label in contact['labels'] if any(label not in remote['labels'] for remote in remotes)
+            ]
+            remote_labels = set().union(*(remote['labels'] for remote in remotes))
+            labels_to_remove = sorted(remote_labels.intersection(owned_labels).difference(contact['labels']))
+            if labels_to_add:
+                payload['addLabels'] = labels_to_add
+            if labels_to_remove:
+                payload['removeLabels'] = labels_to_remove
+
+            if payload:
+                yield 'updates', (cls._failure_contact(contact, phone_number), {'phoneNumber': phone_number, **payload})
+
+        for phone_number_key, remotes in remote_contacts.items():
+            if phone_number_key in matched_phone_numbers:
+                continue
+            labels_to_remove = set().union(*(remote['labels'] for remote in remotes)).intersection(owned_labels)
+            if labels_to_remove:
+                yield 'deletes', (cls._failure_contact(remotes[0], remotes[0]['phoneNumber']), {
+                    'phoneNumber': remotes[0]['phoneNumber'],
+                    'removeLabels': sorted(labels_to_remove),
+                })
 
+    @classmethod
+    def get_all_contacts(cls):
+        all_contacts = []
+        for contacts in cls.iter_contact_pages():
+            all_contacts.extend(contacts)
         return all_contacts
 
+    @classmethod
+    def iter_contact_pages(cls):
+        """
+            Yields the pages of contacts in order, as they arrive. The total number of contacts is not known
+            upfront, so up to SLEEKFLOW_PAGE_FETCH_CONCURRENCY pages are requested ahead; the first page with
+            less than MAX_API_CONTACTS contacts is the last one.
+        """
+        pages = imap_prefetched(
+            lambda offset: cls.get_contacts(offset=offset),
+            count(0, cls.MAX_API_CONTACTS),
+            max_workers=SLEEKFLOW_PAGE_FETCH_CONCURRENCY,
+        )
+        try:
+            for contacts in pages:
+                yield contacts
+                if len(contacts) < cls.MAX_API_CONTACTS:
+                    return
+        finally:
+            pages.close()
+
     @classmethod
     def get_contacts(cls, offset):
         resource_url = f'/contact?offset={offset}'
@@ -148,75 +674,106 @@ class Sleekflow(SleekflowRequests):
             raise Exception('get_contacts failed - I quit!')
 
     @classmethod
-    def create_contacts(cls, contacts):
+    def create_contacts(cls, creates):
+        """
+            'creates' (like 'updates' and 'deletes' below) is a list of (<contact>, <payload>) tuples, as returned
+            by compare_to_remote_contacts. Returns the failed records.
+        """
         # Todo:
         # Add birth date
         # Add age
+        log(f'{cls.LOGGER_ID} create_contacts: creating {len(creates)} contacts...')
+        return cls.upload_contacts(cls.add_api_key(cls.ADD_OR_UPDATE_RESOURCE), creates, 'creates')
 
-        log(f'{cls.LOGGER_ID} create_contacts: handling labels...')
-        # Get all labels
-
-        res = cls.get(cls.add_api_key('labels'))
-
-        labels = json.loads(res.content)
-        data = [{'id': label['id'] for label in labels}]
-        # Delete all labels
+    @classmethod
+    def upload_contacts(cls, endpoint, records, change):
+        """
+            Posts the payloads of 'records', a list of (<contact>, <payload>) tuples, to the endpoint in batches.
+            Returns a failed record (see _failed_record) for every contact that could not be uploaded.
+            'change' is the kind of change, i.e. 'creates', 'updates' or 'deletes'.
+        """
+        batches = cls.batches(records)
+        results = map_concurrently(
+            lambda batch: cls.upload_change_batch(endpoint, change, batch),
+            batches,
+            max_workers=SLEEKFLOW_UPLOAD_CONCURRENCY,
+        )
 
-        res = cls.delete(cls.add_api_key('labels'), data=data)
+        failures = []
+        for batch, (batch_failures, error) in zip(batches, results):
+            if error is not None:
+                batch_failures = [cls._failed_record(contact, message=str(error)) for contact, _payload in batch]
+            failures.extend(batch_failures)
 
-        log(f'{cls.LOGGER_ID} create_contacts: parse contacts...')
-        data = []
+        log(f'{cls.LOGGER_ID} upload_contacts: {len(batches)} batches, {len(failures)}/{len(records)} contacts failed')
+        return failures
 
-        for contact in contacts:
-            if contact.get('Phone Number'):
-                new_contact = {
-                    'firstName': contact['First Name'],
-                    'lastName': contact['Last Name'],
-                    'addLabels': contact['Tags'].split(', '),
-                    'labels': contact['Tags'].split(', '),
-                    # 'email': contact.get('Email'),
-                    'phoneNumber': contact.get('Phone Number'),
-                }
-                data.append(new_contact)
+    @classmethod
+    def batches(cls, records):
+        batcher = SleekflowBatcher()
+        batches = []
+        for record in records:
+            batches.extend(batcher.add(record))
+        batches.extend(batcher.flush())
+        return batches
 
-        log(f'{cls.LOGGER_ID} create_contacts: making long running request...')
-        endpoint = cls.add_api_key('Contact/AddOrUpdate')
+    @classmethod
+    def upload_change_batch(cls, endpoint, change, batch):
+        """
+            Uploads a batch and records it in the journal of the sync, if there is one
+        """
+        failures = cls.upload_batch(endpoint, batch)
+        if cls.journal is not None:
+            cls.journal.record_uploaded(change, [payload['phoneNumber'] for _contact, payload in batch], failures)
+        return failures
 
-        manual = False
+    @classmethod
+    def upload_batch(cls, endpoint, batch):
+        try:
+            res = cls.post(endpoint, [payload for _contact, payload in batch])
+        except Exception as e:
+            log(f'{cls.LOGGER_ID} create_contacts result: {e}')
+            return [cls._failed_record(contact, message=str(e)) for contact, _payload in batch]
 
-        if manual:
-            res_messages = []
-            for i in data:
-                res = cls.post(endpoint, [i])
-                if res.status_code != 200:
-                    res_messages.append(res.content)
-        else:
-            chunk_size = 50
-            max_lenght = len(data)
+        log(f'{cls.LOGGER_ID} create_contacts result: status code => {res.status_code}')
+        if res.status_code == 200:
+            return []
 
-            if chunk_size > max_lenght:
-                chunk_size = max_lenght
+        log(f'{cls.LOGGER_ID} create_contacts result: content => {res.content}')
+        if len(batch) > 1 and 400 <= res.status_code < 500 and res.status_code not in BATCH_WIDE_ERROR_STATUS_CODES:
+            # The batch was rejected because of (some of) its contacts; the halves are retried to find them
+            middle = len(batch) // 2
+            return cls.upload_batch(endpoint, batch[:middle]) + cls.upload_batch(endpoint, batch[middle:])
 
-            iterations = int(max_lenght / chunk_size)
+        return [cls._failed_record(contact, res) for contact, _payload in batch]
 
-            starting_index = 0
-            for iteration in range(1, iterations + 2):
-                if chunk_size*iteration < max_lenght:
-                    items_to_send = data[starting_index:chunk_size*iteration]
-                else:
-                    items_to_send = data[starting_index:]
+    @classmethod
+    def _failure_contact(cls, contact, phone_number):
+        # The breeze_id is what the failed syncs export uses to find the contact
+        return {
+            'breeze_id': contact.get('breeze_id', ''),
+            'phoneNumber': phone_number,
+            'firstName': contact['firstName'],
+            'lastName': contact['lastName'],
+        }
 
-                res = cls.post(endpoint, items_to_send)
-                log(f'{cls.LOGGER_ID} create_contacts result: status code => {res.status_code}')
-                if res.status_code != 200 or res.status_code != "200":
-                    log(f'{cls.LOGGER_ID} create_contacts result: content => {json.loads(res.content)}')
+    @classmethod
+    def _failed_record(cls, contact, response=None, message=None):
+        if message:
+            return {'contact': contact, 'error': {'reason': message}}
 
-                starting_index = chunk_size*iteration
+        try:
+            reason = json.loads(response.content)
+        except ValueError:
+            reason = response.text
+        return {'contact': contact, 'error': {'status_code': str(response.status_code), 'reason': reason}}
 
     @classmethod
-    def update_contacts(cls, contacts):
-        pass
+    def update_contacts(cls, updates):
+        log(f'{cls.LOGGER_ID} update_contacts: updating {len(updates)} contacts...')
+        return cls.upload_contacts(cls.add_api_key(cls.ADD_OR_UPDATE_RESOURCE), updates, 'updates')
 
     @classmethod
-    def delete_contacts(cls, contacts):
-        pass
+    def delete_contacts(cls, deletes):
+        log(f'{cls.LOGGER_ID} delete_contacts: removing the labels of {len(deletes)} contacts...')
+        return cls.upload_contacts(cls.add_api_key(cls.ADD_OR_UPDATE_RESOURCE), deletes, 'deletes')
@@ -0,0 +1,81 @@
+import json
+import os
+import sqlite3
+
+from datetime import datetime
+
+
+class SyncSnapshot:
+    """
+        A local SQLite record of every contact as it was last synced to a remote API, keyed by breeze_id.
+
+        Each record holds the contact's remote id, its content (the API fields and tags that were synced)
+        and a hash of that content, so that a later sync can tell which contacts changed without
+        retrieving the remote contacts.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS contacts ('
+                'breeze_id TEXT PRIMARY KEY, remote_id TEXT, content TEXT NOT NULL, content_hash TEXT NOT NULL)'
+            )
+            self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def close(self):
+        self.connection.close()
+
+    def is_empty(self):
+        return self.connection.execute('SELECT COUNT(*) FROM contacts').fetchone()[0] == 0
+
+    def records(self):
+        """
+            Returns {<breeze_id>: {'remote_id': <remote_id>, 'content': <content>, 'content_hash': <hash>}}
+        """
+        rows = self.connection.execute('SELECT breeze_id, remote_id, content, content_hash FROM contacts')
+        return {
+            breeze_id: {'remote_id': remote_id, 'content': json.loads(content), 'content_hash': content_hash}
+            for breeze_id, remote_id, content, content_hash in rows
+        }
+
+    def last_full_sync(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_full_sync'").fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def replace_all(self, records, full_sync_at):
+        """
+            Replaces every record after a full sync. 'records' has the same format as returned by records().
+        """
+        with self.connection:
+            self.connection.execute('DELETE FROM contacts')
+            self._insert(records)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_full_sync', ?)",
+                (full_sync_at.isoformat(),)
+            )
+
+    def update(self, records, deleted_breeze_ids):
+        """
+            Inserts or replaces 'records' and removes 'deleted_breeze_ids' after an incremental sync
+        """
+        with self.connection:
+            self._insert(records)
+            self.connection.executemany(
+                'DELETE FROM contacts WHERE breeze_id = ?',
+                [(breeze_id,) for breeze_id in deleted_breeze_ids]
+            )
+
+    def _insert(self, records):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO contacts (breeze_id, remote_id, content, content_hash) VALUES (?, ?, ?, ?)',
+            [
+                (breeze_id, record['remote_id'], json.dumps(record['content'], sort_keys=True), record['content_hash'])
+                for breeze_id, record in records.items()
+            ]
+        )
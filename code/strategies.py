@@ -1,8 +1,11 @@
+import numpy as np
 import pandas as pd
 import re
 import os
+import threading
 
 from datetime import datetime
+from pandas._libs.sparse import IntIndex
 from configs import (
     HEADER_VALUE_MAPPINGS,
     DATA_OUTPUT_FILE_NAME,
@@ -13,13 +16,47 @@ from configs import (
     EXPORT_CONTACTS_WHERE_COLUMNS_HAS_VALUE,
     FAILED_SYNC_DATAFRAME_OUTPUT_FILE_NAME,
     BREEZE_TO_CSV_HEADER_CONVERTERS,
+    PERSIST_GENERATED_INPUT_FILE,
+    CSV_CHUNK_SIZE,
+    SYNC_JOURNAL_ENABLED,
+    SYNC_JOURNAL_FILE_NAME,
 )
 from sleekflow import Sleekflow
 from breeze import Breeze
+from journal import SyncJournal
+from instrumentation import increment, span, timed_iter
+from rules import compile_tag_rules
 from utils import send_email
 from logger import log
 
-NUMERIC_OPERATORS = ['<', '<=', '>', '>=', '%']
+# Compiled once, so that invalid criteria are reported before any data is processed
+DYNAMIC_TAG_RULES = compile_tag_rules(DYNAMIC_TAGS_CRITERIA)
+
+
+def _join_flagged_names(rows, columns, names, length, separator=', '):
+    """
+        'rows' and 'columns' are the coordinates of the flagged cells of a (length x names) boolean matrix,
+        ordered by row and then by column. Returns, per row, the flagged names joined by the separator (None
+        if no name is flagged) and the number of flagged names.
+    """
+    joined = np.full(length, None, dtype=object)
+    counts = np.bincount(rows, minlength=length) if len(rows) else np.zeros(length, dtype=int)
+
+    if len(rows):
+        names = np.asarray(names, dtype=object)
+        # Every row's names are one contiguous slice
+        row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        row_ends = np.r_[row_starts[1:], len(rows)]
+        flagged_names = names[columns]
+        joined[rows[row_starts]] = [
+            separator.join(flagged_names[start:end]) for start, end in zip(row_starts, row_ends)
+        ]
+
+    return joined, counts
+
+
+def _is_tag_matrix_column(column):
+    return isinstance(column.dtype, pd.SparseDtype) and column.dtype.subtype == bool
 
 
 class DataCleaner:
@@ -43,6 +80,61 @@ class DataCleaner:
         tag = tag.replace(')', '')
         return True, tag
 
+    # Column versions of the cleaning functions above. They take a series of non-empty values and
+    # return a (<is valid series>, <cleaned series>) tuple.
+
+    @classmethod
+    def clean_phone_number_column(cls, column):
+        # Replace odd characters
+        stripped_numbers = column.astype(str).str.replace(r'[ +()-]', '', regex=True)
+
+        international = stripped_numbers.str.startswith('27') & (stripped_numbers.str.len() == 11)
+        local = stripped_numbers.str.startswith('0') & (stripped_numbers.str.len() == 10)
+
+        # Return original for inspection
+        cleaned_numbers = column.astype(object).where(~local, '27' + stripped_numbers.str[1:])
+        cleaned_numbers = cleaned_numbers.where(~international, stripped_numbers)
+        return international | local, cleaned_numbers
+
+    @classmethod
+    def clean_tags_column(cls, column):
+        tags = column.astype(str).str.replace('(', '- ', regex=False).str.replace(')', '', regex=False)
+        return pd.Series(True, index=column.index), tags
+
+    @classmethod
+    def column_cleaner(cls, cleaning_function):
+        """
+            Resolves the name of a cleaning function to a function that cleans a whole column. If the
+            cleaning function has no column version, it is called on every value of the column.
+        """
+        column_function = getattr(cls, f'{cleaning_function}_column', None)
+        if column_function is not None:
+            return column_function
+
+        value_function = getattr(cls, cleaning_function, None)
+        if not callable(value_function):
+            raise ValueError(f'Unknown cleaning function: {cleaning_function}')
+
+        def _clean_column(column):
+            results = [value_function(row_item) for row_item in column]
+            is_valid = pd.Series([valid for valid, _value in results], index=column.index, dtype=bool)
+            cleaned = pd.Series([value for _valid, value in results], index=column.index, dtype=object)
+            return is_valid, cleaned
+
+        return _clean_column
+
+    @classmethod
+    def resolve_cleaning_functions(cls, cleaning_functions):
+        """
+            Turns a {<column name>: <cleaning function name>} config into {<column name>: <column cleaner>}
+        """
+        return {header: cls.column_cleaner(function_name) for header, function_name in cleaning_functions.items()}
+
+
+# Resolved once, so that unknown cleaning functions are reported before any data is processed
+INPUT_COLUMNS_CLEANERS = DataCleaner.resolve_cleaning_functions(INPUT_COLUMNS_CLEANING_FUNCTIONS)
+OUTPUT_COLUMNS_CLEANERS = DataCleaner.resolve_cleaning_functions(OUTPUT_COLUMNS_CLEANING_FUNCTIONS)
+
 
 class BaseStrategy(DataCleaner):
 
@@ -71,72 +163,121 @@ class BaseStrategy(DataCleaner):
         raise NotImplementedError
 
     @classmethod
-    def dynamic_tags(cls, dataframe, data_index):
-        tags = []
-
-        for tag_name, tag_criteria in DYNAMIC_TAGS_CRITERIA.items():
-            # Extract criteria logic from string
-            column, operator, value = re.split(r'`*`', tag_criteria)[1:-1]
-            operator = operator.strip()
-
-            variable_value = dataframe[column][data_index]
-            reference_value = value
-
-            if variable_value and str(variable_value) == 'nan':
-                continue
-
-            # Basic check to see if values needs to be parsed to integer for eval
-            if operator in NUMERIC_OPERATORS:
-                variable_value = int(variable_value)
-                reference_value = int(reference_value)
-
-            if operator == '=':
-                operator = '=='
-
-            if eval(f'variable_value {operator} reference_value'):
-                tags.append(tag_name)
-
-        return tags
+    def dynamic_tags(cls, dataframe):
+        """
+            Returns a boolean dataframe with a column per dynamic tag, flagging the rows the tag applies to
+        """
+        return pd.DataFrame(
+            data={tag_name: rule.mask(dataframe) for tag_name, rule in DYNAMIC_TAG_RULES},
+            index=dataframe.index,
+            columns=[tag_name for tag_name, _rule in DYNAMIC_TAG_RULES],
+        )
 
 
 class CSVHandler:
     export_dir = None
 
     @classmethod
-    def export_to_csv(cls, dataframe, output_path=None, generated_input_file=False):
+    def export_to_csv(cls, dataframe, output_path=None, generated_input_file=False, append=False):
         if generated_input_file:
             export_path = output_path
         else:
-            if not cls.export_dir:
-                import datetime
-
-                timestamp = datetime.datetime.now()
-                export_timestamp = '{year}_{month}_{day}_{hour}:{minute}:{second}'.format(
-                    year=timestamp.year,
-                    month=timestamp.month,
-                    day=timestamp.day,
-                    hour=timestamp.hour,
-                    minute=timestamp.minute,
-                    second=timestamp.second,
-                )
-                cls.export_dir = f'sync_{export_timestamp}'
-                os.mkdir(f'data_files/output/{cls.export_dir}')
-
             path = DATA_OUTPUT_FILE_NAME
             if output_path:
                 path = output_path
 
-            export_path = f'data_files/output/{cls.export_dir}/{path}'
-        dataframe.to_csv(export_path, index=False)
+            export_path = f'data_files/output/{cls.get_export_dir()}/{path}'
+
+        with span('export_to_csv'):
+            tag_matrix_headers = [header for header in cls.get_header(dataframe) if _is_tag_matrix_column(dataframe[header])]
+            if tag_matrix_headers:
+                cls._export_tag_matrix_to_csv(dataframe, export_path, tag_matrix_headers, append=append)
+            elif append:
+                dataframe.to_csv(export_path, index=False, mode='a', header=False)
+            else:
+                dataframe.to_csv(export_path, index=False)
         return export_path
 
+    @classmethod
+    def get_export_dir(cls):
+        """
+            Returns the name of this run's output directory (in data_files/output), which is created the first time
+        """
+        if not cls.export_dir:
+            import datetime
+
+            timestamp = datetime.datetime.now()
+            export_timestamp = '{year}_{month}_{day}_{hour}:{minute}:{second}'.format(
+                year=timestamp.year,
+                month=timestamp.month,
+                day=timestamp.day,
+                hour=timestamp.hour,
+                minute=timestamp.minute,
+                second=timestamp.second,
+            )
+            cls.export_dir = f'sync_{export_timestamp}'
+            os.mkdir(f'data_files/output/{cls.export_dir}')
+
+        return cls.export_dir
+
+    @classmethod
+    def _export_tag_matrix_to_csv(cls, dataframe, export_path, tag_matrix_headers, append=False, chunk_size=5000):
+        """
+            Writes sparse tag columns the way Breeze exports them (an 'x' for every tagged contact), a
+            chunk of rows at a time so that the tag columns are never expanded all at once
+        """
+        for start in range(0, max(len(dataframe.index), 1), chunk_size):
+            chunk = dataframe.iloc[start:start + chunk_size].copy()
+            for header in tag_matrix_headers:
+                chunk[header] = np.where(chunk[header].to_numpy(dtype=bool), 'x', None)
+
+            if append or start > 0:
+                chunk.to_csv(export_path, index=False, mode='a', header=False)
+            else:
+                chunk.to_csv(export_path, index=False)
+
+    @classmethod
+    def export_to_csv_in_background(cls, dataframe, output_path=None, generated_input_file=False):
+        """
+            Exports a copy of the dataframe on a separate thread, so that processing can continue in the
+            meantime. Returns the thread, which can be joined to wait for the export to finish.
+        """
+        dataframe = dataframe.copy()
+
+        def _export():
+            try:
+                cls.export_to_csv(dataframe, output_path=output_path, generated_input_file=generated_input_file)
+            except Exception as e:
+                log(f'Exporting {output_path} failed: {e}')
+
+        export_thread = threading.Thread(target=_export, name=f'export {output_path}')
+        export_thread.start()
+        return export_thread
+
     @classmethod
     def get_header(cls, dataframe):
         return dataframe.columns.values.tolist()
 
     @classmethod
     def get_csv_dataframe(cls, file_path):
-        return pd.read_csv(file_path)
+        return pd.read_csv(file_path, dtype=cls._csv_dtypes(file_path))
+
+    @classmethod
+    def get_csv_dataframe_chunks(cls, file_path, chunk_size):
+        """
+            Returns an iterator over dataframes of (at most) 'chunk_size' rows of the file. Every column besides
+            the tag columns is read as text, since the types pandas infers could differ from chunk to chunk.
+        """
+        return pd.read_csv(file_path, dtype=cls._csv_dtypes(file_path, other_columns_dtype=str), chunksize=chunk_size)
+
+    @classmethod
+    def _csv_dtypes(cls, file_path, other_columns_dtype=None):
+        # Tag columns are mostly empty, with an 'x' for every tagged contact
+        headers = pd.read_csv(file_path, nrows=0).columns
+        dtypes = {header: 'category' for header in headers if header.endswith('(Tag)')}
+        if other_columns_dtype is not None:
+            dtypes.update({header: other_columns_dtype for header in headers if header not in dtypes})
+        return dtypes
 
 
 class CSVStrategy(BaseStrategy, CSVHandler):
@@ -146,21 +287,38 @@ class CSVStrategy(BaseStrategy, CSVHandler):
         return cls.get_header(cls.get_csv_dataframe(path))
 
     @classmethod
-    def get_data(cls, samplefile, datafile):
+    def get_data(cls, samplefile, datafile, dataframe=None):
+        """
+            Returns the sample file headers and an iterable of people dataframes
+        """
         respondio_headers = cls.get_sample_file_headers(samplefile)
-        people_data = cls.get_csv_dataframe(datafile)
-        return respondio_headers, people_data
+        if dataframe is not None:
+            # A dataframe handed over by a previous stage is used as is, instead of reading the datafile
+            people_dataframes = [dataframe]
+        elif CSV_CHUNK_SIZE:
+            people_dataframes = cls.get_csv_dataframe_chunks(datafile, CSV_CHUNK_SIZE)
+        else:
+            people_dataframes = [cls.get_csv_dataframe(datafile)]
+        return respondio_headers, people_dataframes
 
     @classmethod
-    def clean_data(cls, dataframe, dataframe_cleaning_functions):
+    def clean_data(cls, dataframe, dataframe_cleaners):
+        """
+            'dataframe_cleaners' format (see DataCleaner.resolve_cleaning_functions):
+            {
+                <column_name>: <column cleaner>,
+            }
+
+            The faulty data is returned per column as {<row index>: <faulty value>}
+        """
         headers = cls.get_header(dataframe)
         faulty_data = {}
 
         for header in headers:
-            if header in dataframe_cleaning_functions.keys():
+            if header in dataframe_cleaners.keys():
                 cleaned_data, faulty_data_values = cls.clean_column(
-                    dataframe[header].values.tolist(),
-                    dataframe_cleaning_functions[header]
+                    dataframe[header],
+                    dataframe_cleaners[header]
                 )
                 dataframe[header] = cleaned_data
 
@@ -169,30 +327,33 @@ class CSVStrategy(BaseStrategy, CSVHandler):
         return dataframe, faulty_data
 
     @classmethod
-    def clean_column(cls, column: [], cleaning_function: str):
-        cleaned_rows = []
-        faulty_rows = []
+    def clean_column(cls, column, column_cleaner):
+        cleaned_rows = pd.Series('', index=column.index, dtype=object)
 
-        for row_item in column:
-            if not row_item or str(row_item) == 'nan':
-                cleaned_rows.append('')
-                continue
+        # Empty cells stay empty and are not passed to the cleaner
+        filled = column.notna() & column.astype(bool)
+        if column.dtype == object:
+            filled &= column != 'nan'
 
-            is_valid, cleaned_row_item = eval(f'cls.{cleaning_function}(row_item)')
-            if is_valid:
-                cleaned_rows.append(cleaned_row_item)
-            else:
-                cleaned_rows.append('')
-                faulty_rows.append(cleaned_row_item)
+        is_valid, cleaned_row_items = column_cleaner(column[filled])
+        valid_index = is_valid.index[is_valid.to_numpy(dtype=bool)]
+        cleaned_rows.loc[valid_index] = cleaned_row_items.loc[valid_index]
 
+        faulty_rows = cleaned_row_items[~is_valid].to_dict()
         return cleaned_rows, faulty_rows
 
     @classmethod
     def parse_to_new_dataframe(cls, new_dataframe_headers, old_dataframe):
+        """
+            Every new column is built column-wise from "pieces": each piece is an array of cell values
+            together with the number of items each cell contributes (tag pieces can contribute many).
+            A cell without any items gets the default value, a cell with a single item gets that item
+            and a cell with multiple items gets the items separated by commas.
+        """
         parsed_header_data = {}
+        wildcard_pieces = {}
 
         for header in new_dataframe_headers:
-            new_column_data = []
             default_column_cell_value = ''
 
             # Determine what header will be used for the new dataframe
@@ -206,73 +367,114 @@ class CSVStrategy(BaseStrategy, CSVHandler):
                 breeze_headers = [header]
                 lambda_function = ''
 
-            # Loop through existing dataframe and consolidate data to match new headers
-            for data_index in range(len(old_dataframe)):
-                cell_data = []
-
-                # Go through every specified Breeze header to be merged into this one cell
-                for _header in breeze_headers:
-                    if _header.startswith('*'):
-                        postfix = _header[1:]
-
-                        for old_header in cls.get_header(old_dataframe):
-                            if old_header.endswith(postfix):
-                                if old_dataframe[old_header][data_index] == 'x':
-                                    tag = old_header[:old_header.find("(Tag)")].strip()
-                                    cell_data.append(tag)
-                    else:
-                        breeze_cell_data = old_dataframe[_header][data_index]
-                        if not breeze_cell_data or str(breeze_cell_data) == 'nan':
-                            continue
-                        cell_data.append(breeze_cell_data)
-
-                # Handle additional calculated data for specific cell specified by the
-                # 'lambda' function in the HEADER_VALUE_MAPPINGS config
-                if lambda_function:
-                    cell_data.extend(eval(f"cls.{lambda_function}(old_dataframe, data_index)"))
-
-                if not cell_data:
-                    new_column_data.append(default_column_cell_value)  # Empty cell
-                elif len(cell_data) == 1:
-                    new_column_data.append(cell_data[0])
+            pieces = []
+            # Go through every specified Breeze header to be merged into the cells of this column
+            for _header in breeze_headers:
+                if _header.startswith('*'):
+                    # Wildcard headers are resolved once, no matter how many columns use them
+                    if _header not in wildcard_pieces:
+                        wildcard_pieces[_header] = cls._wildcard_piece(old_dataframe, _header[1:])
+                    pieces.append(wildcard_pieces[_header])
                 else:
-                    # If multiple items merged together, separate by comma
-                    new_column_data.append(', '.join(cell_data))
+                    pieces.append(cls._column_piece(old_dataframe[_header]))
 
-            parsed_header_data[header] = new_column_data
+            # Handle additional calculated data for specific cell specified by the
+            # 'lambda' function in the HEADER_VALUE_MAPPINGS config
+            if lambda_function:
+                pieces.append(cls._lambda_piece(getattr(cls, lambda_function), old_dataframe))
 
-        new_dataframe = pd.DataFrame(data=parsed_header_data)
+            parsed_header_data[header] = cls._merge_pieces(
+                pieces, len(old_dataframe), default_column_cell_value
+            ).tolist()
+
+        # The rows keep their index, so that the rows of consecutive chunks have consecutive indices
+        new_dataframe = pd.DataFrame(data=parsed_header_data, index=old_dataframe.index)
 
         if FILTERED_EXPORT_ENABLED:
             new_dataframe = cls.filter_dataframe_by_columns_values(new_dataframe)
 
         return new_dataframe
 
+    @classmethod
+    def _column_piece(cls, column):
+        # Empty cells (including NaN and 'nan') are skipped
+        present = column.notna() & column.astype(bool)
+        if column.dtype == object:
+            present &= column != 'nan'
+
+        values = column.to_numpy(dtype=object)
+        return values, present.to_numpy().astype(int)
+
+    @classmethod
+    def _wildcard_piece(cls, dataframe, postfix):
+        tag_headers = [old_header for old_header in cls.get_header(dataframe) if old_header.endswith(postfix)]
+        tag_names = [old_header[:old_header.find("(Tag)")].strip() for old_header in tag_headers]
+
+        row_chunks = []
+        column_chunks = []
+        for column_number, tag_header in enumerate(tag_headers):
+            column = dataframe[tag_header]
+            if _is_tag_matrix_column(column):
+                # Only the tagged rows are stored, so they are read without looking at the other rows
+                tagged_rows = column.array.sp_index.indices[column.array.sp_values]
+            else:
+                tagged_rows = np.flatnonzero(column.eq('x').to_numpy())
+            row_chunks.append(tagged_rows)
+            column_chunks.append(np.full(len(tagged_rows), column_number))
+
+        rows = np.concatenate(row_chunks) if row_chunks else np.array([], dtype=int)
+        columns = np.concatenate(column_chunks) if column_chunks else np.array([], dtype=int)
+        order = np.lexsort((columns, rows))
+        return _join_flagged_names(rows[order], columns[order], tag_names, len(dataframe))
+
+    @classmethod
+    def _lambda_piece(cls, function, dataframe):
+        flags = function(dataframe)
+        rows, columns = np.nonzero(flags.to_numpy(dtype=bool))
+        return _join_flagged_names(rows, columns, list(flags.columns), len(dataframe))
+
+    @classmethod
+    def _merge_pieces(cls, pieces, length, default_value):
+        merged = np.full(length, default_value, dtype=object)
+        if not pieces:
+            return merged
+
+        total_counts = sum(counts for _values, counts in pieces)
+
+        single = total_counts == 1
+        for values, counts in pieces:
+            from_piece = single & (counts > 0)
+            merged[from_piece] = values[from_piece]
+
+        # If multiple items merged together, separate by comma
+        multiple = total_counts > 1
+        joined = np.full(length, None, dtype=object)
+        started = np.zeros(length, dtype=bool)
+        for values, counts in pieces:
+            present = multiple & (counts > 0)
+            first = present & ~started
+            following = present & started
+            joined[first] = values[first]
+            joined[following] = joined[following] + ', ' + values[following]
+            started |= present
+        merged[multiple] = joined[multiple]
+
+        return merged
+
     @classmethod
     def filter_dataframe_by_columns_values(cls, dataframe):
-        def _matches(contacts_tags, exportable_tags):
-            export_match_list = []
-            for tags in contacts_tags:
-                # Skip iteration if no data present
-                if not tags or tags is None:
-                    export_match_list.append(False)
-                    continue
-
-                contains_all_tags = True
-                for tag in exportable_tags:
-                    if tag not in tags:
-                        contains_all_tags = False
-                        break
-
-                export_match_list.append(contains_all_tags)
-            return export_match_list
-
-        matches = None
+        """
+            Keeps the contacts of which the last configured column contains all of that column's values
+        """
+        matches = np.zeros(len(dataframe.index), dtype=bool)
         for col, values in EXPORT_CONTACTS_WHERE_COLUMNS_HAS_VALUE.items():
-            if matches is None:
-                matches = _matches(dataframe[col], values)
-            else:
-                matches = matches and _matches(dataframe[col], values)
+            column = dataframe[col]
+            # Skip contacts if no data present
+            column_matches = column.notna() & column.astype(bool)
+            for value in values:
+                column_matches &= column.astype(str).str.contains(value, regex=False)
+            # The matches of a column replace those of the previous columns
+            matches = column_matches.to_numpy(dtype=bool)
 
         return dataframe.loc[matches]
 
@@ -280,37 +482,63 @@ class CSVStrategy(BaseStrategy, CSVHandler):
 class StrategyOne(CSVStrategy):
 
     @classmethod
-    def execute(cls, samplefile, datafile=None, *args, **kwargs):
-        if datafile is None:
+    def execute(cls, samplefile, datafile=None, *args, dataframe=None, **kwargs):
+        if datafile is None and dataframe is None:
             return 'No datafile found!'
         try:
             print('Getting data...')
-            respondio_headers, people_dataframe = cls.get_data(samplefile, datafile)
+            with span('get_data'):
+                respondio_headers, people_dataframes = cls.get_data(samplefile, datafile, dataframe=dataframe)
 
-            print('Cleaning pre-processed data...')
-            cleaned_data, faulty_input_data = cls.clean_data(people_dataframe, INPUT_COLUMNS_CLEANING_FUNCTIONS)
+            print('Cleaning and parsing data...')
+            faulty_input_data = {}
+            processed_dataframes = cls.process_dataframes(respondio_headers, people_dataframes, faulty_input_data)
+            cls.handle_cleaned_dataframes(processed_dataframes)
 
             if faulty_input_data:
                 cls.report_faulty_data(faulty_input_data)
-
-            new_dataframe = cls.parse_to_new_dataframe(respondio_headers, cleaned_data)
-
-            print('Cleaning post-processed data...')
-            post_processed_cleaned_data, _faulty_data = cls.clean_data(new_dataframe, OUTPUT_COLUMNS_CLEANING_FUNCTIONS)
-
-            cls.handle_cleaned_data(post_processed_cleaned_data)
         except Exception as e:
             raise e
         return None
 
+    @classmethod
+    def process_dataframes(cls, respondio_headers, people_dataframes, faulty_input_data):
+        """
+            Cleans and parses the people dataframes one at a time and yields the processed dataframes, so
+            that only one of them needs to be in memory at a time. The faulty input data of every
+            dataframe is added to 'faulty_input_data'.
+        """
+        # A chunked reader reads the chunks while they are iterated over
+        for people_dataframe in timed_iter('get_data', people_dataframes):
+            log(f'Processing {len(people_dataframe.index)} rows...')
+            increment('rows.read', len(people_dataframe.index))
+            with span('clean_data'):
+                cleaned_data, faulty_data = cls.clean_data(people_dataframe, INPUT_COLUMNS_CLEANERS)
+            for header, faulty_values in faulty_data.items():
+                faulty_input_data.setdefault(header, {}).update(faulty_values)
+                increment('rows.faulty_values', len(faulty_values))
+
+            with span('parse_to_new_dataframe'):
+                new_dataframe = cls.parse_to_new_dataframe(respondio_headers, cleaned_data)
+            with span('clean_data'):
+                post_processed_cleaned_data, _faulty_data = cls.clean_data(new_dataframe, OUTPUT_COLUMNS_CLEANERS)
+            increment('rows.processed', len(post_processed_cleaned_data.index))
+            yield post_processed_cleaned_data
+
     @classmethod
     def report_faulty_data(cls, faulty_data):
         print('')
         print("The following columns contains faulty data:")
         for k, v in faulty_data.items():
-            print(f'{k}: {v}')
+            print(f'{k}: ' + ', '.join(f'{value} (row {index})' for index, value in v.items()))
         print('')
 
+    @classmethod
+    def handle_cleaned_dataframes(cls, dataframes):
+        print('Exporting to .csv...')
+        for i, dataframe in enumerate(dataframes):
+            cls.export_to_csv(dataframe, append=i > 0)
+
     @classmethod
     def handle_cleaned_data(cls, new_dataframe):
         print('Exporting to .csv...')
@@ -331,12 +559,16 @@ class StrategyTwo(StrategyOne):
     processed_dataframe = None
     remote_sync_result = {}
 
+    # The journal of an interrupted sync whose plan was cut off, while the sync runs again (see resume)
+    resumed_journal = None
+
     @classmethod
     def execute(cls, samplefile, datafile, *args, **kwargs):
         Sleekflow.set_dry_run(kwargs['dry_run'])
+        Sleekflow.set_full_sync(kwargs.get('full_sync', False))
 
         cls.export = kwargs.get('export')
-        super().execute(samplefile, datafile)
+        super().execute(samplefile, datafile, dataframe=kwargs.get('dataframe'))
 
     @classmethod
     def report_faulty_data(cls, faulty_data):
@@ -344,30 +576,158 @@ class StrategyTwo(StrategyOne):
 
     @classmethod
     def parse_to_dictionary(cls, dataframe):
-        def _parse_contact(columns, i):
-            return {c: dataframe[c][i] for c in columns}
+        # Values are converted to native Python types (int instead of numpy.int64, etc.)
+        return dataframe.to_dict('records')
 
-        dict_data = []
-        keys = cls.get_header(dataframe)
+    @classmethod
+    def iter_dictionaries(cls, dataframe, chunk_size=1000):
+        """
+            Lazy version of parse_to_dictionary: yields the contacts one at a time, converting only
+            'chunk_size' rows at a time
+        """
+        for start in range(0, len(dataframe.index), chunk_size):
+            yield from cls.parse_to_dictionary(dataframe.iloc[start:start + chunk_size])
 
-        for index in dataframe.index:
-            dict_data.append(_parse_contact(keys, index))
+    @classmethod
+    def handle_cleaned_dataframes(cls, dataframes):
+        """
+            Like StrategyOne, exports the processed dataframes one at a time, while their contacts are handed to
+            the sync, so that they're never all in memory at once. The sync only keeps the fields it syncs.
+        """
+        # Push to api
+        contacts = cls.iter_processed_contacts(dataframes)
+        cls.remote_sync_result = cls.sync_contacts(contacts)
 
-        return dict_data
+        if cls.remote_sync_result.get('status') == Sleekflow.FAILED and cls.export:
+            cls._export_failed_sync_contacts()
 
     @classmethod
     def handle_cleaned_data(cls, dataframe):
-        cls.processed_dataframe = dataframe
+        cls.handle_cleaned_dataframes([dataframe])
 
-        if cls.export:
-            super().handle_cleaned_data(cls.processed_dataframe)
+    @classmethod
+    def iter_processed_contacts(cls, dataframes):
+        cls.processed_dataframe = None
+        for i, dataframe in enumerate(dataframes):
+            if cls.export:
+                if i == 0:
+                    print('Exporting to .csv...')
+                cls.export_to_csv(dataframe, append=i > 0)
 
-        # Push to api
-        contacts = cls.parse_to_dictionary(cls.processed_dataframe)
-        cls.remote_sync_result = Sleekflow.sync(contacts)
+            # A single dataframe (like StrategyThree's) is kept for reporting the failed syncs. When there are
+            # more, they're read back from the export instead.
+            cls.processed_dataframe = dataframe if i == 0 else None
+            yield from cls.iter_dictionaries(dataframe)
+
+    @classmethod
+    def sync_contacts(cls, contacts):
+        return Sleekflow.sync(
+            contacts,
+            journal=cls.sync_journal(),
+            owned_labels=cls.owned_labels(),
+            protected_labels=cls.protected_labels(),
+        )
+
+    @classmethod
+    def owned_labels(cls):
+        """
+            The labels that the sync may remove from Sleekflow contacts, next to the labels of the synced contacts
+        """
+        return cls.tag_labels([tag_name for tag_name, _rule in DYNAMIC_TAG_RULES])
+
+    @classmethod
+    def protected_labels(cls):
+        """
+            The labels that the sync must never remove
+        """
+        return []
+
+    @classmethod
+    def tag_labels(cls, tag_names):
+        """
+            The labels of tags, i.e. their names as the 'Tags' column cleaning function outputs them
+        """
+        tag_names = pd.Series(list(tag_names), dtype=object)
+        cleaning_function = OUTPUT_COLUMNS_CLEANING_FUNCTIONS.get('Tags')
+        if cleaning_function and len(tag_names.index):
+            is_valid, cleaned_names = cls.column_cleaner(cleaning_function)(tag_names)
+            tag_names = cleaned_names.where(is_valid, tag_names)
+        return tag_names.tolist()
+
+    @classmethod
+    def sync_journal(cls):
+        if cls.resumed_journal is not None:
+            return cls.resumed_journal
+        return cls.create_journal()
+
+    @classmethod
+    def create_journal(cls):
+        if not SYNC_JOURNAL_ENABLED or Sleekflow.dry_run:
+            return None
+        return SyncJournal(f'data_files/output/{cls.get_export_dir()}/{SYNC_JOURNAL_FILE_NAME}')
+
+    @classmethod
+    def resume(cls, samplefile=None, datafile=None, export=False):
+        """
+            Finishes the last sync from its journal, if it was interrupted. Returns whether there was a sync to resume.
+            When its plan was cut off, the contacts are retrieved and compared again, but the changes that were
+            uploaded are not sent again.
+        """
+        journal = SyncJournal.find_interrupted('data_files/output', SYNC_JOURNAL_FILE_NAME)
+        if journal is None:
+            return False
+
+        log(f'Resuming the sync recorded in {journal.path}')
+        cls.export = export
+        # The output of the interrupted run is completed, rather than starting a new one
+        cls.export_dir = os.path.basename(os.path.dirname(journal.path))
+
+        if not journal.is_plan_complete():
+            log('The plan of the sync was cut off, the contacts are compared again')
+            journal.record_resumed()
+            cls.resumed_journal = journal
+            try:
+                cls.execute(samplefile, datafile, export=export, dry_run=False)
+            finally:
+                cls.resumed_journal = None
+            return True
+
+        cls.remote_sync_result = Sleekflow.resume(journal)
+        cls.processed_dataframe = cls._resumed_dataframe(journal)
 
         if cls.remote_sync_result.get('status') == Sleekflow.FAILED and cls.export:
             cls._export_failed_sync_contacts()
+        return True
+
+    @classmethod
+    def _exported_dataframe(cls):
+        """
+            The processed data, as it was exported to the run's output directory (None if it wasn't)
+        """
+        export_path = f'data_files/output/{cls.export_dir}/{DATA_OUTPUT_FILE_NAME}'
+        if cls.export_dir and os.path.exists(export_path):
+            return pd.read_csv(export_path, dtype=str)
+        return None
+
+    @classmethod
+    def _resumed_dataframe(cls, journal):
+        """
+            The processed data of the interrupted run, for reporting the failed syncs. When it was not exported,
+            the contacts recorded in the journal are used instead.
+        """
+        dataframe = cls._exported_dataframe()
+        if dataframe is not None:
+            return dataframe
+
+        changes, ignored_contacts, _uploaded, _failures = journal.read()
+        contacts = [contact for records in changes.values() for contact, _payload in records]
+        contacts.extend(failure['contact'] for failure in ignored_contacts)
+        return pd.DataFrame(data={
+            'custom_field.breeze_id': [contact.get('breeze_id', '') for contact in contacts],
+            'Phone Number': [contact.get('phoneNumber', '') for contact in contacts],
+            'First Name': [contact.get('firstName', '') for contact in contacts],
+            'Last Name': [contact.get('lastName', '') for contact in contacts],
+        })
 
     @classmethod
     def notify_results(cls, *args, **kwargs):
@@ -410,6 +770,8 @@ class StrategyTwo(StrategyOne):
     @classmethod
     def _export_failed_sync_contacts(cls):
         dataframe = cls.processed_dataframe
+        if dataframe is None:
+            dataframe = cls._exported_dataframe()
         # This setting only suppresses an irrelevant warning message
         pd.options.mode.chained_assignment = None
 
@@ -422,11 +784,12 @@ class StrategyTwo(StrategyOne):
                 contact = c['contact']
                 error = c['error']
 
-                breeze_ids.append(int(contact['breeze_id']))  # Need to cast back to int
+                breeze_ids.append(str(contact['breeze_id']))
                 errors.append(error.get('reason'))
                 status_codes.append(error.get('status_code', ''))
 
-            subframe = dataframe[dataframe['custom_field.breeze_id'].isin(breeze_ids)]
+            # The ids are compared as strings, since they are ints when read from a .csv but strings from Breeze
+            subframe = dataframe[dataframe['custom_field.breeze_id'].astype(str).isin(breeze_ids)]
 
             # DELETE needs to be handled separately because the subframe will be empty
             # due to the contact not being in the dataframe.
@@ -465,30 +828,85 @@ class StrategyTwo(StrategyOne):
 class StrategyThree(StrategyTwo):
     faulty_data = None
 
+    # The names of the Breeze tags whose people were retrieved
+    breeze_tags = []
+
     @classmethod
     def execute(cls, samplefile, datafile, *args, **kwargs):
         log('Executing Strategy 3')
-        success, contacts, tags = Breeze.get_contacts()
+        # The Sleekflow contacts don't depend on Breeze, so they are retrieved at the same time (if needed)
+        Sleekflow.set_full_sync(kwargs.get('full_sync', False))
+        Sleekflow.prefetch_contacts()
+        with span('breeze.get_contacts'):
+            success, contacts, tags = Breeze.get_contacts()
 
         if success:
-            dataframe = cls.parse_to_dataframe(contacts, tags)
-            cls.export_to_csv(dataframe, datafile, generated_input_file=True)
-            super().execute(samplefile, datafile, *args, **kwargs)
+            cls.process_contacts(contacts, tags, samplefile, datafile, *args, **kwargs)
         else:
-            log('Failed to retrieve Breeze contacts. Notifying via email')
-            send_email(
-                'Failed sync',
-                'Could not retrieve Breeze contacts'
-            )
+            cls.notify_failed_retrieval()
             return None
 
+    @classmethod
+    def process_contacts(cls, contacts, tags, samplefile, datafile, *args, **kwargs):
+        cls.breeze_tags = tags
+        with span('parse_to_dataframe'):
+            dataframe = cls.parse_to_dataframe(contacts, tags)
+
+        # The dataframe is handed to the CSV pipeline directly; the generated input file is only a side output
+        export_thread = None
+        if PERSIST_GENERATED_INPUT_FILE:
+            export_thread = cls.export_to_csv_in_background(dataframe, datafile, generated_input_file=True)
+
+        super().execute(samplefile, datafile, *args, dataframe=dataframe, **kwargs)
+
+        if export_thread:
+            export_thread.join()
+
+    @classmethod
+    def owned_labels(cls):
+        # Includes the tags nobody has anymore, so that their labels are removed too
+        return super().owned_labels() + cls.tag_labels(cls.breeze_tags)
+
+    @classmethod
+    def protected_labels(cls):
+        # Who has the tags whose people could not be retrieved is unknown, so their labels are left as they are
+        return super().protected_labels() + cls.tag_labels(failed_tag['tag']['name'] for failed_tag in Breeze.failed_tags)
+
+    @classmethod
+    def add_failed_tags(cls, sync_result):
+        """
+            Adds the tags whose people could not be retrieved to the result of a sync, which then failed
+        """
+        if not Breeze.failed_tags:
+            return sync_result
+
+        failed_tags = [
+            {'tag': failed_tag['tag']['name'], 'error': str(failed_tag['error'])} for failed_tag in Breeze.failed_tags
+        ]
+        log(f'{len(failed_tags)} Breeze tags could not be retrieved: {", ".join(ft["tag"] for ft in failed_tags)}')
+        return {
+            **sync_result,
+            'status': Sleekflow.FAILED,
+            'failed': {**sync_result['failed'], 'tags': failed_tags},
+            'stats': {**sync_result['stats'], 'tags': f'{len(failed_tags)}/{len(failed_tags) + len(cls.breeze_tags)}'},
+        }
+
+    @classmethod
+    def notify_failed_retrieval(cls):
+        log('Failed to retrieve Breeze contacts. Notifying via email')
+        send_email(
+            'Failed sync',
+            'Could not retrieve Breeze contacts'
+        )
+
     @classmethod
     def report_faulty_data(cls, _faulty_data):
         pass
 
     @classmethod
-    def handle_cleaned_data(cls, dataframe):
-        super().handle_cleaned_data(dataframe)
+    def handle_cleaned_dataframes(cls, dataframes):
+        super().handle_cleaned_dataframes(dataframes)
+        cls.remote_sync_result = cls.add_failed_tags(cls.remote_sync_result)
 
     @classmethod
     def notify_results(cls, *args, **kwargs):
@@ -500,18 +918,28 @@ class StrategyThree(StrategyTwo):
             subject = f'Some items failed to sync - {today_date}'
             attachment_file_path = cls._get_failed_results_attachment_path()
 
-            attachment_info = {
-                'path': attachment_file_path,
-                'name': 'failed_syncs.csv'
-            }
-
             stats = cls.remote_sync_result['stats']
 
             email_body = f"""
             Creates failed: {stats['creates']}
             Updates failed: {stats['updates']}
             Deletes failed: {stats['deletes']}
-            
+            """
+
+            failed_tags = cls.remote_sync_result['failed'].get('tags')
+            if failed_tags:
+                email_body += f"""
+            Tags failed to retrieve: {stats['tags']} ({', '.join(ft['tag'] for ft in failed_tags)})
+            Their labels were left as they were in Sleekflow, so they're synced on the next successful run.
+            """
+
+            # There is no attachment when only tags failed
+            if attachment_file_path:
+                attachment_info = {
+                    'path': attachment_file_path,
+                    'name': 'failed_syncs.csv'
+                }
+                email_body += """
             See the attached document for the failed results.
             """
         else:
@@ -524,14 +952,16 @@ class StrategyThree(StrategyTwo):
 
     @classmethod
     def parse_to_dataframe(cls, raw_breeze_contacts, tags):
+        """
+            The tag columns are sparse boolean columns (a True for every tagged contact), so that
+            only the tagged contacts take up memory
+        """
         dataframe_dict = dict()
         # Initialise empty header columns
         for _x, csv_header in BREEZE_TO_CSV_HEADER_CONVERTERS.items():
             dataframe_dict[csv_header] = []
 
-        for tag in tags:
-            qualified_header = f'{tag} (Tag)'
-            dataframe_dict[qualified_header] = [None for i in range(len(raw_breeze_contacts))]
+        tagged_indices = {f'{tag} (Tag)': [] for tag in tags}
 
         for index, contact in enumerate(raw_breeze_contacts):
             for breeze_header, csv_header in BREEZE_TO_CSV_HEADER_CONVERTERS.items():
@@ -539,8 +969,16 @@ class StrategyThree(StrategyTwo):
 
             if contact.get('tags') is not None:
                 for tag in contact['tags']:
-                    qualified_header = f'{tag} (Tag)'
-                    dataframe_dict[qualified_header][index] = 'x'
+                    tagged_indices[f'{tag} (Tag)'].append(index)
+
+        # Built straight from the tagged indices, so no dense column is allocated for any tag
+        for qualified_header, indices in tagged_indices.items():
+            indices = np.unique(np.asarray(indices, dtype=np.int32))
+            dataframe_dict[qualified_header] = pd.arrays.SparseArray(
+                np.ones(len(indices), dtype=bool),
+                sparse_index=IntIndex(len(raw_breeze_contacts), indices),
+                fill_value=False,
+            )
 
         return pd.DataFrame(data=dataframe_dict)
 
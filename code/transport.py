@@ -0,0 +1,202 @@
+import random
+import threading
+import time
+import requests
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from configs import (
+    HTTP_CLIENT_SETTINGS,
+    HTTP_MAX_RETRIES,
+    HTTP_BACKOFF_SECONDS,
+    HTTP_MAX_BACKOFF_SECONDS,
+    HTTP_MAX_RATE_LIMITED_RETRIES,
+)
+from ratelimit import get_limiter
+from instrumentation import record_http
+from logger import log
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# A POST is only retried when the server signals that it did not process the request
+NON_IDEMPOTENT_RETRY_STATUS_CODES = {429, 503}
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE'}
+
+# The slots of the requests to all the services, while a budget is shared (see shared_request_budget)
+_request_slots = None
+
+
+@contextmanager
+def shared_request_budget(max_requests):
+    """
+        Within the 'with' block, at most 'max_requests' requests (to any service, from any thread or pool of
+        threads) are in flight at the same time. A request doesn't hold its slot while it waits to be retried.
+    """
+    global _request_slots
+    _request_slots = threading.BoundedSemaphore(max_requests)
+    try:
+        yield
+    finally:
+        _request_slots = None
+
+
+def _request_slot():
+    return _request_slots if _request_slots is not None else nullcontext()
+
+
+def _retry_after_seconds(response):
+    retry_after = response.headers.get('Retry-After')
+    if not retry_after:
+        return None
+
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+def _loggable_url(url):
+    # The query string is left out, since it can hold an API key (e.g. Sleekflow's ?apikey=...)
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}{parts.path}' if parts.netloc else parts.path
+
+
+def _connection_failed(error):
+    """
+        Whether the request failed before a connection to the server was made, i.e. it was never sent
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+class HTTPClient:
+    """
+        A keep-alive HTTP client for a single remote service. Every request gets the service's
+        timeout, waits for the service's rate limiter and is retried with exponential backoff and
+        jitter on connection errors and 429/5xx responses, honouring the server's Retry-After
+        header when present.
+    """
+
+    def __init__(self, service, timeout=None, pool_size=10, max_retries=HTTP_MAX_RETRIES,
+                 max_rate_limited_retries=HTTP_MAX_RATE_LIMITED_RETRIES,
+                 backoff_seconds=HTTP_BACKOFF_SECONDS, max_backoff_seconds=HTTP_MAX_BACKOFF_SECONDS):
+        self.service = service
+        self.timeout = timeout
+        self.limiter = get_limiter(service)
+        self.max_retries = max_retries
+        self.max_rate_limited_retries = max_rate_limited_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+
+        while True:
+            self.limiter.acquire()
+            try:
+                with _request_slot():
+                    start = time.perf_counter()
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(method, e.__class__.__name__, start, kwargs)
+                if not self._should_retry_error(method, e, attempt):
+                    raise
+                delay = self._backoff(attempt)
+                log(f'{self.service} {method} {_loggable_url(url)}: {e.__class__.__name__}, retrying in {delay:.2f}s')
+            else:
+                self._record(method, response.status_code, start, kwargs, response)
+                retry_after = _retry_after_seconds(response)
+                if response.status_code == 429:
+                    # Slows down every request to this service, not just this one
+                    self.limiter.throttle(retry_after)
+                elif response.status_code < 400:
+                    self.limiter.succeed()
+
+                if not self._should_retry_response(method, response, attempt):
+                    return response
+                delay = self._backoff(attempt, retry_after=retry_after)
+                log(f'{self.service} {method} {_loggable_url(url)}: status code {response.status_code}, '
+                    f'retrying in {delay:.2f}s')
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _record(self, method, status, start, kwargs, response=None):
+        # Every attempt is recorded, so retries show up in the metrics. Form data and files are not counted as bytes sent.
+        data = kwargs.get('data')
+        if isinstance(data, str):
+            data = data.encode()
+        record_http(
+            self.service, method, status, time.perf_counter() - start,
+            bytes_sent=len(data) if isinstance(data, bytes) else 0,
+            bytes_received=len(response.content) if response is not None else 0,
+        )
+
+    def _should_retry_error(self, method, error, attempt):
+        if attempt >= self.max_retries:
+            return False
+        if method in IDEMPOTENT_METHODS:
+            return True
+        # Only safe to send again when the request never reached the server: a connection that was reset or
+        # timed out after the request was sent may have been processed, and would be duplicated
+        return _connection_failed(error)
+
+    def _should_retry_response(self, method, response, attempt):
+        if response.status_code == 429:
+            # The rate limiter has slowed down, so a rate limited request gets more chances
+            return attempt < self.max_rate_limited_retries
+        if attempt >= self.max_retries:
+            return False
+        if method in IDEMPOTENT_METHODS:
+            return response.status_code in RETRY_STATUS_CODES
+        return response.status_code in NON_IDEMPOTENT_RETRY_STATUS_CODES
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            # The server knows best: retrying before it asked for would only be rate limited again
+            return retry_after
+        # "Full jitter": a random delay of up to the exponential backoff
+        return random.uniform(0, min(self.backoff_seconds * (2 ** attempt), self.max_backoff_seconds))
+
+
+_clients = {}
+
+
+def get_client(service):
+    """
+        Returns the shared HTTPClient of a service configured in HTTP_CLIENT_SETTINGS
+    """
+    if service not in _clients:
+        _clients[service] = HTTPClient(service, **HTTP_CLIENT_SETTINGS.get(service, {}))
+    return _clients[service]
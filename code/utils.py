@@ -1,27 +1,110 @@
+import hashlib
+import json
+import pandas as pd
+
+from itertools import islice
+from operator import itemgetter
+
 from configs import API_FIELD_MAPPINGS, DEFAULT_FROM_EMAIL, EMAIL_RECIPIENTS
 from mailer import mail
 from logger import log
 
 
-def map_to_respondio_api_fields(breeze_contacts):
+def _map_text_values(values):
+    return [str(value) if value else '' for value in values]
+
+
+def _map_tags_values(values):
+    # Many contacts share the same tags, so every distinct tags string is only split once
+    split_tags = {}
+    mapped_values = []
+    for tags_string in values:
+        if not tags_string:
+            mapped_values.append([])
+            continue
+
+        tags = split_tags.get(tags_string)
+        if tags is None:
+            tags = split_tags[tags_string] = [tag.strip() for tag in tags_string.split(',')]
+        mapped_values.append(list(tags))
+    return mapped_values
+
+
+def compile_field_mappings(field_mappings):
+    """
+        Compiles an API_FIELD_MAPPINGS config into a list of (<Breeze header>, <field id>, <transform>) tuples,
+        where the transform maps a list of Breeze values to a list of API values.
+        Raises a ValueError if the config is invalid.
+    """
+    plan = []
+    field_ids = set()
+
+    for breeze_header, api_field in field_mappings.items():
+        field_id = api_field.get('field_id') if isinstance(api_field, dict) else None
+        if not field_id or not isinstance(field_id, str):
+            raise ValueError(f'Invalid API field mapping for {breeze_header}: a field_id is required')
+        if field_id in field_ids:
+            raise ValueError(f'Invalid API field mapping for {breeze_header}: {field_id} is mapped more than once')
+        field_ids.add(field_id)
+
+        # Tags is a special case
+        transform = _map_tags_values if field_id == 'tags' else _map_text_values
+        plan.append((breeze_header, field_id, transform))
+
+    if 'breeze_id' not in field_ids:
+        raise ValueError('Invalid API field mappings: contacts are matched by breeze_id, which is not mapped')
+    return plan
+
+
+# Compiled once, so that an invalid config is reported before any contact is synced
+API_FIELD_MAPPING_PLAN = compile_field_mappings(API_FIELD_MAPPINGS)
+
+
+def _map_columns(values_by_header):
+    field_ids = [field_id for _header, field_id, _transform in API_FIELD_MAPPING_PLAN]
+    columns = [transform(values_by_header(header)) for header, _field_id, transform in API_FIELD_MAPPING_PLAN]
+    return [dict(zip(field_ids, values)) for values in zip(*columns)]
+
+
+def map_to_respondio_api_fields(breeze_contacts, chunk_size=1000):
+    """
+        'breeze_contacts' is an iterable of contacts or a dataframe. Either way, the contacts are mapped
+        a whole field (column) at a time; an iterable 'chunk_size' contacts at a time, so that it is not
+        materialized all at once.
+    """
+    if isinstance(breeze_contacts, pd.DataFrame):
+        return _map_columns(lambda header: breeze_contacts[header].tolist())
+
     mapped_contacts = []
+    contacts = iter(breeze_contacts)
+    while True:
+        chunk = list(islice(contacts, chunk_size))
+        if not chunk:
+            return mapped_contacts
+        mapped_contacts.extend(_map_columns(lambda header: list(map(itemgetter(header), chunk))))
 
-    for contact_data in breeze_contacts:
-        mapped_contact = {}
-        for breeze_header, api_field in API_FIELD_MAPPINGS.items():
-            if api_field['field_id'] == 'tags':
-                # Tags is a special case
-                tags_string = contact_data[breeze_header]
-                tags_list = tags_string.split(',') if tags_string else []
-                if any(tags_list):
-                    tags_list = [tag.strip() for tag in tags_list]
-
-                mapped_contact[api_field['field_id']] = tags_list
-            else:
-                mapped_contact[api_field['field_id']] = str(contact_data[breeze_header]) if contact_data[breeze_header] else ''
-        mapped_contacts.append(mapped_contact)
 
-    return mapped_contacts
+def contact_fingerprint(contact):
+    """
+        A hash of a contact in the format returned by map_to_respondio_api_fields. Tags are compared as
+        a set (like determine_updates does), so their order does not change the fingerprint.
+    """
+    canonical = {
+        key: sorted(set(value)) if key == 'tags' else value
+        for key, value in contact.items()
+    }
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _remote_fingerprint(cms_contact, remote_custom_fields, remote_tags):
+    """
+        The contact_fingerprint of a remote contact, over the same API fields as the Breeze contact. A missing
+        remote field counts as empty, like in the field by field comparison.
+    """
+    remote_contact = {key: remote_custom_fields.get(key, '') for key in cms_contact if key != 'tags'}
+    if 'tags' in cms_contact:
+        remote_contact['tags'] = remote_tags or []
+    return contact_fingerprint(remote_contact)
 
 
 def determine_updates(matched_contacts):
@@ -31,13 +114,19 @@ def determine_updates(matched_contacts):
         cms_contact = contacts_match['breeze']
         remote_contact = contacts_match['respondio']
 
-        custom_fields_to_update = {}
+        remote_custom_fields = remote_contact.get('custom_fields') or {}
+        remote_fingerprint = _remote_fingerprint(cms_contact, remote_custom_fields, remote_contact.get('tags'))
+        if contact_fingerprint(cms_contact) == remote_fingerprint:
+            # Most matched contacts are unchanged, so they skip the field by field comparison
+            continue
+
+        changed_fields = []
         tags_to_update = []
         # Compare key-value pairs
-        for key in cms_contact.keys():
+        for key, cms_contact_value in cms_contact.items():
             if key == 'tags':
-                cms_contact_tags = set(cms_contact.get(key, []))
-                remote_tags = set(remote_contact.get(key, []))
+                cms_contact_tags = set(cms_contact_value)
+                remote_tags = set(remote_contact.get(key) or [])
 
                 tags_to_add = cms_contact_tags.difference(remote_tags)
                 tags_to_remove = remote_tags.difference(cms_contact_tags)
@@ -47,22 +136,21 @@ def determine_updates(matched_contacts):
                         'add': tags_to_add,
                         'remove': tags_to_remove,
                     })
-            else:
-                cms_contact_value = cms_contact.get(key, '')
-                remote_value = remote_contact['custom_fields'].get(key, '')
+            elif cms_contact_value != remote_custom_fields.get(key, ''):
+                changed_fields.append((key, cms_contact_value))
 
-                if cms_contact_value != remote_value:
-                    custom_fields_to_update = {key: cms_contact_value, **custom_fields_to_update}
+        # Latest changed field first, the order in which the fields have always been sent
+        custom_fields_to_update = dict(reversed(changed_fields))
 
         if custom_fields_to_update:
             remote_contact['custom_fields'] = custom_fields_to_update
         else:
-            remote_contact.pop('custom_fields')
+            remote_contact.pop('custom_fields', None)
 
         if tags_to_update:
             remote_contact['tags'] = tags_to_update
         else:
-            remote_contact.pop('tags')
+            remote_contact.pop('tags', None)
 
         # Add the breeze_id to remote_contact for auditing purposes
         remote_contact['breeze_id'] = cms_contact['breeze_id']
@@ -73,43 +161,64 @@ def determine_updates(matched_contacts):
     return updates
 
 
+def index_contacts_by_breeze_id(respondio_contacts):
+    """
+        Builds a breeze_id -> remote contact lookup in a single pass over the remote contacts.
+        Only the first remote contact with a given breeze_id is indexed; any further contacts
+        sharing that breeze_id are returned separately as duplicates.
+    """
+    index = {}
+    duplicates = []
+
+    for respond_contact in respondio_contacts:
+        custom_fields = respond_contact.get('custom_fields') or {}
+        if 'breeze_id' not in custom_fields:
+            continue
+
+        breeze_id = custom_fields['breeze_id']
+        if breeze_id in index:
+            duplicates.append(respond_contact)
+        else:
+            index[breeze_id] = respond_contact
+
+    return index, duplicates
+
+
 def compare_contacts(breeze_contacts=[], respondio_contacts=[]):
     """
         This functions does the heavy-lifting of the remote syncing algorithm
     """
+    return compare_mapped_contacts(
+        mapped_contacts=map_to_respondio_api_fields(breeze_contacts),
+        respondio_contacts=respondio_contacts,
+    )
+
+
+def compare_mapped_contacts(mapped_contacts=[], respondio_contacts=[]):
+    """
+        Same as compare_contacts, for Breeze contacts that have already been mapped to the API fields
+    """
 
     def _parse_delete_contact(contact):
         return {'id': contact.get('id'), 'breeze_id': contact['custom_fields']['breeze_id']}
 
     new_contacts = []
     matched_contacts = []
+    breeze_ids = set()
 
-    # As the loop iterates, the matching contacts' id's will be removed so that only those
-    # that did not match remains
-    potential_contacts_to_delete = [
-        _parse_delete_contact(rc)
-        for rc in respondio_contacts
-        if 'breeze_id' in rc.get('custom_fields', {}).keys()
-    ]
+    remote_contacts_index, duplicate_contacts = index_contacts_by_breeze_id(respondio_contacts)
 
-    for breeze_contact in map_to_respondio_api_fields(breeze_contacts):
+    duplicate_breeze_ids = []
+    for breeze_contact in mapped_contacts:
         breeze_id = breeze_contact['breeze_id']
 
-        matched_responseio_contact = None
-        for respond_contact in respondio_contacts:
-            custom_fields = respond_contact['custom_fields']
-
-            if 'breeze_id' in custom_fields.keys():
-                # Handle ChMS contact
-                if custom_fields['breeze_id'] == breeze_id:
-                    # Contact match, so this contact should be removed from potential_contacts_to_delete list
-                    matched_responseio_contact = respond_contact
-
-                    # Remove from delete list
-                    item_to_remove = _parse_delete_contact(respond_contact)
-                    potential_contacts_to_delete.remove(item_to_remove)
-                    break
+        if breeze_id in breeze_ids:
+            # The remote contact has already been claimed by an earlier Breeze contact
+            duplicate_breeze_ids.append(breeze_id)
+            continue
+        breeze_ids.add(breeze_id)
 
+        matched_responseio_contact = remote_contacts_index.get(breeze_id)
         if matched_responseio_contact:
             matched_contacts.append({
                 'breeze': breeze_contact,
@@ -118,6 +227,31 @@ def compare_contacts(breeze_contacts=[], respondio_contacts=[]):
         else:
             new_contacts.append(breeze_contact)
 
+    if duplicate_breeze_ids:
+        log(f'compare_contacts: skipped {len(duplicate_breeze_ids)} Breeze contacts with an already '
+            f'matched breeze_id: {", ".join(str(_id) for _id in duplicate_breeze_ids)}')
+
+    # As before, only the first remote contact with the breeze_id of a Breeze contact is matched; the other
+    # remote contacts sharing it are deleted, and reported so that their conversations can be checked
+    matched_duplicates = [dc for dc in duplicate_contacts if dc['custom_fields']['breeze_id'] in breeze_ids]
+    if matched_duplicates:
+        descriptions = [f'{dc.get("id")} (breeze_id {dc["custom_fields"]["breeze_id"]})' for dc in matched_duplicates]
+        log(f'compare_contacts: deleting {len(matched_duplicates)} remote contacts that share the breeze_id '
+            f'of a matched remote contact: {", ".join(descriptions)}')
+
+    potential_contacts_to_delete = []
+    matched_breeze_ids = set()
+    for rc in respondio_contacts:
+        custom_fields = rc.get('custom_fields') or {}
+        if 'breeze_id' not in custom_fields:
+            continue
+        breeze_id = custom_fields['breeze_id']
+        if breeze_id in breeze_ids and breeze_id not in matched_breeze_ids:
+            # The indexed (first) remote contact with this breeze_id
+            matched_breeze_ids.add(breeze_id)
+            continue
+        potential_contacts_to_delete.append(_parse_delete_contact(rc))
+
     creates = new_contacts
     updates = determine_updates(matched_contacts)
     deletes = potential_contacts_to_delete
@@ -163,11 +297,15 @@ def _print_deletes(data):
     print('----------' + '\n')
 
 
-def output_dry_run_results(creates=[], updates=[], deletes=[]):
+def print_dry_run_results(creates=[], updates=[], deletes=[]):
     print(' ------- DRY RUN OUTPUT -------')
     _print_creates(creates)
     _print_updates(updates)
     _print_deletes(deletes)
+
+
+def output_dry_run_results(creates=[], updates=[], deletes=[]):
+    print_dry_run_results(creates=creates, updates=updates, deletes=deletes)
     # Exit prematurely, since no additional work is needed
     exit(0)
 
@@ -0,0 +1,141 @@
+"""
+    Tests Breeze.get_contacts against a local stub of the Breeze API.
+
+    Run from the directory in which the sync.sh file lives (a code/secrets.py file is needed, like for the sync):
+
+        python -m unittest discover tests
+"""
+import json
+import os
+import sys
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from breeze import Breeze  # noqa: E402
+from configs import BREEZE_TAG_FETCH_CONCURRENCY  # noqa: E402
+from strategies import StrategyThree  # noqa: E402
+
+PEOPLE = [
+    {
+        'id': str(person_id),
+        'force_first_name': f'First {person_id}',
+        'last_name': f'Last {person_id}',
+        'details': {'79910291': [{'phone_type': 'mobile', 'phone_number': f'082 000 000{person_id}'}]},
+    }
+    for person_id in range(1, 5)
+]
+
+TAGS = [{'id': str(tag_id), 'name': f'Tag {tag_id} (Group)'} for tag_id in range(1, 7)]
+
+# The people of every tag, by tag id; the people of tag 4 can't be retrieved
+TAG_PEOPLE = {
+    '1': ['1', '2'],
+    '2': ['2'],
+    '3': [],
+    '5': ['1', '3', '4'],
+    '6': ['4'],
+}
+FAILING_TAG_ID = '4'
+
+
+class StubBreeze(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path.endswith('tags/list_tags'):
+            return self.reply(200, TAGS)
+        if 'filter_json' in query:
+            tag_id = json.loads(query['filter_json'][0])['tag_contains'][len('y_'):]
+            if tag_id == FAILING_TAG_ID:
+                return self.reply(500, {'error': 'Something broke'})
+            return self.reply(200, [{'id': person_id} for person_id in TAG_PEOPLE[tag_id]])
+        return self.reply(200, PEOPLE)
+
+    def reply(self, status_code, content):
+        body = json.dumps(content).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GetContactsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubBreeze)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.connections = set()
+        patches = [
+            mock.patch('breeze.BREEZE_API_URL', f'http://127.0.0.1:{self.server.server_port}/'),
+            # The failing tag is not retried, to keep the test fast
+            mock.patch.object(Breeze.client, 'max_retries', 0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_failed_tag_does_not_abort_the_run(self):
+        success, _contacts, tags = Breeze.get_contacts()
+
+        self.assertTrue(success)
+        self.assertEqual(tags, ['Tag 1 (Group)', 'Tag 2 (Group)', 'Tag 3 (Group)', 'Tag 5 (Group)', 'Tag 6 (Group)'])
+        self.assertEqual([failed_tag['tag']['name'] for failed_tag in Breeze.failed_tags], ['Tag 4 (Group)'])
+
+    def test_tags_are_added_in_tag_order(self):
+        _success, contacts, _tags = Breeze.get_contacts()
+
+        self.assertEqual({contact['id']: contact['tags'] for contact in contacts}, {
+            '1': ['Tag 1 (Group)', 'Tag 5 (Group)'],
+            '2': ['Tag 1 (Group)', 'Tag 2 (Group)'],
+            '3': ['Tag 5 (Group)'],
+            '4': ['Tag 5 (Group)', 'Tag 6 (Group)'],
+        })
+
+    def test_connections_are_reused(self):
+        for _run in range(3):
+            Breeze.get_contacts()
+
+        # 24 requests (the tags, the people and the people per tag, three times), over the pool's connections
+        self.assertLessEqual(len(self.server.connections), BREEZE_TAG_FETCH_CONCURRENCY)
+
+    def test_failed_tags_are_reported_and_their_labels_kept(self):
+        _success, _contacts, tags = Breeze.get_contacts()
+        StrategyThree.breeze_tags = tags
+        self.addCleanup(setattr, StrategyThree, 'breeze_tags', [])
+
+        self.assertIn('Tag 4 - Group', StrategyThree.protected_labels())
+        self.assertNotIn('Tag 4 - Group', StrategyThree.owned_labels())
+
+        sync_result = StrategyThree.add_failed_tags({
+            'status': 'success',
+            'failed': {'creates': {}, 'updates': [], 'deletes': []},
+            'stats': {'creates': '0/4', 'updates': '0/0', 'deletes': '0/0'},
+        })
+        self.assertEqual(sync_result['status'], 'failed')
+        self.assertEqual([failed_tag['tag'] for failed_tag in sync_result['failed']['tags']], ['Tag 4 (Group)'])
+        self.assertEqual(sync_result['stats']['tags'], '1/6')
+
+
+if __name__ == '__main__':
+    unittest.main()
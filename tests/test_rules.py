@@ -0,0 +1,120 @@
+"""
+    Tests the parsing and the evaluation of the dynamic tag criteria in rules.py.
+
+    Run from the directory in which the sync.sh file lives:
+
+        python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from rules import AllOf, AnyOf, Comparison, compile_criteria, compile_tag_rules  # noqa: E402
+
+PEOPLE = pd.DataFrame({
+    'Age': ['65', '30', None, 'unknown', '70.0'],
+    'Gender': ['Female', 'Male', 'Female', None, 'Male'],
+    'Campus': ['North', 'North', 'South', 'South', None],
+    'Member Number': [65.0, 12.0, np.nan, 7.0, 70.0],
+})
+
+
+def matches(criteria, dataframe=PEOPLE):
+    return compile_criteria(criteria).mask(dataframe).tolist()
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_and_binds_tighter_than_or(self):
+        predicate = compile_criteria('`Age` > `60` OR `Gender` = `Male` AND `Campus` = `North`')
+
+        self.assertIsInstance(predicate, AnyOf)
+        self.assertIsInstance(predicate.predicates[0], Comparison)
+        self.assertIsInstance(predicate.predicates[1], AllOf)
+        self.assertNotIsInstance(predicate.predicates[1], AnyOf)
+
+    def test_parentheses_group(self):
+        predicate = compile_criteria('(`Age` > `60` OR `Gender` = `Male`) AND `Campus` = `North`')
+
+        self.assertEqual(repr(predicate), '((`Age` > `60` OR `Gender` == `Male`) AND `Campus` == `North`)')
+
+    def test_keywords_are_case_insensitive(self):
+        self.assertEqual(
+            repr(compile_criteria('`Age` > `60` or `Gender` = `Male` and `Campus` = `North`')),
+            repr(compile_criteria('`Age` > `60` OR `Gender` = `Male` AND `Campus` = `North`')),
+        )
+
+    def test_a_single_comparison_is_not_wrapped(self):
+        predicate = compile_criteria('  `Member Number` <= `12`  ')
+
+        self.assertIsInstance(predicate, Comparison)
+        self.assertEqual((predicate.column, predicate.operator, predicate.number), ('Member Number', '<=', 12.0))
+
+    def test_invalid_criteria_are_rejected(self):
+        invalid_criteria = [
+            '`Age` >= `old`',                        # not a number for a numeric operator
+            '`Age` % `0`',                           # division by zero
+            '`Age` <> `65`',                         # unknown operator
+            '`Age` >= 65',                           # unquoted value
+            '(`Age` >= `65`',                        # unclosed parenthesis
+            '`Age` >= `65` `Gender`',                # trailing text
+            '`Age` >= `65` AND',                     # nothing after AND
+            '',
+        ]
+        for criteria in invalid_criteria:
+            with self.subTest(criteria=criteria):
+                with self.assertRaises(ValueError):
+                    compile_criteria(criteria)
+
+    def test_tag_rules_keep_their_order_and_name_the_invalid_tag(self):
+        rules = compile_tag_rules({'Legendes': '`Age` >= `65`', 'Male': '`Gender` = `Male`'})
+        self.assertEqual([tag_name for tag_name, _predicate in rules], ['Legendes', 'Male'])
+
+        with self.assertRaisesRegex(ValueError, 'Invalid criteria for dynamic tag Seniors'):
+            compile_tag_rules({'Legendes': '`Age` >= `65`', 'Seniors': '`Age` >= `sixty`'})
+
+
+class EvaluateTest(unittest.TestCase):
+
+    def test_equality_compares_text_and_numbers(self):
+        self.assertEqual(matches('`Gender` = `Female`'), [True, False, True, False, False])
+        self.assertEqual(matches('`Gender` == `Female`'), matches('`Gender` = `Female`'))
+        # '70.0' and 70.0 both equal `70`, as numbers
+        self.assertEqual(matches('`Age` = `70`'), [False, False, False, False, True])
+        self.assertEqual(matches('`Member Number` = `65`'), [True, False, False, False, False])
+
+    def test_missing_values_never_match(self):
+        self.assertEqual(matches('`Gender` != `Female`'), [False, True, False, False, True])
+        self.assertEqual(matches('`Member Number` != `65`'), [False, True, False, True, True])
+
+    def test_numeric_operators_skip_what_is_not_a_number(self):
+        self.assertEqual(matches('`Age` >= `65`'), [True, False, False, False, True])
+        self.assertEqual(matches('`Age` > `65`'), [False, False, False, False, True])
+        self.assertEqual(matches('`Age` < `65`'), [False, True, False, False, False])
+        self.assertEqual(matches('`Age` <= `65`'), [True, True, False, False, False])
+
+    def test_modulo_holds_when_there_is_a_remainder(self):
+        self.assertEqual(matches('`Member Number` % `2`'), [True, False, False, True, False])
+
+    def test_combinations(self):
+        self.assertEqual(matches('`Age` >= `65` AND `Gender` = `Male`'), [False, False, False, False, True])
+        self.assertEqual(matches('`Age` >= `65` OR `Campus` = `South`'), [True, False, True, True, True])
+        self.assertEqual(
+            matches('(`Age` >= `65` OR `Campus` = `South`) AND `Gender` = `Female`'),
+            [True, False, True, False, False],
+        )
+
+    def test_the_mask_is_a_boolean_array(self):
+        mask = compile_criteria('`Age` >= `65`').mask(PEOPLE.iloc[0:0])
+
+        self.assertEqual(mask.dtype, bool)
+        self.assertEqual(len(mask), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
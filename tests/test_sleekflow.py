@@ -0,0 +1,327 @@
+"""
+    Tests Sleekflow.sync against a local stub of the Sleekflow API.
+
+    Run from the directory in which the sync.sh file lives (a code/secrets.py file is needed, like for the sync):
+
+        python -m unittest discover tests
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from journal import SyncJournal  # noqa: E402
+from sleekflow import Sleekflow  # noqa: E402
+
+
+class StubSleekflow(BaseHTTPRequestHandler):
+    """
+        Keeps the contacts by (the digits of their) phone number and applies AddOrUpdate like Sleekflow does.
+        The batches with a contact of server.rejected_phone_numbers are rejected with a 400.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path, None))
+        offset = int(parse_qs(url.query).get('offset', ['0'])[0])
+        contacts = list(self.server.contacts.values())
+        return self.reply(200, contacts[offset:offset + Sleekflow.MAX_API_CONTACTS])
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(('POST', urlparse(self.path).path, body))
+        if any(payload['phoneNumber'] in self.server.rejected_phone_numbers for payload in body):
+            return self.reply(400, {'message': 'Invalid contact'})
+
+        for payload in body:
+            contact = self.server.contacts.setdefault(
+                re.sub(r'\D', '', payload['phoneNumber']),
+                {'id': f'sf{len(self.server.contacts)}', 'phoneNumber': payload['phoneNumber']},
+            )
+            contact.update({field: payload[field] for field in ('firstName', 'lastName') if field in payload})
+            labels = {label['LabelValue'] for label in contact.get('labels', [])}
+            labels.update(payload.get('addLabels', []))
+            labels.difference_update(payload.get('removeLabels', []))
+            contact['labels'] = [{'LabelValue': label} for label in sorted(labels)]
+        return self.reply(200, [{'id': 'ok'}] * len(body))
+
+    def reply(self, status_code, content):
+        body = json.dumps(content).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def breeze_contact(breeze_id, phone_number, first_name, tags=''):
+    # A processed contact, as handed to Sleekflow.sync
+    return {
+        'custom_field.breeze_id': breeze_id,
+        'Phone Number': phone_number,
+        'First Name': first_name,
+        'Last Name': 'Smith',
+        'Tags': tags,
+    }
+
+
+def sleekflow_contact(phone_number, first_name, labels):
+    return {
+        'id': f'sf-{phone_number}',
+        'phoneNumber': phone_number,
+        'firstName': first_name,
+        'lastName': 'Smith',
+        'labels': [{'LabelValue': label} for label in labels],
+    }
+
+
+class SleekflowTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubSleekflow)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.contacts = {}
+        self.server.requests = []
+        self.server.rejected_phone_numbers = set()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.snapshot_path = os.path.join(directory, 'snapshot.sqlite3')
+        patches = [
+            mock.patch.object(Sleekflow, 'base_url', f'http://127.0.0.1:{self.server.server_port}/'),
+            mock.patch('sleekflow.SLEEKFLOW_SYNC_SNAPSHOT_PATH', self.snapshot_path),
+            mock.patch('sleekflow.INCREMENTAL_SYNC_ENABLED', False),
+            mock.patch.object(Sleekflow.client, 'max_retries', 0),
+            # Not rate limited, so that the tests don't wait
+            mock.patch.object(Sleekflow.client.limiter, 'rate', None),
+            mock.patch.object(Sleekflow, 'full_sync', False),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def sync(self, contacts, **kwargs):
+        self.server.requests = []
+        return Sleekflow.sync(contacts, **kwargs)
+
+    def posted_payloads(self):
+        return [payload for method, _path, body in self.server.requests if method == 'POST' for payload in body]
+
+    def add_remote_contacts(self, *contacts):
+        for contact in contacts:
+            self.server.contacts[re.sub(r'\D', '', contact['phoneNumber'])] = contact
+
+    def remote_labels(self):
+        return {
+            phone_number: sorted(label['LabelValue'] for label in contact.get('labels', []))
+            for phone_number, contact in self.server.contacts.items()
+        }
+
+
+class SyncTest(SleekflowTestCase):
+
+    def test_changes_are_planned_by_phone_number(self):
+        self.add_remote_contacts(
+            sleekflow_contact('+27 82 000 0001', 'Anna', ['Choir']),
+            sleekflow_contact('27820000002', 'Ben', ['Youth', 'Added in Sleekflow']),
+            sleekflow_contact('27820000009', 'Zed', ['Choir', 'Added in Sleekflow']),
+            sleekflow_contact('27820000010', 'Yara', ['Added in Sleekflow']),
+        )
+
+        result = self.sync([
+            breeze_contact('1', '27820000001', 'Anna', 'Choir, Youth'),
+            breeze_contact('2', '27820000002', 'Benjamin', 'Youth'),
+            breeze_contact('3', '27820000003', 'Carl', 'Choir'),
+        ])
+
+        self.assertEqual(result['status'], Sleekflow.SUCCESS)
+        self.assertEqual(result['stats'], {'creates': '0/1', 'updates': '0/2', 'deletes': '0/1'})
+        self.assertEqual(self.posted_payloads(), [
+            # Creates, updates and deletes, in that order
+            {
+                'firstName': 'Carl', 'lastName': 'Smith', 'addLabels': ['Choir'], 'labels': ['Choir'],
+                'phoneNumber': '27820000003',
+            },
+            {'phoneNumber': '27820000001', 'addLabels': ['Youth']},
+            {'phoneNumber': '27820000002', 'firstName': 'Benjamin'},
+            # Labels that Breeze doesn't own are left alone
+            {'phoneNumber': '27820000009', 'removeLabels': ['Choir']},
+        ])
+        self.assertEqual(self.remote_labels(), {
+            '27820000001': ['Choir', 'Youth'],
+            '27820000002': ['Added in Sleekflow', 'Youth'],
+            '27820000003': ['Choir'],
+            '27820000009': ['Added in Sleekflow'],
+            '27820000010': ['Added in Sleekflow'],
+        })
+
+    def test_protected_labels_are_never_removed(self):
+        self.add_remote_contacts(
+            sleekflow_contact('27820000001', 'Anna', ['Choir', 'Youth']),
+            sleekflow_contact('27820000009', 'Zed', ['Choir', 'Youth']),
+        )
+
+        self.sync(
+            [breeze_contact('1', '27820000001', 'Anna', 'Choir')],
+            owned_labels=['Choir', 'Youth'],
+            protected_labels=['Youth'],
+        )
+
+        self.assertEqual(self.posted_payloads(), [{'phoneNumber': '27820000009', 'removeLabels': ['Choir']}])
+        self.assertEqual(self.remote_labels(), {'27820000001': ['Choir', 'Youth'], '27820000009': ['Youth']})
+
+    def test_rejected_contacts_are_found_by_splitting_the_batch(self):
+        self.server.rejected_phone_numbers = {'27820000003'}
+
+        result = self.sync([breeze_contact(str(i), f'2782000000{i}', f'Person {i}') for i in range(1, 6)])
+
+        self.assertEqual(result['status'], Sleekflow.FAILED)
+        failures = result['failed']['creates']['contact_creates']
+        self.assertEqual([failure['contact']['breeze_id'] for failure in failures], ['3'])
+        self.assertEqual(failures[0]['error']['status_code'], '400')
+        self.assertEqual(sorted(self.server.contacts), ['27820000001', '27820000002', '27820000004', '27820000005'])
+        # The batch of 5, its halves of 2 and 3 and the halves of the rejected half: the rejected contact on its own
+        # and the other 2
+        posted_batches = [body for method, _path, body in self.server.requests if method == 'POST']
+        self.assertEqual([len(batch) for batch in posted_batches], [5, 2, 3, 1, 2])
+
+
+class IncrementalSyncTest(SleekflowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patch = mock.patch('sleekflow.INCREMENTAL_SYNC_ENABLED', True)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.contacts = [
+            breeze_contact('1', '27820000001', 'Anna', 'Choir, Youth'),
+            breeze_contact('2', '27820000002', 'Ben', 'Choir'),
+            breeze_contact('3', '27820000003', 'Carl', 'Youth'),
+        ]
+        self.sync(self.contacts)
+
+    def test_unchanged_contacts_are_not_sent(self):
+        result = self.sync(self.contacts)
+
+        self.assertEqual(result['status'], Sleekflow.SUCCESS)
+        self.assertEqual(self.server.requests, [])
+
+    def test_only_changed_contacts_are_compared_and_sent(self):
+        self.contacts[0]['First Name'] = 'Annie'
+        self.contacts[1]['Tags'] = ''
+        del self.contacts[2]
+
+        self.sync(self.contacts)
+
+        # The Sleekflow contacts are not retrieved
+        self.assertNotIn('GET', [method for method, _path, _body in self.server.requests])
+        self.assertEqual(self.posted_payloads(), [
+            {'phoneNumber': '27820000001', 'firstName': 'Annie'},
+            {'phoneNumber': '27820000002', 'removeLabels': ['Choir']},
+            {'phoneNumber': '27820000003', 'removeLabels': ['Youth']},
+        ])
+        self.assertEqual(self.remote_labels(), {
+            '27820000001': ['Choir', 'Youth'], '27820000002': [], '27820000003': [],
+        })
+
+    def test_failed_contacts_are_sent_again(self):
+        self.contacts[0]['First Name'] = 'Annie'
+        self.server.rejected_phone_numbers = {'27820000001'}
+        self.assertEqual(self.sync(self.contacts)['status'], Sleekflow.FAILED)
+
+        self.server.rejected_phone_numbers = set()
+        self.sync(self.contacts)
+
+        self.assertEqual(self.posted_payloads(), [{'phoneNumber': '27820000001', 'firstName': 'Annie'}])
+
+    def test_full_sync_compares_all_the_sleekflow_contacts(self):
+        # Changed in Sleekflow itself, which only a full sync sees
+        self.server.contacts['27820000002']['firstName'] = 'Benjamin'
+
+        self.sync(self.contacts)
+        self.assertEqual(self.server.requests, [])
+
+        Sleekflow.set_full_sync(True)
+        self.sync(self.contacts)
+        self.assertIn('GET', [method for method, _path, _body in self.server.requests])
+        self.assertEqual(self.posted_payloads(), [{'phoneNumber': '27820000002', 'firstName': 'Ben'}])
+
+
+class ResumeTest(SleekflowTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.journal = SyncJournal(os.path.join(os.path.dirname(self.snapshot_path), 'sync_1', 'journal.jsonl'))
+        self.contacts = [
+            breeze_contact('1', '27820000001', 'Anna', 'Choir'),
+            breeze_contact('2', '27820000002', 'Ben', 'Choir'),
+            breeze_contact('3', '27820000003', 'Carl'),
+        ]
+
+    def test_a_cut_off_plan_is_compared_again_without_the_uploaded_changes(self):
+        # Like the async engine leaves it when it's killed while it compares: the first batch was uploaded
+        contact, payload = {'phoneNumber': '27820000001', 'breeze_id': '1'}, {'phoneNumber': '27820000001'}
+        self.journal.record_planned_changes('creates', [(contact, payload)])
+        self.journal.record_uploaded('creates', ['27820000001'], [])
+        self.journal.close()
+
+        journal = SyncJournal.find_interrupted(os.path.dirname(os.path.dirname(self.journal.path)), 'journal.jsonl')
+        self.assertEqual(journal.path, self.journal.path)
+        self.assertFalse(journal.is_plan_complete())
+
+        journal.record_resumed()
+        result = self.sync(self.contacts, journal=journal)
+
+        self.assertEqual(result['status'], Sleekflow.SUCCESS)
+        self.assertEqual([payload['phoneNumber'] for payload in self.posted_payloads()], ['27820000002', '27820000003'])
+        changes, _ignored_contacts, uploaded_phone_numbers, _failures = journal.read()
+        self.assertEqual(len(changes['creates']), 3)
+        self.assertEqual(uploaded_phone_numbers['creates'], {'27820000001', '27820000002', '27820000003'})
+        self.assertIsNone(SyncJournal.find_interrupted(os.path.dirname(os.path.dirname(journal.path)), 'journal.jsonl'))
+
+    def test_a_sync_cut_mid_upload_only_uploads_the_rest(self):
+        contacts, _ignored_contacts = Sleekflow.parse_contacts(self.contacts)
+        creates, _updates, _deletes = Sleekflow.compare_to_remote_contacts(contacts, [])
+        self.journal.record_plan({'creates': creates, 'updates': [], 'deletes': []}, [])
+        # The first batch was uploaded, and one of its contacts failed
+        failure = Sleekflow._failed_record(creates[0][0], message='Rejected')
+        self.journal.record_uploaded('creates', ['27820000001'], [failure])
+        self.journal.close()
+
+        journal = SyncJournal.find_interrupted(os.path.dirname(os.path.dirname(self.journal.path)), 'journal.jsonl')
+        self.assertTrue(journal.is_plan_complete())
+        self.server.requests = []
+        result = Sleekflow.resume(journal)
+
+        self.assertEqual([payload['phoneNumber'] for payload in self.posted_payloads()], ['27820000002', '27820000003'])
+        self.assertNotIn('GET', [method for method, _path, _body in self.server.requests])
+        self.assertEqual(result['status'], Sleekflow.FAILED)
+        self.assertEqual(result['failed']['creates']['contact_creates'], [failure])
+        self.assertEqual(result['stats']['creates'], '1/3')
+        self.assertIsNone(SyncJournal.find_interrupted(os.path.dirname(os.path.dirname(journal.path)), 'journal.jsonl'))
+
+
+if __name__ == '__main__':
+    unittest.main()
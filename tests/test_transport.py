@@ -0,0 +1,212 @@
+"""
+    Tests the retry and backoff decisions of transport.HTTPClient against a local stub server.
+
+    Run from the directory in which the sync.sh file lives (a code/secrets.py file is needed, like for the sync):
+
+        python -m unittest discover tests
+"""
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from transport import HTTPClient, _retry_after_seconds, shared_request_budget  # noqa: E402
+
+# The tests patch time.sleep away for the client, not for the stub server
+sleep = time.sleep
+
+
+class StubService(BaseHTTPRequestHandler):
+    """
+        Replies with the (<status code>, <headers>) tuples of server.responses in turn, then with a 200.
+        Every reply waits server.delay seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.reply()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.reply()
+
+    def reply(self):
+        with self.server.lock:
+            self.server.requests.append(self.command)
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+            status_code, headers = self.server.responses.popleft() if self.server.responses else (200, {})
+
+        sleep(self.server.delay)
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        try:
+            self.send_response(status_code)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'{}')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client timed out
+            pass
+
+
+def response_with_retry_after(retry_after):
+    response = requests.Response()
+    response.status_code = 429
+    response.headers['Retry-After'] = retry_after
+    return response
+
+
+class HTTPClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubService)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/contacts'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.responses = deque()
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.in_flight = 0
+        self.server.max_in_flight = 0
+
+        self.client = HTTPClient(
+            'test', timeout=(1, 1), max_retries=2, max_rate_limited_retries=4, backoff_seconds=1, max_backoff_seconds=3,
+        )
+        self.addCleanup(self.client.session.close)
+        # The waits between the retries are recorded instead of waited
+        patch = mock.patch('transport.time.sleep')
+        self.sleep = patch.start()
+        self.addCleanup(patch.stop)
+
+    def respond(self, *status_codes, headers=None):
+        self.server.responses.extend((status_code, headers or {}) for status_code in status_codes)
+
+    def test_post_is_retried_when_the_server_did_not_process_it(self):
+        self.respond(503, 429)
+
+        response = self.client.post(self.url, data='[]')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, ['POST'] * 3)
+
+    def test_post_is_not_retried_when_the_server_may_have_processed_it(self):
+        for status_code in (500, 502, 504):
+            with self.subTest(status_code=status_code):
+                self.server.requests = []
+                self.respond(status_code)
+
+                self.assertEqual(self.client.post(self.url, data='[]').status_code, status_code)
+                self.assertEqual(self.server.requests, ['POST'])
+
+    def test_get_is_retried_on_server_errors(self):
+        self.respond(500, 502, 504)
+
+        response = self.client.get(self.url)
+
+        # The third failure is the last retry
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(self.server.requests, ['GET'] * 3)
+
+    def test_client_errors_are_not_retried(self):
+        self.respond(400, 404)
+
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+        self.assertEqual(self.client.post(self.url, data='[]').status_code, 404)
+        self.assertEqual(self.server.requests, ['GET', 'POST'])
+
+    def test_rate_limited_requests_get_more_retries(self):
+        self.respond(*[429] * 10)
+
+        self.assertEqual(self.client.post(self.url, data='[]').status_code, 429)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_retry_after_is_honoured_beyond_the_maximum_backoff(self):
+        self.respond(429, headers={'Retry-After': '12'})
+
+        self.client.post(self.url, data='[]')
+
+        self.sleep.assert_called_once_with(12.0)
+
+    def test_the_exponential_backoff_is_capped(self):
+        with mock.patch('transport.random.uniform', side_effect=lambda low, high: high):
+            self.assertEqual([self.client._backoff(attempt) for attempt in range(4)], [1, 2, 3, 3])
+
+    def test_retry_after_seconds(self):
+        self.assertEqual(_retry_after_seconds(response_with_retry_after('2.5')), 2.5)
+        self.assertEqual(_retry_after_seconds(response_with_retry_after('-1')), 0)
+        self.assertIsNone(_retry_after_seconds(response_with_retry_after('soon')))
+        self.assertIsNone(_retry_after_seconds(requests.Response()))
+
+        retry_at = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+        self.assertAlmostEqual(_retry_after_seconds(response_with_retry_after(retry_at)), 60, delta=2)
+        retried_at = format_datetime(datetime.now(timezone.utc) - timedelta(seconds=60), usegmt=True)
+        self.assertEqual(_retry_after_seconds(response_with_retry_after(retried_at)), 0)
+
+    def test_post_is_retried_when_no_connection_could_be_made(self):
+        with socket.socket() as unused_socket:
+            unused_socket.bind(('127.0.0.1', 0))
+            closed_port_url = f'http://127.0.0.1:{unused_socket.getsockname()[1]}/contacts'
+
+        with self.assertRaises(requests.ConnectionError):
+            self.client.post(closed_port_url, data='[]')
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_post_is_not_retried_when_the_response_timed_out(self):
+        self.server.delay = 0.5
+
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.post(self.url, data='[]', timeout=(1, 0.2))
+        self.assertEqual(self.server.requests, ['POST'])
+
+    def test_get_is_retried_when_the_response_timed_out(self):
+        self.server.delay = 0.5
+
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.get(self.url, timeout=(1, 0.2))
+        self.assertEqual(self.server.requests, ['GET'] * 3)
+
+    def test_a_shared_budget_limits_the_requests_in_flight(self):
+        self.server.delay = 0.1
+        clients = [self.client, HTTPClient('other test', timeout=(1, 1))]
+        self.addCleanup(clients[1].session.close)
+
+        with shared_request_budget(2):
+            threads = [threading.Thread(target=clients[i % 2].get, args=(self.url,)) for i in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(self.server.requests), 6)
+        self.assertEqual(self.server.max_in_flight, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()